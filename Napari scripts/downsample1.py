@@ -1,11 +1,14 @@
 import os
+import sys
 import numpy as np 
 from pathlib import Path
-from tifffile import imread
-from tifffile import imsave
 from tifffile import imwrite
 from timeit import default_timer as time
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from interact.readers import open_stack
+from interact.pipeline import run_pipeline, load_stacks
+
 file_folder = Path('/Volumes/Song_8TB/20220415_143603_GFPwGBDE01T01')
 
 max_dir = file_folder / ('0_max_projections')
@@ -24,7 +27,7 @@ i0_C00_files = [item for item in files if 'I0' in item]
 i1_C00_files = [item for item in files if 'I1' in item]
 i0_C00_files.sort()
 i1_C00_files.sort()
-sample_image = imread(file_folder / i0_C00_files[0])
+sample_image = open_stack(file_folder / i0_C00_files[0])
 slices = sample_image.shape[0]
 pixels = sample_image.shape[1]
 
@@ -39,33 +42,35 @@ full_shape = slices, pixels, pixels
 max_shape = pixels, pixels
 
 save_dict = {}
+px_xy = (6.4/magnification)*xy_scale_factor
+px_z = 2.5 * z_scale_factor
 
-for index in range(frames):
-    start = time()
-    i0_C00 = np.zeros(full_shape, dtype = 'uint16')
-    i1_C00 = np.zeros(full_shape, dtype = 'uint16')
-    c00 = np.zeros(full_shape, dtype = 'uint16')
-    c00_Max = np.zeros(max_shape, dtype='uint16')
-    print('finished creating empty arrays')
+def read_frame(index):
+    # read fully into memory on the pipeline's reader thread, ahead of the frame being processed
     print(f'starting to load time point {index} of channel {name}')
-    i0_C00 = imread(file_folder / i0_C00_files[index])
-    print('finished loading left side illumination')
-    i1_C00 = imread(file_folder / i1_C00_files[index])
-    print('finished loading right side illumination')
-    c00 = np.maximum(i0_C00, i1_C00)
-    
+    stacks = load_stacks([file_folder / i0_C00_files[index], file_folder / i1_C00_files[index]])
+    print(f'finished loading time point {index}')
+    return stacks
+
+def process_frame(index, stacks):
+    start = time()
+    c00 = np.maximum(stacks[0], stacks[1])
     print('finished merging left and right sided illumination')
     c00_Max = np.max(c00, axis=0)
     print('finished calculating max projection')
-    c00 = c00[::z_scale_factor,::xy_scale_factor,::xy_scale_factor]
+    c00 = c00[::z_scale_factor,::xy_scale_factor,::xy_scale_factor].copy()
     print('finished downsampling volume')
+    return c00, c00_Max, start
 
-    px_xy = (6.4/magnification)*xy_scale_factor
-    px_z = 2.5 * z_scale_factor
-
+def write_frame(index, result):
+    c00, c00_Max, start = result
     imwrite(vol_dir / (name + '_' + str(index) + '.tif'), c00, imagej=True, resolution=(1./px_xy, 1./px_xy), metadata={'spacing': px_z, 'unit': 'um', 'axes': 'ZYX', 'finterval': 16})
     imwrite(max_dir / (name + '_' + str(index) + '.tif'), c00_Max, imagej=True, resolution=(1./(6.4/magnification), 1./(6.4/magnification)), metadata={'unit': 'um', 'axes': 'YX', 'finterval': 16})
     end = time()
     save_dict[str(index)] = end-start
     print(f'finished processing frame {index} in {round((end-start), 4)} seconds')
-    print(f'{round((index+1)/frames*100, 2)}% finished downsampling all frames')
\ No newline at end of file
+
+# frames are read ahead, processed and written behind on separate threads; memory_mb caps how
+# many stacks are held at once
+run_pipeline(list(range(frames)), read_frame, process_frame, write_frame, read_ahead=2, num_workers=2, memory_mb=8192)
+print('finished downsampling all frames')
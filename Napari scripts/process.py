@@ -1,11 +1,15 @@
 import os
+import sys
 import numpy as np 
 from pathlib import Path
-from tifffile import imread
-from tifffile import imsave
 from tifffile import imwrite
 from timeit import default_timer as time
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from interact.readers import open_stack
+from interact.instrument import StageTimer, RunLog, LOG_NAME
+from interact.pipeline import run_pipeline, load_stacks, data_nbytes
+
 file_folder = Path('/Volumes/Song_EP/20220421_125427_Exp318_1-300')
 
 max_dir = file_folder / ('0_max_projections')
@@ -22,7 +26,7 @@ i0_C00_files = [item for item in files if 'I0' in item]
 i1_C00_files = [item for item in files if 'I1' in item]
 i0_C00_files.sort()
 i1_C00_files.sort()
-sample_image = imread(file_folder / i0_C00_files[0])
+sample_image = open_stack(file_folder / i0_C00_files[0])
 slices = sample_image.shape[0]
 pixels = sample_image.shape[1]
 
@@ -36,31 +40,44 @@ frames = len(i0_C00_files)
 full_shape = slices, pixels, pixels
 max_shape = pixels, pixels
 
-save_dict = {}
+run_log = RunLog(max_dir / LOG_NAME)
+run_timer = StageTimer()
+run_start = time()
 
-for index in range(frames):
+def read_frame(index):
+    # read fully into memory on the pipeline's reader thread, ahead of the frame being projected
+    print(f'starting to load time point {index} of channel {name}')
     start = time()
-    i0_C00 = np.zeros(full_shape, dtype = 'uint16')
-    i1_C00 = np.zeros(full_shape, dtype = 'uint16')
-    c00_Max = np.zeros(max_shape, dtype='uint16')
-    print('finished creating empty arrays')
+    stacks = load_stacks([file_folder / i0_C00_files[index], file_folder / i1_C00_files[index]])
+    print(f'finished loading time point {index}')
+    return stacks, time() - start
 
-    print(f'starting to load time point {index} of channel {name}')
-    i0_C00 = imread(file_folder / i0_C00_files[index])
-    print('finished loading left side illumination')
-    i1_C00 = imread(file_folder / i1_C00_files[index])
-    print('finished loading right side illumination')
-    
-    i0_Max = np.max(i0_C00, axis=0)
-    i1_Max = np.max(i1_C00, axis=0)
-    c00_Max = np.maximum(i0_Max, i1_Max)
+def project_frame(index, data):
+    (i0_C00, i1_C00), read_seconds = data
+    start = time()
+    timer = StageTimer()
+    timer.add('read', read_seconds, bytes_read=i0_C00.nbytes + i1_C00.nbytes)
+    with timer.stage('project'):
+        i0_Max = np.max(i0_C00, axis=0)
+        i1_Max = np.max(i1_C00, axis=0)
+    with timer.stage('fuse'):
+        c00_Max = np.maximum(i0_Max, i1_Max)
     print('finished merging max projections')
+    return c00_Max, timer, time() - start
+
+def write_frame(index, result):
+    c00_Max, timer, seconds = result
+    start = time()
+    with timer.stage('write', bytes_written=c00_Max.nbytes):
+        imwrite(max_dir / (name + '_' + str(index) + '.tif'), c00_Max, imagej=True, resolution=(1./(6.4/magnification), 1./(6.4/magnification)), metadata={'unit': 'um', 'axes': 'YX', 'finterval': 16})
+    seconds += time() - start
+    run_log.record('frame', timer, channel=name, frame=index, wall_seconds=seconds)
+    run_timer.merge(timer)
+    print(f'finished processing frame {index} in {round(seconds, 4)} seconds')
 
-    px_xy = (6.4/magnification)*xy_scale_factor
-    px_z = 2.5 * z_scale_factor
+# frames are read ahead, projected and written behind on separate threads; memory_mb caps how
+# many stacks are held at once
+run_pipeline(list(range(frames)), read_frame, project_frame, write_frame, read_ahead=2, num_workers=2, memory_mb=8192,
+             size=lambda data: data_nbytes(data[0]))
 
-    imwrite(max_dir / (name + '_' + str(index) + '.tif'), c00_Max, imagej=True, resolution=(1./(6.4/magnification), 1./(6.4/magnification)), metadata={'unit': 'um', 'axes': 'YX', 'finterval': 16})
-    end = time()
-    save_dict[str(index)] = end-start
-    print(f'finished processing frame {index} in {round((end-start), 4)} seconds')
-    print(f'{round((index+1)/frames*100, 2)}% finished processing all frames')
\ No newline at end of file
+run_log.summary(run_timer, wall_seconds=time()-run_start, channel=name, frames=frames)
@@ -0,0 +1,187 @@
+'''
+Lossless archiving of raw acquisitions. Every stack is re-encoded into a chunked, compressed
+zarr array named like the original (S000_t000000_..._P00100.zarr) with the bit-shuffled Blosc
+codecs the volumes use, which typically shrinks sparse 16-bit fluorescence several fold. The
+settings and metadata files are kept as they are, so the catalog, the index and every reader see
+the same acquisition. Each archived stack is checked pixel for pixel against its source with a
+checksum before the source is (optionally) deleted, and the stacks are archived across a process
+pool.
+'''
+import os
+import json
+import shutil
+import hashlib
+import time
+import zarr
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tifffile import TiffFile
+from interact.catalog import Catalog
+from interact.readers import iter_planes, stack_shape
+from interact.storage import compressor, stored_size
+from interact.index import INDEX_NAME
+
+ARCHIVE_CODEC = 'blosc-zstd'
+ARCHIVE_CHUNKS = (1, 512, 512) # one plane deep, so a single plane decompresses without its neighbours
+ARCHIVE_MANIFEST = 'kkpo_archive.json'
+PARTIAL_SUFFIX = '.partial' # archives being written, not picked up by the catalog
+
+
+def archive_name(stack_name):
+    '''
+    S000_..._P00100.tif -> S000_..._P00100.zarr
+    '''
+    return f'{Path(stack_name).stem}.zarr'
+
+
+def pixel_checksum(planes, shape, dtype):
+    '''
+    blake2b checksum of the pixels of a stack, independent of how they are stored.
+    Parameters: planes (iterable) - the planes in order, see readers.iter_planes
+                shape (tuple), dtype (np.dtype) - of the stack, hashed in as well
+    Returns: hex digest
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{tuple(shape)} {dtype.str}'.encode())
+    for plane in planes:
+        digest.update(memoryview(plane.astype(dtype, copy=False).tobytes()))
+    return digest.hexdigest()
+
+
+def archive_stack(source_path, archive_path, codec=ARCHIVE_CODEC, chunks=ARCHIVE_CHUNKS, delete_source=False):
+    '''
+    Re-encodes one stack, verifies it and optionally deletes the source. Runs in a worker process.
+    The archive is written under a temporary name and only renamed once its pixels have been read
+    back and their checksum matches the source's.
+    Parameters: source_path (str/Path) - the .tif or .raw stack
+                archive_path (str/Path) - the .zarr to write
+                codec (str or codec) - codec profile from storage.CODEC_PROFILES; must be lossless
+                chunks (tuple) - (Z, Y, X) chunk shape, clipped to the stack
+                delete_source (bool) - delete the source once the archive is verified
+    Returns: dict with the 'checksum', 'source_bytes', 'archive_bytes' and 'seconds'
+    '''
+    start = time.perf_counter()
+    source_path, archive_path = Path(source_path), Path(archive_path)
+    partial_path = archive_path.with_name(archive_path.name + PARTIAL_SUFFIX)
+    if partial_path.exists():
+        shutil.rmtree(partial_path)
+    shape, dtype = stack_shape(source_path)
+    array = zarr.open_array(str(partial_path), mode='w', shape=shape, dtype=dtype,
+                            chunks=tuple(min(c, size) for c, size in zip(chunks, shape)),
+                            compressor=compressor(codec), dimension_separator='/')
+
+    # hash the source while it is streamed into the archive, so it is only read once
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{tuple(shape)} {dtype.str}'.encode())
+    block = []
+    z_start = 0
+    for plane in iter_planes(source_path):
+        digest.update(memoryview(plane.tobytes()))
+        block.append(plane)
+        if len(block) == array.chunks[0]:
+            array[z_start:z_start + len(block)] = block
+            z_start += len(block)
+            block = []
+    if block:
+        array[z_start:z_start + len(block)] = block
+    source_checksum = digest.hexdigest()
+
+    # read back what was written, a plane at a time, straight from the compressed chunks
+    written = zarr.open_array(str(partial_path), mode='r')
+    archive_checksum = pixel_checksum((written[z] for z in range(shape[0])), shape, dtype)
+    if archive_checksum != source_checksum:
+        shutil.rmtree(partial_path)
+        raise ValueError(f'{archive_path.name} does not match {source_path.name} after re-encoding, the source was kept')
+
+    description = None
+    if source_path.suffix == '.tif':
+        with TiffFile(source_path) as tif:
+            description = tif.pages[0].description or None
+    source_bytes = os.path.getsize(source_path)
+    array.attrs.update({'source_name': source_path.name, 'source_bytes': source_bytes, 'checksum': source_checksum,
+                        'tiff_description': description})
+    if archive_path.exists():
+        shutil.rmtree(archive_path)
+    os.rename(partial_path, archive_path)
+    if delete_source:
+        os.remove(source_path)
+    return {'checksum': source_checksum, 'source_bytes': source_bytes, 'archive_bytes': stored_size(archive_path),
+            'seconds': time.perf_counter() - start}
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {'stacks': {}, 'failures': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    temp_path = f'{manifest_path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, manifest_path)
+
+
+def archive_acquisition(dir_path, out_dir=None, codec=ARCHIVE_CODEC, chunks=ARCHIVE_CHUNKS, num_workers=None, delete_originals=False):
+    '''
+    Archives every stack of an acquisition folder. Stacks already in the folder's archive manifest
+    are skipped, so an interrupted run picks up where it stopped.
+    Parameters: dir_path (str/Path) - the acquisition folder
+                out_dir (str/Path) - folder to write the archive to, with copies of the settings and
+                                     metadata files; None archives in place, which replaces every
+                                     original with its archive and needs delete_originals=True
+                codec (str or codec) - lossless codec profile, see storage.CODEC_PROFILES
+                chunks (tuple) - (Z, Y, X) chunk shape of the archived stacks
+                num_workers (int) - stacks archived at once in separate processes, None for one per CPU
+                delete_originals (bool) - delete every original once its archive has been verified
+    Returns: the manifest, {'stacks': {stack name: record}, 'failures': {stack name: error}}
+    '''
+    dir_path = Path(dir_path)
+    out_dir = Path(out_dir) if out_dir is not None else dir_path
+    if out_dir == dir_path and not delete_originals:
+        raise ValueError('Archiving in place replaces the original stacks, pass delete_originals=True or an out_dir')
+    Path.mkdir(out_dir, parents=True, exist_ok=True)
+    manifest_path = out_dir / ARCHIVE_MANIFEST
+    manifest = load_manifest(manifest_path)
+    manifest['failures'] = {}
+
+    file_names = os.listdir(dir_path)
+    catalog = Catalog([name for name in file_names if not name.endswith('.zarr')])
+    if out_dir != dir_path:
+        # the settings, metadata and anything else that is not a stack travel with the archive as they are
+        for name in file_names:
+            source = dir_path / name
+            if (name in catalog.names or name.startswith('.') or name in (INDEX_NAME, ARCHIVE_MANIFEST) or not source.is_file()
+                    or (out_dir / name).exists()):
+                continue
+            shutil.copy2(source, out_dir / name)
+
+    todo = [name for name in catalog.names
+            if not (name in manifest['stacks'] and (out_dir / archive_name(name)).exists())]
+    print(f'Archiving {len(todo)} of {len(catalog)} stacks from {dir_path} to {out_dir}')
+    if not todo:
+        return manifest
+    source_bytes = archive_bytes = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(archive_stack, dir_path / name, out_dir / archive_name(name), codec, chunks, delete_originals): name
+                   for name in todo}
+        for done, future in enumerate(as_completed(futures), start=1):
+            name = futures[future]
+            try:
+                record = future.result()
+            except Exception as error:
+                print(f'Could not archive {name}: {error}')
+                manifest['failures'][name] = repr(error)
+                continue
+            record['archive'] = archive_name(name)
+            manifest['stacks'][name] = record
+            source_bytes += record['source_bytes']
+            archive_bytes += record['archive_bytes']
+            save_manifest(manifest, manifest_path)
+            print(f'{done}/{len(todo)} archived {name}, {record["source_bytes"] / max(record["archive_bytes"], 1):.2f}x smaller')
+    save_manifest(manifest, manifest_path)
+    if archive_bytes:
+        print(f'Archived {source_bytes / 1e9:.2f} GB into {archive_bytes / 1e9:.2f} GB ({source_bytes / archive_bytes:.2f}x), '
+              f'{len(manifest["failures"])} failure(s)')
+    return manifest
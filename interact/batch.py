@@ -0,0 +1,277 @@
+'''
+Batch driver for converting many acquisitions at once. Every (directory, region, channel) is an
+independent job run on a process pool or a dask cluster, and a persistent manifest records which
+(directory, region, channel, output) units have finished so interrupted batches pick up where
+they stopped.
+'''
+import os
+import json
+import hashlib
+import traceback
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from interact.catalog import Catalog
+from interact.storage import DEFAULT_CHUNKS, DEFAULT_CODEC
+from interact.hyperstack import MAX_FORMATS
+from interact.pipeline import PLANE_MEMORY_MB
+
+OUTPUTS = ('max', 'vol')
+MANIFEST_NAME = 'kkpo_manifest.json'
+
+
+def find_acquisitions(root_path):
+    '''
+    Walks a folder and returns every directory that contains Flamingo stacks.
+    Parameters: root_path (str/Path) - folder to search, e.g. '/Volumes/zs2tb/stims/'
+    Returns: sorted list of Paths
+    '''
+    acquisitions = []
+    for dir_path, dir_names, file_names in os.walk(root_path):
+        # archived stacks are .zarr folders, so they count as stacks but are not searched
+        stack_dirs = [name for name in dir_names if name.endswith('.zarr')]
+        dir_names[:] = [name for name in dir_names if not name.endswith('_processed') and not name.endswith('.zarr')]
+        if len(Catalog(file_names + stack_dirs)):
+            acquisitions.append(Path(dir_path))
+    return sorted(acquisitions)
+
+
+def output_files(path):
+    '''
+    Lists the files making up an output, which is either a single file or a folder such as a zarr.
+    '''
+    path = Path(path)
+    if path.is_dir():
+        return sorted(file for file in path.rglob('*') if file.is_file())
+    return [path]
+
+
+def checksum(path, block_size=2**22):
+    '''
+    blake2b checksum of an output. Folders are hashed file by file in sorted order, including the
+    relative file names, so a missing or renamed chunk changes the checksum.
+    Parameters: path (str/Path) - file or folder
+                block_size (int) - bytes read at a time
+    Returns: hex digest (str)
+    '''
+    path = Path(path)
+    digest = hashlib.blake2b(digest_size=16)
+    for file in output_files(path):
+        if path.is_dir():
+            digest.update(str(file.relative_to(path)).encode())
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def output_size(path):
+    return sum(file.stat().st_size for file in output_files(path))
+
+
+class Manifest:
+    '''
+    JSON record of the finished and failed units of a batch. It is rewritten atomically after
+    every job, so a crash or Ctrl-C never loses more than the jobs that were running.
+    '''
+
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r') as f:
+                self.units = json.load(f)
+        else:
+            self.units = {}
+
+    @staticmethod
+    def key(dir_path, region_name, ch_name, output):
+        return '|'.join([str(Path(dir_path).resolve()), region_name, ch_name, output])
+
+    def is_done(self, dir_path, region_name, ch_name, output, verify=False):
+        '''
+        Checks whether a unit finished in an earlier run and its outputs are still on disk with the
+        recorded size (and checksum, when verify is True).
+        '''
+        unit = self.units.get(self.key(dir_path, region_name, ch_name, output))
+        if unit is None or unit['status'] != 'done':
+            return False
+        for record in unit['files']:
+            if not os.path.exists(record['path']) or output_size(record['path']) != record['size']:
+                return False
+            if verify and record['checksum'] is not None and checksum(record['path']) != record['checksum']:
+                return False
+        return True
+
+    def record_done(self, dir_path, region_name, ch_name, output, paths, with_checksum=True, shared=()):
+        '''
+        Parameters: paths (list) - the files of the unit
+                    shared (list) - those of paths that other units write into as well, such as a
+                                    region's max projection hyperstack; only their size is recorded,
+                                    since their checksum changes as the other units finish
+        '''
+        shared = {str(path) for path in shared}
+        self.units[self.key(dir_path, region_name, ch_name, output)] = {
+            'status': 'done',
+            'finished': datetime.now().isoformat(timespec='seconds'),
+            'files': [{'path': str(path),
+                       'size': output_size(path),
+                       'checksum': checksum(path) if with_checksum and str(path) not in shared else None} for path in paths]}
+
+    def record_failure(self, dir_path, region_name, ch_name, output, error):
+        self.units[self.key(dir_path, region_name, ch_name, output)] = {
+            'status': 'failed',
+            'finished': datetime.now().isoformat(timespec='seconds'),
+            'error': error,
+            'files': []}
+
+    def save(self):
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.units, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def failures(self):
+        return {key: unit['error'] for key, unit in self.units.items() if unit['status'] == 'failed'}
+
+
+def plan_jobs(dirs, manifest, outputs=OUTPUTS, verify=False):
+    '''
+    Lists the jobs still to do. A job is one (directory, region, channel) with the outputs that
+    have not finished yet, so a channel whose max projections are done but whose volume failed
+    only redoes the volume.
+    Returns: list of job dicts
+    '''
+    jobs = []
+    for dir_path in dirs:
+        catalog = Catalog.from_dir(dir_path)
+        for region_name in catalog.tokens('R'):
+            for ch_name in catalog.tokens('C', R=region_name):
+                missing = [output for output in outputs if not manifest.is_done(dir_path, region_name, ch_name, output, verify=verify)]
+                if missing:
+                    jobs.append({'dir_path': str(dir_path),
+                                 'region_name': str(region_name),
+                                 'ch_name': str(ch_name),
+                                 'outputs': missing,
+                                 'disk': os.stat(dir_path).st_dev})
+    return jobs
+
+
+def run_job(dir_path, region_name, ch_name, outputs, step=8, num_workers=None, chunks=DEFAULT_CHUNKS, codec=DEFAULT_CODEC, fusion=None,
+            max_format='hyperstack', memory_mb=PLANE_MEMORY_MB):
+    '''
+    Converts one (directory, region, channel). Runs in a worker process. The channels of a region
+    share its max projection hyperstack, which is kept from earlier runs so the channels that
+    already finished keep their planes.
+    Parameters: memory_mb (float) - cap on the planes this job reads ahead, see Kkpo.save_regions
+    Returns: dict of the outputs written, see Kkpo.save_channel, with the region's hyperstack
+             under 'hyperstack' as well when the projections went into it
+    '''
+    from interact.kkpo import Kkpo
+    kkpo = Kkpo(dir_path)
+    region_info = kkpo.get_region_info(region_name)
+    hyperstack = kkpo.max_hyperstack(region_name, region_info) if 'max' in outputs and max_format != 'tiff' else None
+    written = kkpo.save_channel(region_name, ch_name, save_vol='vol' in outputs, save_max='max' in outputs,
+                                step=step, num_workers=num_workers, chunks=chunks, codec=codec, fusion=fusion, region_info=region_info,
+                                max_files=max_format != 'hyperstack', hyperstack=hyperstack, memory_mb=memory_mb)
+    written = {output: [str(path) for path in paths] for output, paths in written.items() if output in outputs}
+    if hyperstack is not None and str(hyperstack['path']) in written.get('max', []):
+        written['hyperstack'] = [str(hyperstack['path'])]
+    return written
+
+
+def run_batch(dirs, manifest_path=None, outputs=OUTPUTS, step=8, max_jobs=None, max_jobs_per_disk=2,
+              workers_per_job=None, client=None, verify=False, with_checksum=True, chunks=DEFAULT_CHUNKS, codec=DEFAULT_CODEC,
+              fusion=None, max_format='hyperstack', memory_mb=PLANE_MEMORY_MB):
+    '''
+    Converts every region and channel of many acquisitions in parallel, skipping the units that
+    the manifest says are already done.
+    Parameters: dirs (list or str/Path) - acquisition directories, or a folder to search with
+                                          find_acquisitions
+                manifest_path (str/Path) - manifest to resume from, by default kkpo_manifest.json
+                                           in the searched folder (or the first directory's parent)
+                outputs (tuple) - any of 'max' and 'vol'
+                step, chunks, codec, fusion, max_format - see Kkpo.save_regions
+                max_jobs (int) - jobs running at once across all disks, None for the pool default
+                max_jobs_per_disk (int) - jobs running at once reading/writing the same disk
+                workers_per_job (int) - timepoints converted at once inside each job
+                client (distributed.Client) - run on a dask cluster instead of a local process pool
+                verify (bool) - recompute checksums of finished outputs before skipping them
+                with_checksum (bool) - checksum outputs as they finish
+                memory_mb (float) - cap on the planes read ahead by all the jobs running at once,
+                                    shared out evenly between them; None for no cap
+    Returns: Manifest
+    '''
+    if max_format not in MAX_FORMATS:
+        raise ValueError(f'max_format must be one of {list(MAX_FORMATS)}')
+    if isinstance(dirs, (str, Path)):
+        root_path = Path(dirs)
+        dirs = find_acquisitions(root_path)
+    else:
+        dirs = [Path(dir_path) for dir_path in dirs]
+        root_path = dirs[0].parent if dirs else Path.cwd()
+    manifest = Manifest(manifest_path or root_path / MANIFEST_NAME)
+
+    queue = plan_jobs(dirs, manifest, outputs=outputs, verify=verify)
+    print(f'{len(queue)} job(s) to run across {len(dirs)} acquisition(s)')
+    if not queue:
+        return manifest
+
+    if client is not None:
+        executor = client.get_executor()
+        max_jobs = max_jobs or len(client.scheduler_info()['workers'])
+    else:
+        max_jobs = max_jobs or os.cpu_count()
+        executor = ProcessPoolExecutor(max_workers=max_jobs)
+    # every job reads ahead on its own, so the jobs running at once split the cap between them
+    job_memory_mb = memory_mb / max_jobs if memory_mb is not None else None
+
+    running = {}
+    disk_counts = {}
+    num_done = 0
+    try:
+        while queue or running:
+            # start every queued job whose disk still has room
+            for job in list(queue):
+                if len(running) >= max_jobs:
+                    break
+                if disk_counts.get(job['disk'], 0) >= max_jobs_per_disk:
+                    continue
+                queue.remove(job)
+                disk_counts[job['disk']] = disk_counts.get(job['disk'], 0) + 1
+                future = executor.submit(run_job, job['dir_path'], job['region_name'], job['ch_name'], job['outputs'],
+                                         step=step, num_workers=workers_per_job, chunks=chunks, codec=codec, fusion=fusion,
+                                         max_format=max_format, memory_mb=job_memory_mb)
+                running[future] = job
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                disk_counts[job['disk']] -= 1
+                unit = (job['dir_path'], job['region_name'], job['ch_name'])
+                try:
+                    written = future.result()
+                except BaseException as e:
+                    error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+                    print(f'FAILED {" ".join(unit)}: {error}')
+                    for output in job['outputs']:
+                        manifest.record_failure(*unit, output, error)
+                else:
+                    for output in job['outputs']:
+                        manifest.record_done(*unit, output, written.get(output, []), with_checksum=with_checksum,
+                                             shared=written.get('hyperstack', []))
+                    num_done += 1
+                    print(f'finished {" ".join(unit)} ({num_done} done, {len(queue) + len(running)} left)')
+                manifest.save()
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    failures = manifest.failures()
+    if failures:
+        print('*****'*9)
+        print(f'{len(failures)} unit(s) failed, run the batch again to retry them:')
+        for key, error in failures.items():
+            print(f'  {key}: {error}')
+        print('*****'*9)
+    return manifest
@@ -0,0 +1,210 @@
+'''
+Reproducible benchmark suite. Generates synthetic acquisitions of several sizes and times each
+conversion path at several worker counts, saving the results as JSON so regressions show up when
+a run is compared with an earlier one.
+
+    python -m interact.benchmark results.json --sizes small medium --workers 1 2 4 --baseline old.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import numpy as np
+import dask
+import dask.array as da
+from pathlib import Path
+from datetime import datetime
+from tifffile import imwrite as tiff_write
+from interact.catalog import Catalog
+from interact.readers import open_stack, dask_stacks
+from interact.synthetic import make_acquisition
+from interact.pipeline import run_pipeline, load_stacks
+
+# (timepoints, planes, height, width) of each dataset size, two channels with two illumination sides
+SIZES = {'tiny': (2, 16, 128, 128),
+         'small': (4, 32, 512, 512),
+         'medium': (6, 100, 1024, 1024),
+         'large': (8, 200, 2048, 2048)}
+
+
+def channel_stacks(dir_path, ch_name):
+    '''
+    The I0 and I1 stack paths of every timepoint of a channel, in time order.
+    '''
+    catalog = Catalog.from_dir(dir_path)
+    pairs = catalog.illumination_pairs(C=ch_name)
+    return [[Path(dir_path) / catalog.name(index) for index in pairs[key]] for key in sorted(pairs)]
+
+
+def numpy_path(dir_path, out_dir, num_workers=1, step=8):
+    '''
+    The plain NumPy workflow of Napari scripts/process.py and downsample1.py: read both sides,
+    fuse, max-project, stride-downsample and write, one timepoint after another.
+    '''
+    for ch_name in Catalog.from_dir(dir_path).tokens('C'):
+        for tp, (i0_path, i1_path) in enumerate(channel_stacks(dir_path, ch_name)):
+            fused = np.maximum(np.asarray(open_stack(i0_path)), np.asarray(open_stack(i1_path)))
+            tiff_write(out_dir / f'{ch_name}_{tp}_max.tif', fused.max(axis=0))
+            tiff_write(out_dir / f'{ch_name}_{tp}_vol.tif', fused[::2, ::step, ::step])
+
+
+def numpy_pipeline_path(dir_path, out_dir, num_workers=1, step=8):
+    '''
+    The same NumPy workflow run through pipeline.run_pipeline: stacks are read ahead on one
+    thread, fused and projected on num_workers threads and written behind on two more.
+    '''
+    items = [(ch_name, tp, stack_paths) for ch_name in Catalog.from_dir(dir_path).tokens('C')
+             for tp, stack_paths in enumerate(channel_stacks(dir_path, ch_name))]
+
+    def compute(item, stacks):
+        fused = np.maximum(stacks[0], stacks[1])
+        return fused.max(axis=0), fused[::2, ::step, ::step].copy()
+
+    def write(item, result):
+        ch_name, tp, _ = item
+        tiff_write(out_dir / f'{ch_name}_{tp}_max.tif', result[0])
+        tiff_write(out_dir / f'{ch_name}_{tp}_vol.tif', result[1])
+
+    run_pipeline(items, lambda item: load_stacks(item[2]), compute, write, num_workers=num_workers, num_writers=2)
+
+
+def dask_two_pass_path(dir_path, out_dir, num_workers=1, step=8):
+    '''
+    The dask workflow save_regions used before the single-pass engine: a strided to_zarr of the
+    fused volume followed by a separate per-timepoint max projection, reading every stack twice.
+    Kept as the baseline the engine is measured against.
+    '''
+    for ch_name in Catalog.from_dir(dir_path).tokens('C'):
+        stacks = channel_stacks(dir_path, ch_name)
+        left = dask_stacks([pair[0] for pair in stacks])
+        right = dask_stacks([pair[1] for pair in stacks])
+        fused = da.maximum(left, right)
+        with dask.config.set(num_workers=num_workers):
+            da.to_zarr(fused[:, :, ::step, ::step], str(out_dir / f'{ch_name}_volume.zarr'), overwrite=True)
+            for tp in range(fused.shape[0]):
+                tiff_write(out_dir / f'{ch_name}_{tp}_Max.tiff', fused[tp].max(axis=0).compute())
+
+
+def engine_path(dir_path, out_dir, num_workers=1, step=8):
+    '''
+    Kkpo.save_regions with the single-pass engine, writing max projections and the pyramid.
+    '''
+    from interact.kkpo import Kkpo
+    kkpo = Kkpo(dir_path)
+    for region_name in kkpo.region_names:
+        region_info = kkpo.get_region_info(region_name)
+        for ch_name in region_info[2]:
+            kkpo.save_channel(region_name, ch_name, save_vol=True, save_max=True, step=step,
+                              num_workers=num_workers, region_info=region_info)
+
+
+ENGINES = {'numpy': numpy_path,
+           'numpy-pipeline': numpy_pipeline_path,
+           'dask-two-pass': dask_two_pass_path,
+           'engine': engine_path}
+SERIAL_ENGINES = {'numpy'} # ignore the worker count, so they are only run once per size
+
+
+def dataset_bytes(dir_path):
+    return sum(os.path.getsize(Path(dir_path) / name) for name in Catalog.from_dir(dir_path).names)
+
+
+def clear_outputs(dir_path, out_dir):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    Path.mkdir(out_dir, parents=True, exist_ok=True)
+    for processed in Path(dir_path).glob('*_processed'):
+        shutil.rmtree(processed)
+
+
+def run_suite(work_dir, sizes=('tiny', 'small'), worker_counts=(1, 2, 4), engines=tuple(ENGINES), repeats=1, keep_data=True):
+    '''
+    Times every engine on every dataset size at every worker count.
+    Parameters: work_dir (str/Path) - scratch folder for the synthetic datasets and outputs
+                sizes (tuple) - keys of SIZES
+                worker_counts (tuple) - numbers of parallel workers to try
+                engines (tuple) - keys of ENGINES
+                repeats (int) - runs per combination, the fastest is kept
+                keep_data (bool) - keep the generated datasets for the next run
+    Returns: dict with the environment and a list of results
+    '''
+    work_dir = Path(work_dir)
+    results = []
+    for size in sizes:
+        num_timepoints, num_planes, height, width = SIZES[size]
+        dir_path = work_dir / f'synthetic_{size}'
+        if not dir_path.exists() or not len(Catalog.from_dir(dir_path)):
+            print(f'Generating {size} dataset...')
+            make_acquisition(dir_path, num_timepoints=num_timepoints, num_planes=num_planes, height=height, width=width)
+        num_bytes = dataset_bytes(dir_path)
+        for engine in engines:
+            for num_workers in (worker_counts[:1] if engine in SERIAL_ENGINES else worker_counts):
+                times = []
+                for _ in range(repeats):
+                    out_dir = work_dir / 'outputs'
+                    clear_outputs(dir_path, out_dir)
+                    start = time.perf_counter()
+                    ENGINES[engine](dir_path, out_dir, num_workers=num_workers)
+                    times.append(time.perf_counter() - start)
+                seconds = min(times)
+                results.append({'engine': engine, 'size': size, 'workers': num_workers, 'seconds': seconds,
+                                'input_MB': num_bytes / 1e6, 'MBps': num_bytes / 1e6 / seconds})
+                print(f'{engine:>14} {size:>7} {num_workers:>3} workers {seconds:>8.2f} s {num_bytes / 1e6 / seconds:>8.1f} MB/s')
+        clear_outputs(dir_path, work_dir / 'outputs')
+        if not keep_data:
+            shutil.rmtree(dir_path)
+
+    return {'date': datetime.now().isoformat(timespec='seconds'),
+            'machine': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'dask': dask.__version__,
+            'results': results}
+
+
+def compare(current, baseline, tolerance=0.2):
+    '''
+    Prints the combinations that got slower than the baseline by more than tolerance.
+    Parameters: current, baseline (dict) - outputs of run_suite
+                tolerance (float) - allowed fractional slowdown
+    Returns: list of regressions
+    '''
+    previous = {(r['engine'], r['size'], r['workers']): r['seconds'] for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        key = (result['engine'], result['size'], result['workers'])
+        if key in previous and result['seconds'] > previous[key] * (1 + tolerance):
+            regressions.append({'key': key, 'seconds': result['seconds'], 'baseline_seconds': previous[key]})
+            print(f'REGRESSION {key}: {result["seconds"]:.2f} s vs {previous[key]:.2f} s')
+    if not regressions:
+        print('No regressions against the baseline')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Kkpo conversion paths on synthetic data.')
+    parser.add_argument('output', help='JSON file to write the results to')
+    parser.add_argument('--work-dir', default='kkpo_benchmark', help='scratch folder for the datasets')
+    parser.add_argument('--sizes', nargs='+', default=['tiny', 'small'], choices=list(SIZES))
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--baseline', help='earlier results JSON to check for regressions')
+    args = parser.parse_args(argv)
+
+    current = run_suite(args.work_dir, sizes=args.sizes, worker_counts=args.workers, engines=args.engines, repeats=args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(current, baseline):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
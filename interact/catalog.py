@@ -0,0 +1,201 @@
+'''
+Indexed catalog of Flamingo file names. Every name is parsed exactly once into an integer array
+of its S/t/V/R/X/Y/C/I/D/P fields, so lookups by field are O(1) and group-by queries are
+vectorized instead of rescanning the file list with substring matching.
+'''
+import os
+import re
+import numpy as np
+
+# field letter and the number of digits Flamingo writes for it
+FIELDS = ('S', 't', 'V', 'R', 'X', 'Y', 'C', 'I', 'D', 'P')
+FIELD_WIDTHS = {'S': 3, 't': 6, 'V': 3, 'R': 4, 'X': 3, 'Y': 3, 'C': 2, 'I': 1, 'D': 1, 'P': 5}
+STACK_SUFFIXES = ('.tif', '.raw', '.zarr') # .zarr stacks are compressed archives, see archive.py
+NAME_PATTERN = re.compile(r'S(\d+)_t(\d+)_V(\d+)_R(\d+)_X(\d+)_Y(\d+)_C(\d+)_I(\d+)_D(\d+)(?:_P(\d+))?')
+
+
+def parse_name(file_name):
+    '''
+    Parses the fields out of a Flamingo file name.
+    Parameters: file_name (str) - e.g. S000_t000000_V000_R0000_X000_Y000_C00_I0_D0_P00100,
+                                  without the file suffix
+    Returns: tuple of ints in FIELDS order (P is -1 when the name has no plane count), or None
+             if the name does not follow the Flamingo convention
+    '''
+    match = NAME_PATTERN.fullmatch(file_name)
+    if match is None:
+        return None
+    return tuple(int(value) if value is not None else -1 for value in match.groups())
+
+
+def token(field, value):
+    '''
+    Formats a field value back into the token used in file names.
+    Parameters: field (str) - one of FIELDS
+                value (int) - the field value
+    Returns: str, e.g. token('R', 2) -> 'R0002'
+    '''
+    return f'{field}{int(value):0{FIELD_WIDTHS[field]}d}'
+
+
+def field_value(field, value):
+    '''
+    Accepts either an int or a file name token ('R0002', 't000011') and returns the int value.
+    '''
+    if isinstance(value, str):
+        return int(value[len(field):])
+    return int(value)
+
+
+class Catalog:
+
+    def __init__(self, file_names, suffix=STACK_SUFFIXES):
+        '''
+        Builds the catalog from a list of file names. Names that do not follow the Flamingo
+        convention or do not end with suffix (hidden files, max projections, etc.) are ignored.
+        Parameters: file_names (list) - file names, not paths
+                    suffix (str or tuple) - accepted file name endings, by default the .tif, .raw and
+                                            archived .zarr stacks; '_Settings.txt' catalogs the settings files
+        '''
+        suffixes = (suffix,) if isinstance(suffix, str) else tuple(suffix)
+        names = []
+        rows = []
+        for file_name in sorted(file_names):
+            if file_name.startswith('.'):
+                continue
+            name_suffix = next((ending for ending in suffixes if file_name.endswith(ending)), None)
+            if name_suffix is None:
+                continue
+            fields = parse_name(file_name[:-len(name_suffix)])
+            if fields is None:
+                continue
+            names.append(file_name)
+            rows.append(fields)
+        self._build(names, rows)
+
+    def _build(self, names, rows):
+        self.names = names
+        self.fields = np.array(rows, dtype=np.int64).reshape(-1, len(FIELDS))
+        # the plane count is a property of the stack rather than part of its identity, so it is left out of the key
+        self.lookup = {tuple(row[:-1]): index for index, row in enumerate(rows)}
+        self.unique = {field: np.unique(self.fields[:, i]) for i, field in enumerate(FIELDS)}
+
+    @classmethod
+    def from_dir(cls, dir_path, suffix=STACK_SUFFIXES):
+        '''
+        Lists a directory once and builds the catalog from it.
+        '''
+        return cls(os.listdir(dir_path), suffix=suffix)
+
+    @classmethod
+    def from_fields(cls, names, rows):
+        '''
+        Rebuilds a catalog from names that have already been parsed, e.g. by a previous run.
+        Parameters: names (list) - sorted file names
+                    rows (list) - the parse_name fields of every name
+        '''
+        catalog = cls.__new__(cls)
+        catalog._build(list(names), [tuple(row) for row in rows])
+        return catalog
+
+    def __len__(self):
+        return len(self.names)
+
+    def column(self, field):
+        '''
+        Returns the values of one field for every entry as an int array.
+        '''
+        return self.fields[:, FIELDS.index(field)]
+
+    def mask(self, **where):
+        '''
+        Boolean mask of the entries matching every given field, e.g. mask(R='R0000', C=1).
+        '''
+        keep = np.ones(len(self), dtype=bool)
+        for field, value in where.items():
+            keep &= self.column(field) == field_value(field, value)
+        return keep
+
+    def select(self, **where):
+        '''
+        Indices of the entries matching every given field.
+        '''
+        return np.flatnonzero(self.mask(**where))
+
+    def find(self, **fields):
+        '''
+        O(1) lookup of the entry with exactly these fields. Fields that are not given are taken to
+        be the only value present in the catalog (S/V/X/Y/D of a single tile acquisition).
+        Parameters: fields - field values as ints or tokens
+        Returns: index of the entry, or None when there is no such stack
+        '''
+        key = []
+        for field in FIELDS[:-1]:
+            if field in fields:
+                key.append(field_value(field, fields[field]))
+                continue
+            values = self.unique[field]
+            if len(values) != 1:
+                return self._find_partial(**fields)
+            key.append(values[0])
+        return self.lookup.get(tuple(key))
+
+    def _find_partial(self, **fields):
+        indices = self.select(**fields)
+        return int(indices[0]) if len(indices) else None
+
+    def values(self, field, **where):
+        '''
+        Sorted unique values of a field, optionally restricted to matching entries.
+        '''
+        if not where:
+            return self.unique[field]
+        return np.unique(self.column(field)[self.mask(**where)])
+
+    def tokens(self, field, **where):
+        '''
+        Sorted unique tokens of a field, e.g. tokens('C', R='R0000') -> ['C00', 'C01'].
+        '''
+        return np.array([token(field, value) for value in self.values(field, **where)])
+
+    def group_by(self, fields, **where):
+        '''
+        Groups the matching entries by one or more fields in a single vectorized pass.
+        Parameters: fields (tuple) - fields to group by, e.g. ('t', 'I')
+                    where - field filters applied first
+        Returns: dict mapping tuples of field values to arrays of entry indices
+        '''
+        indices = self.select(**where)
+        if not len(indices):
+            return {}
+        keys = self.fields[np.ix_(indices, [FIELDS.index(field) for field in fields])]
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        splits = np.split(indices[order], np.cumsum(np.bincount(inverse.ravel()))[:-1])
+        return {tuple(int(v) for v in key): split for key, split in zip(unique_keys, splits)}
+
+    def illumination_pairs(self, **where):
+        '''
+        Pairs up the illumination and detection sides of every stack, e.g. the I0/I1 stacks of each
+        timepoint and channel, or all four I0/I1 x D0/D1 stacks with two cameras. Only complete
+        groups (every side present) are returned.
+        Parameters: where - field filters, e.g. R='R0000', C='C01'
+        Returns: dict mapping (t, C) to a list of entry indices ordered by D, then I
+        '''
+        num_sides = len(self.values('I', **where)) * len(self.values('D', **where))
+        groups = self.group_by(('t', 'C'), **where)
+        pairs = {}
+        for key, indices in groups.items():
+            indices = indices[np.lexsort((self.column('I')[indices], self.column('D')[indices]))]
+            if len(indices) == num_sides:
+                pairs[key] = [int(index) for index in indices]
+        return pairs
+
+    def name(self, index):
+        return self.names[index]
+
+    def entry(self, index):
+        '''
+        The fields of one entry as a dict of ints.
+        '''
+        return dict(zip(FIELDS, (int(value) for value in self.fields[index])))
@@ -0,0 +1,136 @@
+'''
+Automatic sample cropping. Most of a Flamingo field of view is empty background around the
+sample, so before a region is converted its bounding box is found from cheap, strided max
+projections of a few timepoints of every channel. The box is the union over time, so it stays
+put for the whole timelapse, padded by a margin and snapped to the pyramid's coarsest blocks. The
+engine then only streams the planes and rows inside it, and the volumes and projections are
+written at the size of the box.
+'''
+import numpy as np
+from interact.readers import open_stack
+
+CROP_MARGIN = 32 # pixels of background kept around the sample at full resolution
+CROP_SAMPLES = 8 # timepoints sampled to find the box, spread over the timelapse
+SAMPLE_STEP = (4, 8, 8) # (Z, Y, X) stride of the projections the box is found from
+THRESHOLD = 0.1 # foreground is brighter than this fraction of the way from background to the brightest pixels
+MIN_PIXELS = 2 # rows/columns/planes with fewer foreground pixels are treated as noise
+
+
+def sample_projection(stack_path, step=SAMPLE_STEP):
+    '''
+    A strided look at a stack: every step[0]th plane, every step[1]th row and every step[2]th
+    column. For memory-mapped stacks only those rows are read from disk.
+    Returns: (Z, Y, X) ndarray
+    '''
+    stack = open_stack(stack_path)
+    return np.array(stack[::step[0], ::step[1], ::step[2]])
+
+
+def sample_timepoints(num_timepoints, num_samples=CROP_SAMPLES):
+    '''
+    Indices of up to num_samples timepoints spread evenly from the first to the last.
+    '''
+    return sorted({int(round(t)) for t in np.linspace(0, num_timepoints - 1, min(num_samples, num_timepoints))})
+
+
+def foreground_mask(samples, threshold=THRESHOLD):
+    '''
+    Thresholds a strided stack halfway between background and the sample. The background is the
+    median, since most of the field is empty, and the sample level is the 99.9th percentile.
+    Returns: boolean (Z, Y, X) ndarray, None when nothing stands out of the background
+    '''
+    background = float(np.median(samples))
+    bright = float(np.percentile(samples, 99.9))
+    if bright <= background:
+        return None
+    return samples > background + threshold * (bright - background)
+
+
+def mask_box(mask, step=SAMPLE_STEP, min_pixels=MIN_PIXELS):
+    '''
+    The bounding box of a foreground mask in full resolution pixels.
+    Returns: ((z0, z1), (y0, y1), (x0, x1)), None for an empty mask
+    '''
+    box = []
+    for axis, stride in enumerate(step):
+        other = tuple(a for a in range(3) if a != axis)
+        hits = np.flatnonzero(mask.sum(axis=other) >= min_pixels)
+        if not len(hits):
+            return None
+        box.append((int(hits[0]) * stride, (int(hits[-1]) + 1) * stride))
+    return tuple(box)
+
+
+def union_box(boxes):
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    return tuple((min(box[axis][0] for box in boxes), max(box[axis][1] for box in boxes)) for axis in range(3))
+
+
+def align_box(box, stack_shape, margin=CROP_MARGIN, alignment=(1, 1, 1), z_margin=SAMPLE_STEP[0]):
+    '''
+    Pads a box by margin in X and Y and by z_margin planes in Z, snaps it
+    outwards to multiples of alignment and clips it to the stack. Snapping to the pyramid's
+    downsampling factors keeps the edges of the box on whole blocks of every level; the box does
+    not have to line up with the volume's chunks.
+    Parameters: box (tuple) - ((z0, z1), (y0, y1), (x0, x1)) in full resolution pixels
+                stack_shape (tuple) - (Z, Y, X) of the stacks
+                margin (int) - pixels added on every side in Y and X
+                z_margin (int) - planes added on either side in Z, by default the Z sampling stride
+                alignment (tuple) - (Z, Y, X) multiples the box starts and stops on
+    Returns: ((z0, z1), (y0, y1), (x0, x1))
+    '''
+    margins = (z_margin, margin, margin)
+    aligned = []
+    for (start, stop), pad, size, multiple in zip(box, margins, stack_shape, alignment):
+        start = max(start - pad, 0) // multiple * multiple
+        stop = min(-(-(stop + pad) // multiple) * multiple, size)
+        aligned.append((start, stop))
+    return tuple(aligned)
+
+
+def find_crop(stack_groups, stack_shape, margin=CROP_MARGIN, alignment=(1, 1, 1), step=SAMPLE_STEP, threshold=THRESHOLD):
+    '''
+    Finds the bounding box of the sample over a set of stacks.
+    Parameters: stack_groups (list) - the stack paths of every sampled timepoint and channel, a
+                                      list of the aligned illumination/detection sides each
+                stack_shape (tuple) - (Z, Y, X) of the stacks
+                margin, alignment - see align_box
+                step (tuple) - (Z, Y, X) stride of the sampled projections
+                threshold (float) - see foreground_mask
+    Returns: ((z0, z1), (y0, y1), (x0, x1)) in full resolution pixels, None when no sample was found
+    '''
+    boxes = []
+    for stack_paths in stack_groups:
+        samples = sample_projection(stack_paths[0], step)
+        for stack_path in stack_paths[1:]:
+            np.maximum(samples, sample_projection(stack_path, step), out=samples)
+        mask = foreground_mask(samples, threshold)
+        boxes.append(mask_box(mask, step) if mask is not None else None)
+    box = union_box(boxes)
+    if box is None:
+        return None
+    return align_box(box, stack_shape, margin, alignment, z_margin=step[0])
+
+
+def check_crop(crop, stack_shape):
+    '''
+    Validates a crop given by hand and clips it to the stack.
+    Parameters: crop (tuple) - ((z0, z1), (y0, y1), (x0, x1)), a None pair keeps that axis whole
+    Returns: ((z0, z1), (y0, y1), (x0, x1))
+    '''
+    if len(crop) != 3:
+        raise ValueError(f'A crop is ((z0, z1), (y0, y1), (x0, x1)), got {crop}')
+    clipped = []
+    for pair, size in zip(crop, stack_shape):
+        start, stop = pair if pair is not None else (0, size)
+        start, stop = max(int(start), 0), min(int(stop), size)
+        if stop <= start:
+            raise ValueError(f'Crop {crop} is empty for stacks of shape {tuple(stack_shape)}')
+        clipped.append((start, stop))
+    return tuple(clipped)
+
+
+def crop_shape(crop):
+    return tuple(stop - start for start, stop in crop)
@@ -0,0 +1,302 @@
+'''
+Drift correction of timelapse outputs. The shift of every timepoint is estimated by FFT phase
+correlation on small images, binned max projections or a coarse level of a volume pyramid, and
+refined to a fraction of a pixel by evaluating the correlation around its peak with a
+matrix-multiply DFT (Guizar-Sicairos et al. 2008) instead of a large zero-padded FFT. X and Y come
+from the XY projection and Z from the XZ and YZ projections, every axis averaged over the two
+projections that see it.
+
+The shifts are only recorded, in {region}_Drift.json and in the attributes of the volumes, and are
+applied when the outputs are viewed or exported, so a registered copy of the data is never written.
+'''
+import os
+import json
+import numpy as np
+import zarr
+import dask.array as da
+from interact.pyramid import block_mean_xy, open_pyramid
+
+DRIFT_UPSAMPLE = 20 # the correlation peak is refined to 1/20 of a pixel of the images it is found in
+DRIFT_BIN = 4 # XY binning of max projections before they are correlated
+DRIFT_REFERENCES = ('previous', 'first')
+LOW_PEAK = 0.2 # correlation peaks below this are reported as unreliable
+PHASE_FLOOR = 0.01 # fraction of the strongest frequency added to every magnitude before whitening
+TAPER = 8 # 1/TAPER of the image on every side fades to zero before correlating
+PROJECTION_AXES = {'xy': (1, 2), 'xz': (0, 2), 'yz': (0, 1)} # the (Z, Y, X) axes every projection keeps
+
+
+def drift_name(region_name):
+    return f'{region_name}_Drift.json'
+
+
+def projections(volume):
+    '''
+    The XY, XZ and YZ max projections of a (Z, Y, X) volume, oriented like the engine's ortho outputs.
+    '''
+    volume = np.asarray(volume)
+    return {'xy': volume.max(axis=0), 'xz': volume.max(axis=1), 'yz': volume.max(axis=2)}
+
+
+def binned(image, binning=DRIFT_BIN):
+    return block_mean_xy(np.asarray(image, dtype=np.float32), binning)
+
+
+def prepare(image):
+    '''
+    Readies an image for correlation: the background (median) is subtracted and the outer edges
+    fade to zero with a cosine ramp, so the borders of the field do not line up with themselves.
+    The middle of the field is left at full weight, where a window over all of it would pull the
+    estimate towards the centre.
+    '''
+    image = np.asarray(image, dtype=np.float32)
+    image = np.maximum(image - np.median(image), 0)
+    for axis, size in enumerate(image.shape):
+        width = size // TAPER
+        if not width:
+            continue
+        ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(width) + 0.5) / width)
+        window = np.ones(size, np.float32)
+        window[:width] = ramp
+        window[-width:] = ramp[::-1]
+        shape = [1] * image.ndim
+        shape[axis] = size
+        image = image * window.reshape(shape)
+    return image
+
+
+def upsampled_dft(data, region_size, upsample, offsets):
+    '''
+    The inverse DFT of data on a region_size grid of 1/upsample pixel steps starting at offsets,
+    one small matrix product per axis.
+    '''
+    for size, offset in list(zip(data.shape, offsets))[::-1]:
+        kernel = np.exp(-2j * np.pi * (np.arange(region_size) - offset)[:, np.newaxis] * np.fft.fftfreq(size, upsample))
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+
+def phase_correlation(reference, moving, upsample=DRIFT_UPSAMPLE):
+    '''
+    Estimates the translation between two images.
+    Parameters: reference, moving (ndarray) - images of the same shape, see prepare
+                upsample (int) - the peak is refined to 1/upsample of a pixel, 1 for whole pixels
+    Returns: shift (float ndarray, one value per axis) that moves moving onto reference, see
+             shift_image; peak (float) - height of the normalized correlation peak, near 1 for a
+             clean match and near 0 when nothing lines up
+    '''
+    product = np.fft.fftn(reference) * np.conj(np.fft.fftn(moving))
+    # whiten the spectrum, keeping mostly the phase; the floor stops the frequencies the sample
+    # has no power at (pure noise and rounding) from dominating the peak
+    magnitude = np.abs(product)
+    product /= magnitude + PHASE_FLOOR * magnitude.max() + 1e-12
+    perfect = max(np.abs(product).mean(), 1e-12) # the peak height of two identical images
+    correlation = np.fft.ifftn(product)
+    peak = np.unravel_index(np.argmax(np.abs(correlation)), correlation.shape)
+    height = np.abs(correlation[peak]) / perfect
+    shape = np.array(correlation.shape)
+    shift = np.array(peak, dtype=np.float64)
+    shift[shift > shape // 2] -= shape[shift > shape // 2]
+    if upsample > 1:
+        shift = np.round(shift * upsample) / upsample
+        region_size = int(np.ceil(upsample * 1.5))
+        centre = np.fix(region_size / 2)
+        fine_correlation = np.conj(upsampled_dft(np.conj(product), region_size, upsample, centre - shift * upsample))
+        fine_peak = np.unravel_index(np.argmax(np.abs(fine_correlation)), fine_correlation.shape)
+        shift += (np.array(fine_peak) - centre) / upsample
+        height = np.abs(fine_correlation[fine_peak]) / product.size / perfect
+    return shift, float(height)
+
+
+def estimate_drift(frames, scale=(1, 1, 1), reference='previous', upsample=DRIFT_UPSAMPLE):
+    '''
+    Estimates the shift of every timepoint of a timelapse.
+    Parameters: frames (iterable) - per timepoint, a dict of projections {'xy': (Y, X), 'xz': (Z, X),
+                                    'yz': (Z, Y)}, consumed one at a time; without 'xz' and 'yz'
+                                    Z is not corrected
+                scale (tuple) - (Z, Y, X) size of a frame pixel in full resolution pixels, e.g. the
+                                downsampling factor of the pyramid level
+                reference (str) - 'previous' registers every timepoint to the one before and adds
+                                  the shifts up, which follows a sample that changes over the
+                                  timelapse; 'first' registers every timepoint to the first, which
+                                  does not accumulate error
+                upsample (int) - see phase_correlation
+    Returns: (T, 3) ndarray of (z, y, x) shifts in full resolution pixels that register every
+             timepoint onto the first (which is zero), (T,) ndarray of the weakest correlation peak
+             of every timepoint
+    '''
+    if reference not in DRIFT_REFERENCES:
+        raise ValueError(f'reference must be one of {list(DRIFT_REFERENCES)}, got {reference}')
+    scale = np.asarray(scale, dtype=np.float64)
+    shifts, peaks = [], []
+    first = previous = None
+    total = np.zeros(3)
+    for frame in frames:
+        prepared = {name: prepare(image) for name, image in frame.items() if image is not None}
+        if not any(image.any() for image in prepared.values()):
+            # a blank frame, e.g. a timepoint padded into a hyperstack, keeps the last shift
+            shifts.append(total.copy())
+            peaks.append(0.0)
+            continue
+        if first is None:
+            first = previous = prepared
+            shifts.append(total.copy())
+            peaks.append(1.0)
+            continue
+        target = previous if reference == 'previous' else first
+        sums, counts = np.zeros(3), np.zeros(3)
+        weakest = None
+        for name, image in prepared.items():
+            if name not in target or target[name].shape != image.shape:
+                continue
+            shift, peak = phase_correlation(target[name], image, upsample)
+            for axis, value in zip(PROJECTION_AXES[name], shift):
+                sums[axis] += value
+                counts[axis] += 1
+            weakest = peak if weakest is None else min(weakest, peak)
+        step = np.divide(sums, counts, out=np.zeros(3), where=counts > 0) * scale
+        total = total + step if reference == 'previous' else step
+        shifts.append(total.copy())
+        peaks.append(weakest if weakest is not None else 0.0)
+        previous = prepared
+    return np.array(shifts).reshape(-1, 3), np.array(peaks)
+
+
+def volume_timepoints(root, timepoint_names):
+    '''
+    The timepoint names of a (T, Z, Y, X) pyramid, as save_channel records them, or the first T of
+    timepoint_names for volumes that do not record them.
+    '''
+    return list(root.attrs.get('timepoints', list(timepoint_names)[:root['0'].shape[0]]))
+
+
+def volume_frames(vol_path, timepoint_names, level=None, binning=DRIFT_BIN):
+    '''
+    The orthogonal projections of every timepoint of a (T, Z, Y, X) pyramid at one level, read a
+    timepoint at a time.
+    Parameters: vol_path (Path) - pyramid written by save_regions
+                timepoint_names (list) - the region's timepoints, see volume_timepoints
+                level (int) - pyramid level, None for the coarsest level binned no more than binning
+                              in XY; the coarsest levels of a deep pyramid are too small to find a
+                              shift on to a fraction of a full resolution pixel
+                binning (int) - the coarsest XY factor picked when level is None
+    Returns: generator of frames for estimate_drift, (z, y, x) downsampling factor of the level,
+             list of timepoint names
+    '''
+    root = zarr.open_group(str(vol_path), mode='r')
+    factors = root.attrs['downsample_factors']
+    if level is None:
+        level = max([index for index, factor in enumerate(factors) if factor[-1] <= binning], default=0)
+    level = range(len(factors))[level]
+    array = root[str(level)]
+    if array.ndim != 4:
+        raise ValueError(f'{vol_path} holds a single volume, there is no drift to correct')
+    return (projections(array[t]) for t in range(array.shape[0])), tuple(factors[level]), volume_timepoints(root, timepoint_names)
+
+
+def translate(array, axis, offset):
+    '''
+    Moves the content of an array by a whole number of pixels along one axis, filling with zeros.
+    Works on numpy and (lazily) on dask arrays.
+    '''
+    size = array.shape[axis]
+    offset = int(np.clip(offset, -size, size))
+    if not offset:
+        return array
+    pad = [(0, 0)] * array.ndim
+    pad[axis] = (offset, 0) if offset > 0 else (0, -offset)
+    index = [slice(None)] * array.ndim
+    index[axis] = slice(0, size) if offset > 0 else slice(-offset, size - offset)
+    padded = da.pad(array, pad) if isinstance(array, da.Array) else np.pad(array, pad)
+    return padded[tuple(index)]
+
+
+def shift_image(image, shift):
+    '''
+    Translates an image by a sub-pixel shift with linear interpolation; what moves in from outside
+    the field is black.
+    Parameters: image (ndarray) - any number of dimensions
+                shift (sequence) - per axis, positive moves the content towards higher indices
+    Returns: ndarray of the image's shape and type
+    '''
+    shifted = np.asarray(image, dtype=np.float32)
+    for axis, value in enumerate(shift):
+        whole = int(np.floor(value))
+        fraction = float(value - whole)
+        moved = translate(shifted, axis, whole)
+        if fraction > 1e-3:
+            moved = (1 - fraction) * moved + fraction * translate(shifted, axis, whole + 1)
+        shifted = moved
+    if np.issubdtype(image.dtype, np.integer):
+        shifted = np.rint(shifted)
+    return shifted.astype(image.dtype)
+
+
+def timepoint_shift(record, tp_name):
+    '''
+    The (z, y, x) shift of a timepoint in a drift record, zero for timepoints it does not cover.
+    '''
+    if record is None or tp_name not in record['timepoints']:
+        return np.zeros(3)
+    return np.array(record['shifts'][record['timepoints'].index(tp_name)])
+
+
+def write_drift(path, record):
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def read_drift(path):
+    '''
+    Returns: the drift record written by Kkpo.correct_drift, None when there is none
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def annotate_volume(vol_path, record, timepoint_names):
+    '''
+    Stores the shifts of a volume's timepoints in its attributes ('drift'), in full resolution
+    pixels and in um. OME-Zarr 0.4 only has one translation per array, not one per timepoint, so
+    the shifts live next to the multiscales metadata and are applied by open_registered.
+    Parameters: vol_path (Path) - (T, Z, Y, X) pyramid
+                record (dict) - drift record, see Kkpo.correct_drift
+                timepoint_names (list) - the region's timepoints, see volume_timepoints
+    '''
+    root = zarr.open_group(str(vol_path), mode='r+')
+    if root['0'].ndim != 4:
+        return
+    shifts = [timepoint_shift(record, tp_name) for tp_name in volume_timepoints(root, timepoint_names)]
+    voxel_size = np.array(record['voxel_size'])
+    root.attrs['drift'] = {'reference': record['reference'], 'channel': record['channel'],
+                           'shifts': [[round(float(value), 3) for value in shift] for shift in shifts],
+                           'shifts_um': [[round(float(value), 4) for value in shift * voxel_size] for shift in shifts]}
+
+
+def open_registered(vol_path):
+    '''
+    Opens a pyramid like pyramid.open_pyramid, with the drift recorded in its attributes applied
+    lazily: every timepoint of every level is moved by the nearest whole number of that level's
+    pixels, so nothing is resampled and a timepoint is only read when it is looked at.
+    Returns: list of dask arrays (finest first), list of per level scales
+    '''
+    levels, scales = open_pyramid(vol_path)
+    root = zarr.open_group(str(vol_path), mode='r')
+    drift = root.attrs.get('drift')
+    if drift is None or levels[0].ndim != 4:
+        return levels, scales
+    shifts = np.array(drift['shifts'])
+    registered = []
+    for level, factor in zip(levels, root.attrs['downsample_factors']):
+        timepoints = []
+        for t in range(level.shape[0]):
+            volume = level[t]
+            if t < len(shifts):
+                for axis, offset in enumerate(np.rint(shifts[t] / np.array(factor)).astype(int)):
+                    volume = translate(volume, axis, offset)
+            timepoints.append(volume)
+        registered.append(da.stack(timepoints))
+    return registered, scales
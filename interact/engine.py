@@ -0,0 +1,177 @@
+'''
+Single-pass conversion engine. Each Flamingo stack is streamed plane by plane exactly once and
+the illumination fusion, max projection and multiscale volume are all produced from that read.
+'''
+import os
+import time
+import numpy as np
+import dask
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tifffile import imwrite as tiff_write
+from interact.pyramid import PyramidWriter
+from interact.hyperstack import write_plane
+from interact.readers import iter_planes, stack_shape
+from interact.instrument import StageTimer, fault_in, active_client
+from interact.pipeline import PlaneReader, ByteBudget, READ_AHEAD, PLANE_MEMORY_MB
+from interact.fusion import Fuser, DEFAULT_REDUCER
+from interact.qc import StackStats
+from interact.catalog import parse_name, FIELDS
+
+
+def illumination_sides(stack_paths):
+    '''
+    The I value of every stack, read from the file names. Stacks with names that do not parse
+    are each counted as their own side.
+    '''
+    fields = [parse_name(Path(path).stem) for path in stack_paths]
+    if any(field is None for field in fields):
+        return list(range(len(stack_paths)))
+    return [field[FIELDS.index('I')] for field in fields]
+
+
+def convert_timepoint(stack_paths, max_path=None, vol_path=None, tp=None, fusion=DEFAULT_REDUCER, hyperstack=None,
+                      ortho_paths=None, qc=False, crop=None, temporal=None, planes=None):
+    '''
+    Streams one timepoint through the engine. The planes of every illumination/detection side are
+    read in lockstep and fused once, so the stacks are read from disk exactly once and fused once
+    no matter how many outputs are requested. Memory is bounded to a couple of full planes plus
+    the per-level buffers of the pyramid writer, and the slabs a PlaneReader holds when one is
+    reading ahead.
+    Parameters: stack_paths (list) - one stack path per side (I0, I1, or I0/I1 x D0/D1), aligned
+                max_path (Path) - where to write the max projection, None to skip
+                vol_path (Path) - pyramid created by create_pyramid, None to skip
+                tp (int) - timepoint index into the volume, None for a single volume
+                fusion (str) - reducer from fusion.REDUCERS
+                hyperstack (tuple) - (path, t, c) plane of a max projection hyperstack to write the
+                                     projection into, see hyperstack.create_hyperstack
+                ortho_paths (tuple) - (XZ path, YZ path) to write max projections along Y and X of
+                                      the fused stack to, None to skip
+                qc (bool) - also collect the per-plane stats of every raw side, see qc.StackStats
+                crop (tuple) - ((z0, z1), (y0, y1), (x0, x1)) box of the stacks to convert, see
+                               crop.find_crop; every output is the size of the box. None for all of it
+                temporal (tuple) - (t, projection accumulator, volume accumulator) to add this
+                                   timepoint's max projection and fused planes to, see
+                                   temporal.TemporalAccumulator; either accumulator may be None
+                planes (PlaneReader) - reads the (cropped) planes of stack_paths ahead on another
+                                       thread, see pipeline.PlaneReader; None reads them here
+    Returns: dict of per-stage stats, see instrument.StageTimer.as_dict, with 'qc' holding the
+             StackStats.as_dict of every stack in stack_paths order when qc is set
+    '''
+    timer = StageTimer()
+    pyramid = PyramidWriter(vol_path, tp, timer=timer) if vol_path is not None else None
+    max_projection = None
+    fuser = None
+    stack_stats = None
+    xz_rows, yz_rows = [], []
+    t, projection_reductions, volume_reductions = temporal if temporal is not None else (None, None, None)
+    z = 0
+
+    # planes come straight off the page cache when the stacks can be memory-mapped, so they are
+    # read-only and the fusion goes into one reused buffer
+    reader = planes
+    sides = iter(reader) if reader is not None else zip(*[iter_planes(path, crop=crop) for path in stack_paths])
+    while True:
+        start = time.perf_counter()
+        planes = next(sides, None)
+        if planes is None:
+            break
+        if reader is None:
+            for plane in planes:
+                fault_in(plane)
+            timer.add('read', time.perf_counter() - start, bytes_read=sum(plane.nbytes for plane in planes))
+
+        if qc:
+            with timer.stage('qc'):
+                if stack_stats is None:
+                    stack_stats = [StackStats(plane.dtype) for plane in planes]
+                for stats, plane in zip(stack_stats, planes):
+                    stats.add_plane(plane)
+
+        if len(planes) == 1:
+            fused = planes[0]
+        else:
+            with timer.stage('fuse'):
+                if fuser is None:
+                    crop_x = {} if crop is None else {'x_start': crop[2][0], 'full_width': stack_shape(stack_paths[0])[0][-1]}
+                    fuser = Fuser(fusion, planes[0].shape, planes[0].dtype, illuminations=illumination_sides(stack_paths), **crop_x)
+                fused = fuser.fuse(planes)
+
+        if max_path is not None or hyperstack is not None or projection_reductions is not None:
+            with timer.stage('project'):
+                if max_projection is None:
+                    max_projection = fused.copy()
+                else:
+                    np.maximum(max_projection, fused, out=max_projection)
+
+        if ortho_paths is not None:
+            with timer.stage('project'):
+                xz_rows.append(fused.max(axis=0))
+                yz_rows.append(fused.max(axis=1))
+
+        if volume_reductions is not None:
+            with timer.stage('temporal'):
+                volume_reductions.add_plane(z, fused)
+        z += 1
+
+        if pyramid is not None:
+            pyramid.add_plane(fused)
+
+    if pyramid is not None:
+        pyramid.close()
+    if reader is not None:
+        timer.add('read', reader.seconds, bytes_read=reader.num_bytes)
+    if max_path is not None:
+        with timer.stage('write', bytes_written=max_projection.nbytes):
+            tiff_write(max_path, max_projection)
+    if hyperstack is not None:
+        with timer.stage('write', bytes_written=max_projection.nbytes):
+            write_plane(*hyperstack, max_projection)
+    if projection_reductions is not None and max_projection is not None:
+        with timer.stage('temporal'):
+            projection_reductions.add(max_projection, t=t)
+    if ortho_paths is not None and xz_rows:
+        for path, rows in zip(ortho_paths, (xz_rows, yz_rows)):
+            with timer.stage('write', bytes_written=len(rows) * rows[0].nbytes):
+                tiff_write(path, np.stack(rows))
+    result = timer.as_dict()
+    if qc:
+        result['qc'] = [stats.as_dict() for stats in stack_stats] if stack_stats is not None else []
+    return result
+
+
+def convert_timepoints(jobs, num_workers=None, read_ahead=READ_AHEAD, memory_mb=PLANE_MEMORY_MB):
+    '''
+    Runs convert_timepoint for every job in parallel. Uses the active dask distributed Client if
+    there is one and the jobs share no temporal accumulators. Otherwise the jobs run on local
+    threads, each with a PlaneReader that reads its stacks a slab of planes at a time on a
+    background thread, read_ahead slabs ahead of the conversion, so the disk and the CPU work at
+    the same time and no job ever holds a whole stack in memory.
+    Parameters: jobs (list) - dicts of convert_timepoint keyword arguments (stack_paths, max_path,
+                              vol_path, tp, fusion, hyperstack, ortho_paths, qc, crop, temporal)
+                num_workers (int) - number of jobs run at once, None for the scheduler default
+                                    (the number of CPUs without a Client)
+                read_ahead (int) - slabs of planes read ahead of each job's conversion, without a Client
+                memory_mb (float) - cap on the planes read ahead by all the running jobs together,
+                                    without a Client; None for no cap
+    Returns: list of the per-stage stats of every job
+    '''
+    # temporal accumulators are shared between the jobs, so those always run on local threads
+    if active_client() is None or any(job.get('temporal') is not None for job in jobs):
+        # only running jobs read, so every slab that holds the budget has a worker to take it
+        budget = ByteBudget(memory_mb * 2**20 if memory_mb is not None else None)
+
+        def convert(job):
+            reader = PlaneReader(job['stack_paths'], crop=job.get('crop'), budget=budget, depth=read_ahead)
+            try:
+                return convert_timepoint(**job, planes=reader)
+            finally:
+                reader.close()
+
+        with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count() or 1) as executor:
+            return list(executor.map(convert, jobs))
+
+    tasks = [dask.delayed(convert_timepoint)(**job) for job in jobs]
+    if num_workers is None:
+        return list(dask.compute(*tasks))
+    return list(dask.compute(*tasks, num_workers=num_workers))
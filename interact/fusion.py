@@ -0,0 +1,102 @@
+'''
+Illumination and detection side fusion. The aligned planes of every I0/I1 (and D0/D1) stack of a
+timepoint are reduced to one plane in a single vectorised pass, written into buffers that are
+allocated once per stack, so fusing adds no temporaries however many outputs use the result.
+'''
+import numpy as np
+
+REDUCERS = ('max', 'min', 'mean', 'linear', 'sigmoid')
+WEIGHTED_REDUCERS = ('linear', 'sigmoid')
+DEFAULT_REDUCER = 'max'
+CHANNEL_REDUCERS = {'C04': 'min'} # LED/transmitted light is darkest where the sample is, as in FlamingoConverter.ijm
+SIGMOID_WIDTH = 0.05 # width of the sigmoid transition as a fraction of the image width
+
+
+def default_reducer(ch_name):
+    '''
+    The reducer a channel is fused with unless told otherwise.
+    '''
+    return CHANNEL_REDUCERS.get(ch_name, DEFAULT_REDUCER)
+
+
+def blend_weights(method, width):
+    '''
+    Weight of the first illumination side at every X position. The sheet from the first side
+    enters at X = 0 and is sharpest there, the second side gets 1 - weight.
+    Parameters: method (str) - 'linear' for a ramp across the image, 'sigmoid' for a smooth step
+                               in the middle
+                width (int) - image width in pixels
+    Returns: float32 ndarray of shape (width,)
+    '''
+    x = np.arange(width, dtype=np.float64)
+    if method == 'linear':
+        weight = 1 - x / max(width - 1, 1)
+    else:
+        weight = 1 / (1 + np.exp((x - (width - 1) / 2) / (SIGMOID_WIDTH * width)))
+    return weight.astype(np.float32)
+
+
+class Fuser:
+    '''
+    Fuses one set of aligned planes at a time into a preallocated output plane.
+    '''
+
+    def __init__(self, method, shape, dtype, illuminations=None, x_start=0, full_width=None):
+        '''
+        Parameters: method (str) - one of REDUCERS
+                    shape (tuple) - (Y, X) plane shape
+                    dtype (np.dtype) - pixel type of the planes and the fused output
+                    illuminations (list) - the illumination side (I value) of each plane, only
+                                           needed by the weighted reducers
+                    x_start, full_width (int) - where cropped planes start in X and the width of the
+                                                uncropped field, so the blend weights stay where the
+                                                sheets actually enter; full_width None for uncropped planes
+        '''
+        if method not in REDUCERS:
+            raise ValueError(f'Unknown fusion method {method}, choose one of {list(REDUCERS)}')
+        self.method = method
+        self.out = np.empty(shape, dtype)
+        if method == 'mean' or method in WEIGHTED_REDUCERS:
+            self.sum = np.empty(shape, np.float32)
+            self.scratch = np.empty(shape, np.float32)
+        if method in WEIGHTED_REDUCERS:
+            if illuminations is None or len(set(illuminations)) != 2:
+                raise ValueError(f'{method} fusion blends two illumination sides, got {illuminations}')
+            first = min(illuminations)
+            weight = blend_weights(method, full_width or shape[-1])[x_start:x_start + shape[-1]]
+            # detection sides of the same illumination share its weight equally
+            self.weights = [(weight if side == first else 1 - weight) / illuminations.count(side) for side in illuminations]
+
+    def fuse(self, planes):
+        '''
+        Parameters: planes (list) - aligned 2D planes, one per stack
+        Returns: the fused plane. This is the same buffer every call, so copy it to keep it past
+                 the next call; a single plane is returned as is.
+        '''
+        if len(planes) == 1:
+            return planes[0]
+        if self.method == 'max':
+            np.maximum(planes[0], planes[1], out=self.out)
+            for plane in planes[2:]:
+                np.maximum(self.out, plane, out=self.out)
+            return self.out
+        if self.method == 'min':
+            np.minimum(planes[0], planes[1], out=self.out)
+            for plane in planes[2:]:
+                np.minimum(self.out, plane, out=self.out)
+            return self.out
+
+        if self.method == 'mean':
+            np.add(planes[0], planes[1], out=self.sum, dtype=np.float32)
+            for plane in planes[2:]:
+                np.add(self.sum, plane, out=self.sum, dtype=np.float32)
+            self.sum *= 1 / len(planes)
+        else:
+            np.multiply(planes[0], self.weights[0], out=self.sum)
+            for plane, weight in zip(planes[1:], self.weights[1:]):
+                np.multiply(plane, weight, out=self.scratch)
+                self.sum += self.scratch
+        if np.issubdtype(self.out.dtype, np.integer):
+            np.rint(self.sum, out=self.sum)
+        np.copyto(self.out, self.sum, casting='unsafe')
+        return self.out
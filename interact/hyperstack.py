@@ -0,0 +1,142 @@
+'''
+Max projection hyperstacks. Instead of one small TIFF per channel per timepoint, the projections of
+a region go into a single ImageJ hyperstack (T, C, Y, X) that opens in Fiji with its pixel size,
+frame interval and channel names. The file is allocated up front with its image data in one
+contiguous block, so every (t, c) plane sits at a fixed offset: workers write their planes in
+place, in any order and in parallel, and any plane can be read back without touching the others.
+'''
+import os
+import tempfile
+import numpy as np
+from pathlib import Path
+from tifffile import TiffFile
+from tifffile import memmap as tiff_memmap
+
+MAX_FORMATS = ('hyperstack', 'tiff', 'both') # one hyperstack per region, one TIFF per channel and timepoint, or both
+UNEVEN = ('pad', 'trim') # pad channels missing a timepoint with black planes, or drop the timepoints they miss
+FRAMES_COPIED = 16 # timepoints copied at a time when a hyperstack is resized
+
+
+def hyperstack_name(region_name):
+    return f'{region_name}_Max_hyperstack.tif'
+
+
+def create_hyperstack(path, num_timepoints, channel_names, plane_shape, dtype, pixel_size=None, interval=0):
+    '''
+    Allocates an empty hyperstack. Planes that are never written stay black, which is how channels
+    missing a timepoint are padded.
+    Parameters: path (str/Path) - the .tif to create, replaced if it exists
+                num_timepoints (int) - T
+                channel_names (list) - name of every channel, e.g. ['C00', 'C01'], stored as slice labels
+                plane_shape (tuple) - (Y, X)
+                dtype (np.dtype) - pixel type
+                pixel_size (float) - um per pixel, None to leave the file uncalibrated
+                interval (float) - seconds between timepoints
+    Returns: Path
+    '''
+    metadata = {'axes': 'TCYX', 'mode': 'composite' if len(channel_names) > 1 else 'grayscale',
+                'Labels': [ch_name for _ in range(num_timepoints) for ch_name in channel_names]}
+    if interval:
+        metadata['finterval'] = interval
+    options = {}
+    if pixel_size is not None:
+        metadata['unit'] = 'um'
+        options['resolution'] = (1 / pixel_size, 1 / pixel_size)
+    stack = tiff_memmap(path, shape=(num_timepoints, len(channel_names), *plane_shape), dtype=dtype, imagej=True,
+                        metadata=metadata, **options)
+    stack.flush()
+    del stack
+    return Path(path)
+
+
+def hyperstack_layout(path):
+    '''
+    Reads where the image data of a hyperstack lives.
+    Returns: dict with 'shape' (T, C, Y, X), 'dtype', 'offset' of the first plane in bytes,
+             'channels' names, 'pixel_size' (um or None) and 'interval' (s)
+    '''
+    with TiffFile(path) as tif:
+        metadata = tif.imagej_metadata or {}
+        page = tif.pages[0]
+        series = tif.series[0]
+        shape = (metadata.get('frames', 1), metadata.get('channels', 1), *page.shape)
+        if series.dataoffset is None:
+            raise ValueError(f'{path} is not a contiguous hyperstack')
+        resolution = page.resolution[0] if metadata.get('unit') == 'um' else None
+        return {'shape': shape,
+                'dtype': series.dtype,
+                'offset': series.dataoffset,
+                'channels': metadata.get('Labels', [f'C{c:02d}' for c in range(shape[1])])[:shape[1]],
+                'pixel_size': 1 / resolution if resolution else None,
+                'interval': metadata.get('finterval', 0)}
+
+
+def plane_offset(layout, t, c):
+    num_timepoints, num_channels, height, width = layout['shape']
+    if not (0 <= t < num_timepoints and 0 <= c < num_channels):
+        raise IndexError(f'plane (t={t}, c={c}) is outside a hyperstack of {num_timepoints} timepoints x {num_channels} channels')
+    return layout['offset'] + (t * num_channels + c) * height * width * layout['dtype'].itemsize
+
+
+def write_plane(path, t, c, plane, layout=None):
+    '''
+    Writes one plane in place. Every plane has its own byte range, so separate threads or
+    processes can write different planes of the same file at once.
+    Parameters: path (str/Path) - hyperstack made by create_hyperstack
+                t, c (int) - timepoint and channel index
+                plane (ndarray) - (Y, X)
+                layout (dict) - hyperstack_layout of the file, read when not given
+    '''
+    layout = layout or hyperstack_layout(path)
+    if tuple(plane.shape) != tuple(layout['shape'][2:]):
+        raise ValueError(f'plane of shape {plane.shape} does not fit a hyperstack of {layout["shape"][2:]} planes')
+    with open(path, 'r+b') as f:
+        f.seek(plane_offset(layout, t, c))
+        f.write(np.ascontiguousarray(plane, dtype=layout['dtype']).tobytes())
+
+
+def read_plane(path, t, c, layout=None):
+    '''
+    Random access to one plane. Parameters: see write_plane. Returns: (Y, X) ndarray
+    '''
+    layout = layout or hyperstack_layout(path)
+    height, width = layout['shape'][2:]
+    plane = np.fromfile(path, dtype=layout['dtype'], count=height * width, offset=plane_offset(layout, t, c))
+    return plane.reshape(height, width)
+
+
+def plane_memmap(path, t, c, layout=None):
+    '''
+    One plane of the hyperstack as a writable memmap, for writers that fill a plane a strip at a
+    time such as mosaic.MosaicCanvas.
+    '''
+    layout = layout or hyperstack_layout(path)
+    return np.memmap(path, dtype=layout['dtype'], mode='r+', offset=plane_offset(layout, t, c), shape=layout['shape'][2:])
+
+
+def resize_hyperstack(path, num_timepoints, interval=None):
+    '''
+    Grows or trims the T axis, keeping the planes that still fit. The image data has to stay
+    contiguous, so the file is rewritten next to the old one and swapped in; grow by more than one
+    timepoint at a time when appending so the copies stay rare.
+    Parameters: path (str/Path) - hyperstack to resize
+                num_timepoints (int) - new T
+                interval (float) - new frame interval in seconds, None to keep the current one
+    Returns: hyperstack_layout of the resized file
+    '''
+    path = Path(path)
+    layout = hyperstack_layout(path)
+    handle, new_path = tempfile.mkstemp(suffix='.tif', dir=path.parent)
+    os.close(handle)
+    create_hyperstack(new_path, num_timepoints, layout['channels'], layout['shape'][2:], layout['dtype'],
+                      pixel_size=layout['pixel_size'], interval=layout['interval'] if interval is None else interval)
+    new_layout = hyperstack_layout(new_path)
+    old = np.memmap(path, dtype=layout['dtype'], mode='r', offset=layout['offset'], shape=layout['shape'])
+    new = np.memmap(new_path, dtype=layout['dtype'], mode='r+', offset=new_layout['offset'], shape=new_layout['shape'])
+    for start in range(0, min(num_timepoints, layout['shape'][0]), FRAMES_COPIED):
+        stop = min(start + FRAMES_COPIED, num_timepoints, layout['shape'][0])
+        new[start:stop] = old[start:stop]
+    new.flush()
+    del old, new
+    os.replace(new_path, path)
+    return new_layout
@@ -0,0 +1,227 @@
+'''
+Acquisition index. What Kkpo learns about an acquisition folder is kept in a JSON sidecar inside
+it: the file list with the parsed name fields, stack shapes and dtypes, the timestamp, plane
+spacing and stage position of every settings file read, and FlamingoMetaData.txt with the
+objective and pixel size. Reopening a folder that has not changed since it was indexed only counts
+the names in it, and skips parsing them and every text file. When it has changed, only the new
+names are parsed and the ones that disappeared are dropped.
+'''
+import os
+import re
+import json
+import time
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+from interact.catalog import Catalog, STACK_SUFFIXES
+from interact.readers import stack_shape
+from interact.mosaic import parse_stage_position
+from interact.pyramid import CAMERA_PIXEL_SIZE
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+
+INDEX_NAME = 'kkpo_index.json'
+INDEX_VERSION = 1
+SETTINGS_SUFFIX = '_Settings.txt'
+MTIME_RESOLUTION = 2 # seconds; FAT/exFAT volumes store modification times to 2 s, so a folder scanned within that of its last change is listed again
+TIMESTAMP_PATTERN = re.compile(r'Date time stamp\s*=\s*(\d{8})_(\d{6})')
+
+
+def parse_settings(text):
+    '''
+    Pulls what Kkpo uses out of the text of a settings file.
+    Returns: dict with 'timestamp' (ISO format str), 'plane_spacing' (um) and 'position' ([y, x]
+             stage position in um), each None when the file does not record it
+    '''
+    timestamp = TIMESTAMP_PATTERN.search(text)
+    spacing = None
+    spacing_lines = [line for line in text.splitlines() if 'spacing' in line.lower() and '=' in line]
+    try:
+        spacing = float(spacing_lines[0].split('=')[-1].split()[0])
+    except (IndexError, ValueError):
+        pass
+    position = parse_stage_position(text)
+    return {'timestamp': datetime.strptime(''.join(timestamp.groups()), '%Y%m%d%H%M%S').isoformat() if timestamp else None,
+            'plane_spacing': spacing,
+            'position': list(position) if position is not None else None}
+
+
+@contextmanager
+def locked(handle, exclusive=False):
+    '''
+    Holds an advisory lock on an open file: shared for reading, exclusive for writing. Does nothing
+    where fcntl is not available.
+    '''
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+        yield
+    finally:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def parse_objmag(lines):
+    '''
+    The objective magnification from the 'Name = ' line of FlamingoMetaData.txt, e.g. 'Olympus 10x' -> 10.
+    '''
+    try:
+        return int([line for line in lines if 'Name = ' in line][0][-3:-1])
+    except (IndexError, ValueError):
+        return None
+
+
+class AcquisitionIndex:
+    '''
+    Sidecar index of an acquisition folder. The folder's modification time only changes when files
+    are added, removed or renamed, so an unchanged time and an unchanged number of files mean the
+    stored file list is still right. The count catches the file systems and network shares whose
+    folder times lag behind or are cached.
+    The index file itself is rewritten in place, which does not touch the folder's time, under an
+    exclusive lock that readers wait on, so another process never sees a half written file.
+    '''
+
+    def __init__(self, dir_path, index_path=None, persist=True):
+        '''
+        Parameters: dir_path (str/Path) - the acquisition folder
+                    index_path (str/Path) - the sidecar, kkpo_index.json in the folder by default
+                    persist (bool) - False keeps the index in memory only, e.g. for read-only folders
+        '''
+        self.dir_path = Path(dir_path)
+        self.index_path = (Path(index_path) if index_path else self.dir_path / INDEX_NAME) if persist else None
+        self.data = self.load()
+        self.dirty = False
+
+    def empty(self):
+        return {'version': INDEX_VERSION, 'dir_mtime_ns': None, 'scanned_at': None, 'num_files': 0,
+                'stacks': {'names': [], 'fields': []}, 'settings': {'names': [], 'fields': []},
+                'shapes': {}, 'settings_info': {}, 'metadata': None}
+
+    def load(self):
+        '''
+        Reads the sidecar. A missing, damaged or outdated one starts an empty index.
+        '''
+        if self.index_path is None or not self.index_path.exists():
+            return self.empty()
+        try:
+            with open(self.index_path, 'r') as f, locked(f):
+                data = json.load(f)
+        except (OSError, ValueError):
+            print(f'Could not read {self.index_path.name}, rebuilding it')
+            return self.empty()
+        return data if data.get('version') == INDEX_VERSION else self.empty()
+
+    def save(self, force=False):
+        '''
+        Writes the index back if anything changed. The file is overwritten in place rather than
+        replaced so the folder's modification time stays put, and locked while it is, so a reader
+        in another process gets the old or the new index but never a mix of the two.
+        '''
+        if self.index_path is None or not (self.dirty or force):
+            return
+        text = json.dumps(self.data).encode()
+        try:
+            handle = os.open(self.index_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                with locked(handle, exclusive=True):
+                    os.write(handle, text)
+                    os.ftruncate(handle, len(text))
+            finally:
+                os.close(handle)
+            self.dirty = False
+        except OSError as error:
+            print(f'Could not write the index {self.index_path} ({error}), keeping it in memory only')
+            self.index_path = None
+
+    def scan(self):
+        '''
+        Brings the file list up to date, parsing the folder's names only when it has changed.
+        Returns: (stack Catalog, settings Catalog)
+        '''
+        # create the sidecar before looking at the folder, so creating it does not invalidate the scan
+        if self.index_path is not None and not self.index_path.exists():
+            self.save(force=True)
+        scanned_at = time.time()
+        stat = os.stat(self.dir_path)
+        file_names = os.listdir(self.dir_path)
+        data = self.data
+        unchanged = (data['dir_mtime_ns'] == stat.st_mtime_ns and data['scanned_at'] is not None
+                     and data['scanned_at'] - stat.st_mtime >= MTIME_RESOLUTION and data['num_files'] == len(file_names))
+        if not unchanged:
+            self.update_names(file_names)
+            data.update(dir_mtime_ns=stat.st_mtime_ns, scanned_at=scanned_at, num_files=len(file_names))
+            self.dirty = True
+        return (Catalog.from_fields(data['stacks']['names'], data['stacks']['fields']),
+                Catalog.from_fields(data['settings']['names'], data['settings']['fields']))
+
+    def update_names(self, file_names):
+        '''
+        Parses the names that are new since the last scan and forgets the ones that are gone.
+        '''
+        present = set(file_names)
+        for kind, suffix in (('stacks', STACK_SUFFIXES), ('settings', SETTINGS_SUFFIX)):
+            entries = {name: row for name, row in zip(self.data[kind]['names'], self.data[kind]['fields']) if name in present}
+            new = Catalog([name for name in file_names if name not in entries], suffix=suffix)
+            entries.update(zip(new.names, new.fields.tolist()))
+            names = sorted(entries)
+            self.data[kind] = {'names': names, 'fields': [entries[name] for name in names]}
+        for cache in ('shapes', 'settings_info'):
+            self.data[cache] = {name: value for name, value in self.data[cache].items() if name in present}
+
+    def stack_shape(self, stack_path):
+        '''
+        The (Z, Y, X) shape and dtype of a stack, read from its header the first time only. The
+        file size is kept with it, so a stack that was still being written is read again.
+        '''
+        stack_path = Path(stack_path)
+        size = os.path.getsize(stack_path)
+        cached = self.data['shapes'].get(stack_path.name) if stack_path.parent == self.dir_path else None
+        if cached is not None and cached[2] == size:
+            return tuple(cached[0]), np.dtype(cached[1])
+        shape, dtype = stack_shape(stack_path)
+        if stack_path.parent == self.dir_path:
+            self.data['shapes'][stack_path.name] = [list(shape), np.dtype(dtype).str, size]
+            self.dirty = True
+        return tuple(shape), np.dtype(dtype)
+
+    def settings(self, settings_name):
+        '''
+        The parse_settings dict of a settings file in the folder, read the first time only.
+        '''
+        info = self.data['settings_info'].get(settings_name)
+        if info is None:
+            with open(self.dir_path / settings_name, 'r') as f:
+                info = parse_settings(f.read())
+            self.data['settings_info'][settings_name] = info
+            self.dirty = True
+        return info
+
+    def settings_datetime(self, settings_name):
+        timestamp = self.settings(settings_name)['timestamp']
+        return datetime.fromisoformat(timestamp) if timestamp else None
+
+    def metadata(self):
+        '''
+        FlamingoMetaData.txt, reread only when its size or modification time changes.
+        Returns: dict with 'lines', 'objmag' and 'pixel_size' (um), or None if there is no file
+        '''
+        metadata_path = self.dir_path / 'FlamingoMetaData.txt'
+        try:
+            stat = os.stat(metadata_path)
+        except FileNotFoundError:
+            return None
+        cached = self.data['metadata']
+        if cached is not None and cached['mtime_ns'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            return cached
+        with open(metadata_path, 'r') as f:
+            lines = [line.rstrip() for line in f]
+        objmag = parse_objmag(lines)
+        self.data['metadata'] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'lines': lines, 'objmag': objmag,
+                                 'pixel_size': CAMERA_PIXEL_SIZE / objmag if objmag else None}
+        self.dirty = True
+        return self.data['metadata']
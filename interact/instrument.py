@@ -0,0 +1,217 @@
+'''
+Per-stage instrumentation. Every stage of a conversion (discovery, metadata parse, read, qc, fuse,
+project, downsample, write) accumulates wall time and bytes moved, so a slow run shows whether it
+was waiting on the disk, the CPU or the dask scheduler. Records go to a JSON-lines log and a
+summary table is printed at the end of a run.
+'''
+import os
+import sys
+import json
+import mmap
+import time
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+STAGES = ('discovery', 'metadata', 'crop', 'read', 'qc', 'fuse', 'project', 'temporal', 'downsample', 'write', 'mosaic', 'drift')
+LOG_NAME = 'kkpo_log.jsonl'
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of this process in MB, None where the platform does not report it.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def fault_in(plane):
+    '''
+    Touches one element per memory page of a memory-mapped plane, so the disk read happens now
+    rather than in whichever stage first looks at the pixels.
+    '''
+    if not isinstance(plane, np.memmap) or not plane.size:
+        return plane
+    step = max(mmap.PAGESIZE // plane.itemsize, 1)
+    if plane.flags.c_contiguous:
+        plane.reshape(-1)[::step].max()
+    elif plane.ndim == 2 and plane.strides[-1] == plane.itemsize:
+        # a cropped plane: every row is contiguous on its own
+        plane[:, ::step].max()
+        plane[:, -1].max()
+    return plane
+
+
+class StageTimer:
+    '''
+    Accumulates seconds, calls and bytes read/written per stage. Timers are plain dicts underneath
+    so the stats of tasks run in other processes can be returned and merged.
+    '''
+
+    def __init__(self, stages=None):
+        self.stages = {}
+        self.peak_rss_mb = None
+        if stages is not None:
+            self.merge(stages)
+
+    @contextmanager
+    def stage(self, name, bytes_read=0, bytes_written=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, bytes_read=bytes_read, bytes_written=bytes_written)
+
+    def add(self, name, seconds, bytes_read=0, bytes_written=0, calls=1):
+        stats = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'bytes_read': 0, 'bytes_written': 0})
+        stats['seconds'] += seconds
+        stats['calls'] += calls
+        stats['bytes_read'] += int(bytes_read)
+        stats['bytes_written'] += int(bytes_written)
+
+    def merge(self, other):
+        '''
+        Adds in the stats of another StageTimer or of the dict returned by its as_dict.
+        '''
+        if isinstance(other, StageTimer):
+            other = other.as_dict()
+        for name, stats in other.get('stages', {}).items():
+            self.add(name, stats['seconds'], stats['bytes_read'], stats['bytes_written'], calls=stats['calls'])
+        peaks = [peak for peak in (self.peak_rss_mb, other.get('peak_rss_mb')) if peak is not None]
+        self.peak_rss_mb = max(peaks) if peaks else None
+
+    def as_dict(self):
+        '''
+        Returns: {'stages': {stage: stats with MB/s}, 'peak_rss_mb': float}, stages in STAGES order
+        '''
+        stages = {}
+        for name in sorted(self.stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+            stats = dict(self.stages[name])
+            num_bytes = max(stats['bytes_read'], stats['bytes_written'])
+            stats['MBps'] = num_bytes / 1e6 / stats['seconds'] if stats['seconds'] > 0 and num_bytes else None
+            stages[name] = stats
+        peaks = [peak for peak in (self.peak_rss_mb, peak_rss_mb()) if peak is not None]
+        return {'stages': stages, 'peak_rss_mb': max(peaks) if peaks else None}
+
+
+def active_client():
+    '''
+    The dask distributed Client in use, None when dask runs on the local scheduler.
+    '''
+    try:
+        from distributed import default_client
+        return default_client()
+    except (ImportError, ValueError):
+        return None
+
+
+def summarize_task_stream(tasks, num_threads):
+    '''
+    Condenses a dask task stream into the numbers that tell a scheduler-bound run apart: how busy
+    the worker threads were over the span of the run and how long went on transfers and disk.
+    Parameters: tasks (list) - task stream records from distributed.get_task_stream
+                num_threads (int) - total worker threads of the cluster
+    Returns: dict
+    '''
+    seconds = {}
+    starts, stops = [], []
+    for task in tasks:
+        for startstop in task.get('startstops', []):
+            action = startstop['action']
+            seconds[action] = seconds.get(action, 0.0) + startstop['stop'] - startstop['start']
+            starts.append(startstop['start'])
+            stops.append(startstop['stop'])
+    span = max(stops) - min(starts) if starts else 0.0
+    return {'tasks': len(tasks),
+            'workers': len({task.get('worker') for task in tasks}),
+            'threads': num_threads,
+            'span_seconds': span,
+            'compute_seconds': seconds.get('compute', 0.0),
+            'transfer_seconds': seconds.get('transfer', 0.0),
+            'disk_seconds': seconds.get('disk-read', 0.0) + seconds.get('disk-write', 0.0),
+            'utilisation': seconds.get('compute', 0.0) / (span * num_threads) if span and num_threads else None}
+
+
+class RunLog:
+    '''
+    Writes instrumentation records as JSON lines and prints the end of run summary.
+    '''
+
+    def __init__(self, log_path=None):
+        '''
+        Parameters: log_path (str/Path) - JSON-lines file to append to, None to only keep the
+                                          records in memory
+        '''
+        self.log_path = log_path
+        self.records = []
+
+    def record(self, event, timer=None, **fields):
+        '''
+        Appends a record to the log.
+        Parameters: event (str) - what the record is about, e.g. 'channel'
+                    timer (StageTimer) - stage stats to include
+                    fields - anything else JSON serialisable to include
+        Returns: the record dict
+        '''
+        record = {'time': datetime.now().isoformat(timespec='seconds'), 'event': event, 'pid': os.getpid()}
+        record.update({key: str(value) if isinstance(value, os.PathLike) else value for key, value in fields.items()})
+        if timer is not None:
+            record.update(timer.as_dict())
+        self.records.append(record)
+        if self.log_path is not None:
+            try:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as error:
+                print(f'Could not write to the log {self.log_path} ({error}), keeping records in memory only')
+                self.log_path = None
+        return record
+
+    @contextmanager
+    def task_stream(self):
+        '''
+        Captures the dask task stream while the block runs, if a distributed Client is active.
+        Returns: dict that is filled with the stream summary when the block exits, left empty on
+                 the local scheduler
+        '''
+        stats = {}
+        client = active_client()
+        if client is None:
+            yield stats
+            return
+        from distributed import get_task_stream
+        with get_task_stream(client=client) as stream:
+            yield stats
+        stats.update(summarize_task_stream(stream.data, sum(client.nthreads().values())))
+
+    def summary(self, timer, wall_seconds=None, **fields):
+        '''
+        Prints a per-stage table of a run and logs it as a 'summary' record.
+        Parameters: timer (StageTimer) - the stats of the whole run
+                    wall_seconds (float) - end to end time of the run; stages run in parallel so
+                                           their seconds can add up to more than this
+        '''
+        record = self.record('summary', timer, wall_seconds=wall_seconds, **fields)
+        total = sum(stats['seconds'] for stats in record['stages'].values())
+        print(f'{"stage":>11} {"seconds":>9} {"share":>6} {"read MB":>9} {"written MB":>11} {"MB/s":>8}')
+        for name, stats in record['stages'].items():
+            rate = f'{stats["MBps"]:.1f}' if stats['MBps'] is not None else '-'
+            share = 100 * stats['seconds'] / total if total else 0
+            print(f'{name:>11} {stats["seconds"]:>9.2f} {share:>5.0f}% {stats["bytes_read"] / 1e6:>9.1f} '
+                  f'{stats["bytes_written"] / 1e6:>11.1f} {rate:>8}')
+        totals = []
+        if wall_seconds is not None:
+            totals.append(f'wall time {wall_seconds:.2f} s')
+        if record['peak_rss_mb'] is not None:
+            totals.append(f'peak memory {record["peak_rss_mb"]:.0f} MB')
+        if totals:
+            print(', '.join(totals))
+        return record
@@ -1,40 +1,81 @@
 import os
 import sys
+import tempfile
 import napari
 import numpy as np
-from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime
 from tifffile import imread as tiff_read
-from tifffile import imwrite as tiff_write
-from dask_image.imread import imread as dask_read
-import dask.array as da
-from dask import distributed
 import time
-from yaspin import yaspin
+from interact.engine import convert_timepoints
+from interact.pipeline import READ_AHEAD, PLANE_MEMORY_MB
+from interact.qc import qc_name, stack_keys, write_qc
+from interact.pyramid import create_pyramid, open_pyramid, pyramid_factors, CAMERA_PIXEL_SIZE, DEFAULT_PLANE_SPACING
+from interact.catalog import field_value, token
+from interact.live import LiveConverter
+from interact.storage import benchmark_profiles, DEFAULT_CHUNKS, DEFAULT_CODEC
+from interact.crop import find_crop, check_crop, crop_shape, sample_timepoints, CROP_MARGIN, CROP_SAMPLES
+from interact.instrument import StageTimer, RunLog, LOG_NAME
+from interact.fusion import default_reducer
+from interact.preview import render_preview, contrast_limits
+from interact.lazy import LazyChannel, LRUCache, CACHE_MB, PREFETCH
+from interact.hyperstack import create_hyperstack, hyperstack_layout, hyperstack_name, read_plane, MAX_FORMATS, UNEVEN
+from interact.index import AcquisitionIndex, locked
+from interact.archive import archive_acquisition, ARCHIVE_CODEC
+from interact.temporal import TemporalAccumulator, temporal_name
+from interact.drift import (estimate_drift, volume_frames, binned, annotate_volume, open_registered, read_drift, write_drift,
+                            drift_name, shift_image, timepoint_shift, DRIFT_BIN, DRIFT_UPSAMPLE, LOW_PEAK)
+from interact.mosaic import tile_offsets, overlap_widths, tile_weights, mosaic_projection, mosaic_volume, DEFAULT_OVERLAP
 
 class Kkpo:
 
-    def __init__(self, file_path=None):
+    def __init__(self, file_path=None, log_path=None, index=True):
+        '''
+        Parameters: file_path (str/Path) - the acquisition folder
+                    log_path (str/Path) - JSON-lines file for the per-stage timings, by default
+                                          kkpo_log.jsonl in the acquisition folder
+                    index (bool) - keep what is learnt about the folder in kkpo_index.json so it
+                                   reopens without rescanning, False to keep it in memory only
+        '''
         if not file_path:
             print('*****'*9)
             print("I can't make a Kakapo without a file path!")
             print('*****'*9)
             sys.exit()
         self.file_path = Path(file_path)
-        self.files = [file for file in os.listdir(self.file_path) if all([file.endswith('.tif')]) and not any([file.startswith('.'),
-                                                                                                              'MP' in file,
-                                                                                                              'max' in file])]
-        self.region_names = np.unique([file.split('_')[3] for file in self.files])
         self.temporal = True # default
-        try:
-            with open(self.file_path / 'FlamingoMetaData.txt', "r") as f:
-                self.metadata = [line.rstrip() for line in f]
-            self.objmag = int([line for line in self.metadata if 'Name = ' in line][0][-3:-1])
-        except FileNotFoundError:
+        self.timer = StageTimer() # stage stats of the current run, reset after every summary
+        self.run_log = RunLog(log_path or self.file_path / LOG_NAME)
+        self.index = AcquisitionIndex(self.file_path, persist=index)
+        self.refresh()
+        self.read_metadata()
+
+    def refresh(self):
+        '''
+        Brings the stack and settings catalogs up to date from the index, which only lists the
+        directory if it has changed. Called once on creation and again by the live mode every time
+        it looks for newly written stacks.
+        '''
+        with self.timer.stage('discovery'):
+            self.catalog, self.settings_catalog = self.index.scan()
+            self.index.save()
+        self.files = self.catalog.names
+        self.region_names = self.catalog.tokens('R')
+
+    def read_metadata(self):
+        '''
+        Reads FlamingoMetaData.txt (through the index) and pulls out the objective magnification.
+        '''
+        with self.timer.stage('metadata'):
+            metadata = self.index.metadata()
+            self.index.save()
+        if metadata is None:
             print('No metadata found. Continuing...')
             self.metadata = None
             self.objmag = None
+        else:
+            self.metadata = metadata['lines']
+            self.objmag = metadata['objmag']
 
     def get_datetime(self, settings_file: np.ndarray):
         '''
@@ -54,6 +95,51 @@ class Kkpo:
         start_second = int(timestamp_time[4:6])
         return datetime(start_year, start_month, start_day, start_hour, start_minute, start_second)
 
+    def get_voxel_size(self, region_name: str):
+        '''
+        Works out the physical voxel size of a region from the objective magnification and the plane
+        spacing recorded in the first settings file of the region.
+        Parameters: region_name (str) - the name of the region
+        Returns: (z, y, x) voxel size in um
+        '''
+        if self.objmag:
+            xy_pixel_size = CAMERA_PIXEL_SIZE / self.objmag
+        else:
+            print('No objective magnification found, using a pixel size of 1 um.')
+            xy_pixel_size = 1.0
+
+        z_spacing = DEFAULT_PLANE_SPACING
+        settings = self.settings_catalog.select(R=region_name)
+        if len(settings):
+            spacing = self.index.settings(self.settings_catalog.name(settings[0]))['plane_spacing']
+            if spacing is not None:
+                z_spacing = spacing
+            else:
+                print(f'No plane spacing found for region {region_name}, using {DEFAULT_PLANE_SPACING} um.')
+        return z_spacing, xy_pixel_size, xy_pixel_size
+
+    def get_timestamps(self, region_name: str):
+        '''
+        The acquisition time of every timepoint of a region, from the settings file of the first
+        channel/illumination/camera/tile of each timepoint. Settings files are parsed once and
+        kept in the index, so this is exact per-frame timing at no extra cost on reopening.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+        Returns: dict of timepoint name -> datetime, timepoints without a settings file left out
+        '''
+        settings = self.settings_catalog
+        first = {field: self.catalog.values(field, R=region_name)[0] for field in ('C', 'I', 'D', 'X', 'Y')}
+        timestamps = {}
+        for tp_name in self.catalog.tokens('t', R=region_name):
+            indices = settings.select(R=region_name, t=tp_name, **first)
+            if not len(indices):
+                indices = settings.select(R=region_name, t=tp_name)
+            if len(indices):
+                timestamp = self.index.settings_datetime(settings.name(indices[0]))
+                if timestamp is not None:
+                    timestamps[str(tp_name)] = timestamp
+        self.index.save()
+        return timestamps
+
     def get_region_info(self, region_name: str):
         '''
         Identifies the number of timepoints, channels, slices, and illumination sources for a given
@@ -67,28 +153,29 @@ class Kkpo:
          - num_illum (int) - the number of illumination sources in the region
         '''
         # get the image parameters for the region
-        region_files = [file for file in self.files if region_name in file]
-        timepoint_names = np.unique([file.split('_')[1] for file in region_files])
-        channel_names =   np.unique([file.split('_')[6] for file in self.files])
-        illum_names =     np.unique([file.split('_')[7] for file in self.files])
-        plane_names =     np.unique([file.split('_')[9] for file in self.files])
+        timepoint_names = self.catalog.tokens('t', R=region_name)
+        channel_names =   self.catalog.tokens('C', R=region_name)
+        illum_names =     self.catalog.tokens('I', R=region_name)
+        plane_names =     self.catalog.tokens('P', R=region_name)
+        camera_name =     self.catalog.tokens('D', R=region_name)[0]
+        tile_x_name =     self.catalog.tokens('X', R=region_name)[0]
+        tile_y_name =     self.catalog.tokens('Y', R=region_name)[0]
         num_timepoints =  len(timepoint_names)
         print(f'num time points = {num_timepoints}')
 
         # pick out the first and last settings files
-        setting_files = [file for file in os.listdir(self.file_path) if "Settings.txt" in file and region_name in file and not file.startswith('.')]
-        first_timepoint_name = [file for file in setting_files if all(match in file for match in [timepoint_names[0], channel_names[0], illum_names[0]])]
-        last_timepoint_name = [file for file in setting_files if all(match in file for match in [timepoint_names[-1], channel_names[0], illum_names[0]])]
+        settings = self.settings_catalog
+        first_timepoint_name = [settings.name(i) for i in settings.select(R=region_name, t=timepoint_names[0], C=channel_names[0], I=illum_names[0], D=camera_name, X=tile_x_name, Y=tile_y_name)]
+        last_timepoint_name = [settings.name(i) for i in settings.select(R=region_name, t=timepoint_names[-1], C=channel_names[0], I=illum_names[0], D=camera_name, X=tile_x_name, Y=tile_y_name)]
 
-        # read the settings file, get the start and end times
-        with open(self.file_path / first_timepoint_name[0], "r") as f:
-            first_timepoint_file = [l.rstrip() for l in f]
-        start_datetime = self.get_datetime(first_timepoint_file)
+        # get the start and end times, the settings files are parsed once and kept in the index
+        start_datetime = self.index.settings_datetime(first_timepoint_name[0])
 
         if num_timepoints == 1 or len(first_timepoint_name) == 1 and len(last_timepoint_name) == 0:
             self.temporal = False
             print('No setting file found for last timepoint, continuing without interval calculation.')
-            timepoint_names = [first_timepoint_name[0].split('_')[1]]
+            timepoint_names = timepoint_names[:1]
+            self.index.save()
             return 0, timepoint_names, channel_names, illum_names, plane_names
 
         if len(first_timepoint_name) != 1 or len(last_timepoint_name) != 1:
@@ -99,34 +186,74 @@ class Kkpo:
             print('*****'*9)
             sys.exit()
 
-        with open(self.file_path / last_timepoint_name[0], "r") as f:
-            last_timepoint_file = [l.rstrip() for l in f]
-        end_datetime = self.get_datetime(last_timepoint_file)
+        end_datetime = self.index.settings_datetime(last_timepoint_name[0])
+        self.index.save()
         total_seconds = (end_datetime - start_datetime).total_seconds()
         interval = total_seconds / (num_timepoints - 1)
         return interval, timepoint_names, channel_names, illum_names, plane_names
 
     
-    def save_regions(self, save_vol = False, save_max = True, step = 8, overwrite = False):
+    def save_regions(self, save_vol = False, save_max = True, step = 8, overwrite = False, chunks = DEFAULT_CHUNKS, codec = DEFAULT_CODEC,
+                     fusion = None, max_format = 'hyperstack', uneven = 'pad', memory_mb = PLANE_MEMORY_MB, save_ortho = False, qc = False,
+                     crop = None, crop_margin = CROP_MARGIN, temporal_reductions = None, drift = False):
         ''' 
         Saves the regions as individual files.
-        Parameters: save_vol (bool) - whether or not to save the volume as a single file
+        Parameters: save_vol (bool) - whether or not to save the volume as a multiscale OME-Zarr pyramid
                     save_max (bool) - whether or not to save the max projection as a single file    
-                    step (int) - the step size to use when saving the volume (step=8 will be <10% of original file size)
+                    step (int) - XY downsampling of the coarsest pyramid level, levels are written at
+                                 full resolution and every power of two up to step
                     overwrite (bool) - whether or not to overwrite existing files
-        Returns: None
+                    chunks (str or tuple) - volume chunk profile ('default', 'planes', 'blocks', 'ortho')
+                                            or a (Z, Y, X) chunk shape, see storage.CHUNK_PROFILES
+                    codec (str) - volume compression profile, see storage.CODEC_PROFILES
+                    fusion (str) - how the illumination/detection sides are fused: 'max', 'min', 'mean',
+                                   or 'linear'/'sigmoid' blending across X, see fusion.REDUCERS;
+                                   None picks per channel (min for the C04 LED channel, max otherwise)
+                    max_format (str) - 'hyperstack' writes the max projections of a region into one ImageJ
+                                       hyperstack ({region}_Max_hyperstack.tif), 'tiff' writes one file per
+                                       channel per timepoint, 'both' does both
+                    uneven (str) - when channels have different numbers of timepoints, 'pad' fills the
+                                   gaps in the hyperstack with black planes and 'trim' keeps only the
+                                   timepoints every channel has
+                    memory_mb (float) - cap on the raw planes read ahead of the conversion by all the
+                                        timepoints being converted at once, when no dask Client is
+                                        running; None for no cap, see engine.convert_timepoints
+                    save_ortho (bool) - also save XZ and YZ max projections of every fused stack
+                                        ({region}_{channel}_{timepoint}_MaxXZ.tiff / _MaxYZ.tiff)
+                    qc (bool) - collect per-plane mean, max, saturated pixel count and focus score and
+                                a histogram of every raw stack while converting, into {region}_QC.npz,
+                                see qc.read_qc
+                    crop - None converts the full field of view; 'auto' finds the bounding box of the sample
+                           in every region with find_crop and only reads and writes that box; a
+                           ((z0, z1), (y0, y1), (x0, x1)) box in pixels crops every region to it; a dict
+                           of region name -> None, 'auto' or box sets it per region. Mosaics are not cropped
+                    crop_margin (int) - pixels of background kept around the sample by 'auto'
+                    temporal_reductions (tuple) - reductions over the whole timelapse to accumulate while
+                                                  converting, any of 'max', 'min', 'mean', 'std' and 'running'
+                                                  (an exponential running average), see temporal.py. They are
+                                                  saved for the max projections ({region}_{channel}_TMean.tiff, ...)
+                                                  and, with save_vol, for the volumes (..._TMean_volume.zarr,
+                                                  'running' excepted). None for none
+                    drift (bool) - estimate the drift of every region after converting it and record it for
+                                   view_volumes and save_preview to apply, see correct_drift; from the
+                                   max projections with save_max, from the volumes otherwise
+        Returns: None, a per-stage summary is printed and appended to the log at the end
         '''
         if not save_vol and not save_max:
             print('*****'*9)
             print('I can\'t save nothing!')
             print('*****'*9)
             sys.exit()
+        if max_format not in MAX_FORMATS or uneven not in UNEVEN:
+            raise ValueError(f'max_format must be one of {list(MAX_FORMATS)} and uneven one of {list(UNEVEN)}')
 
+        start = time.perf_counter()
         for region_num, region_name in enumerate(self.region_names):
             print(f'Saving region {region_num + 1}/{len(self.region_names)}')
             print(f'Collecting information about region {region_name}')
 
-            interval, timepoint_names, channel_names, illum_names, plane_names = self.get_region_info(region_name)
+            with self.timer.stage('metadata'):
+                interval, timepoint_names, channel_names, illum_names, plane_names = self.get_region_info(region_name)
 
             # create a folder to save the max projections and volume arrays for this region
             region_save_path = self.file_path / f'{region_name}_processed'
@@ -142,111 +269,702 @@ class Kkpo:
                 print('Creating directories...')
                 Path.mkdir(region_save_path, parents=True, exist_ok=True)
     
+            # the hyperstack is created by the first channel to write to it, once the plane shape is known
+            hyperstack = None
+            if save_max and max_format != 'tiff':
+                hyperstack = self.max_hyperstack(region_name, (interval, timepoint_names, channel_names), uneven)
+                if hyperstack['path'].exists():
+                    os.remove(hyperstack['path'])
+
+            # every channel of a region gets the same box, so they still overlay and share the hyperstack
+            region_crop = crop.get(region_name) if isinstance(crop, dict) else crop
+            if isinstance(region_crop, str) and region_crop == 'auto':
+                region_crop = self.find_crop(region_name, margin=crop_margin, step=step)
+
             for ch_num, ch_name in enumerate(channel_names):
                 print(f'Saving channel {ch_num+1}/{len(channel_names)}')
-                if not self.temporal and len(illum_names) == 1:
-                    print('single time point and one-sided illumination detected')
-                    channel_array = dask_read(self.file_path / f'S000_t000000_V000_{region_name}_X000_Y000_{ch_name}_I0_D0_{plane_names[region_num]}')
-                if not self.temporal and len(illum_names) == 2:
-                    print('single time point and two-sided illumination detected')
-                    channel_array_left = dask_read(self.file_path / f'S000_t000000_V000_{region_name}_X000_Y000_{ch_name}_I0_D0_{plane_names[region_num]}')
-                    channel_array_right = dask_read(self.file_path / f'S000_t000000_V000_{region_name}_X000_Y000_{ch_name}_I1_D0_{plane_names[region_num]}')
-                    
-                if self.temporal and len(illum_names) == 1:
-                    print('Multiple time points with one-sided illumination detected')
-                    channel_array = dask_read(self.file_path /  f'*{region_name}*{ch_name}*.tif')
-                    channel_array.compute_chunk_sizes()
-                
-                if self.temporal and len(illum_names) == 2:
-                    print('Multiple time points with two-sided illumination detected')
-                    channel_array_left = dask_read(self.file_path / f'*{region_name}*{ch_name}_I0*.tif')
-                    channel_array_right = dask_read(self.file_path / f'*{region_name}*{ch_name}_I1*.tif')
-
-                    # if one side has fewer time points, trim the other side
-                    numtp1 = channel_array_left.shape[0]
-                    numtp2 = channel_array_right.shape[0]
-                    if numtp1 < numtp2:
-                        channel_array_right = channel_array_right[:numtp1]
-                    elif numtp2 < numtp1:
-                        channel_array_left = channel_array_left[:numtp2]
-                    assert channel_array_left.shape == channel_array_right.shape, 'something is wrong... I0 and I1 arrays are not the same shape'
-
-                # save the downsampled channel volume, if requested
-                if save_vol:
-
-                    chan_path = region_save_path / f'{region_name}_{ch_name}_volume.zarr'
-
-                    if not self.temporal and len(illum_names) == 1:
-                        print('Saving volume, please be patient...')
-                        da.to_zarr(channel_array[:,::step,::step], chan_path, overwrite=True)
-                    
-                    if not self.temporal and len(illum_names) == 2:
-                        print('Saving volume, please be patient...')
-                        fused = da.maximum(channel_array_left, channel_array_right)
-                        da.to_zarr(fused[:,::step,::step], chan_path, overwrite=True)
-
-                    if self.temporal and len(illum_names) == 1:
-                        with yaspin() as sp:
-                            sp.text = f'Converting full volume for {ch_name} to zarr, please be patient...'
-                            start = time.time()
-                            da.to_zarr(channel_array[:,:,::step,::step], chan_path, overwrite=True)
-                            end = time.time()
-                            print(f'Saved channel {ch_name} in {round(end - start, 3)} seconds')
-
-                    if self.temporal and len(illum_names) == 2:
-                        with yaspin() as sp:
-                            sp.text = f'Fusing two-sided illumination and converting full volume for {ch_name} to zarr, please be patient...'
-                            start = time.time()
-                            fused = da.maximum(channel_array_left, channel_array_right)
-                            da.to_zarr(fused[:,:,::step,::step], chan_path, overwrite=True)
-                            end = time.time()
-                            print(f'Saved channel {ch_name} in {round(end - start, 3)} seconds')
-
-
-
-                # save the max projections for this channel (getting ~16-20s/it which is about as fast as I can do it using fiji)
-                if save_max:
-                    with tqdm(total=len(timepoint_names)) as max_pbar:
-                        max_pbar.set_description('Saving max projections')
-                        if not self.temporal:
-                            if len(illum_names) > 1:
-                                tiff_write(region_save_path / f'{region_name}_{ch_name}_Max.tiff', np.maximum(np.max(channel_array_left, axis=0), np.max(channel_array_right, axis=0)))
-                            if len(illum_names) == 1:
-                                tiff_write(region_save_path / f'{region_name}_{ch_name}_Max.tiff', np.max(channel_array, axis=0))
-                            max_pbar.update(1)
-                        else:
-                            for tp, tp_name in enumerate(timepoint_names):
-                                if len(illum_names) > 1:
-                                    tiff_write(region_save_path / f'{region_name}_{ch_name}_{tp_name}_Max.tiff', np.maximum(np.max(channel_array_left[tp], axis=0), np.max(channel_array_right[tp], axis=0)))
-                                else:
-                                    print(channel_array.shape, tp)
-                                    m = da.max(channel_array[tp], axis=0)
-                                    print(type(m))
-                                    print(f'shape of max projection is {m.shape}')
-                                    print(f'chunk size of max projection is {m.chunksize}')
-                                    #m = np.asarray(m)
-                                    #print(type(m))
-                                    #print(f'shape of max projection is {m.shape}')
-                                    tiff_write(region_save_path / f'{region_name}_{ch_name}_{tp_name}_Max.tiff', m)
-                                max_pbar.update(1)
+                self.save_channel(region_name, ch_name, save_vol=save_vol, save_max=save_max, step=step, chunks=chunks, codec=codec,
+                                  fusion=fusion, region_info=(interval, timepoint_names, channel_names, illum_names, plane_names),
+                                  max_files=max_format != 'hyperstack', hyperstack=hyperstack, memory_mb=memory_mb,
+                                  save_ortho=save_ortho, qc=qc, crop=region_crop, temporal_reductions=temporal_reductions)
+
+            if drift and self.temporal:
+                self.correct_drift(region_name, source='max' if save_max else 'volume')
 
         print(f'done saving regions')
+        self.run_log.summary(self.timer, wall_seconds=time.perf_counter() - start, dir_path=self.file_path)
+        self.timer = StageTimer()
+
+
+    def max_hyperstack(self, region_name, region_info, uneven = 'pad'):
+        '''
+        Describes the max projection hyperstack of a region for save_channel to write into. The file
+        itself is created by the first channel that writes to it, see open_max_hyperstack.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+                    region_info (tuple) - (interval, timepoint_names, channel_names, ...) from get_region_info
+                    uneven (str) - see save_regions
+        Returns: dict with 'path', 'timepoints', 'channels' and 'interval'
+        '''
+        interval, timepoint_names, channel_names = region_info[:3]
+        return {'path': self.file_path / f'{region_name}_processed' / hyperstack_name(region_name),
+                'timepoints': self.hyperstack_timepoints(region_name, timepoint_names, channel_names, uneven),
+                'channels': list(channel_names),
+                'interval': interval}
+
+    def hyperstack_timepoints(self, region_name, timepoint_names, channel_names, uneven = 'pad'):
+        '''
+        The timepoints that go into a region's max projection hyperstack.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+                    timepoint_names, channel_names (list) - from get_region_info
+                    uneven (str) - 'pad' keeps every timepoint, 'trim' only those with complete
+                                   stacks in every channel and tile
+        Returns: list of timepoint names, in hyperstack order
+        '''
+        if uneven == 'pad':
+            return list(timepoint_names)
+        complete = None
+        for ch_name in channel_names:
+            for tile in self.catalog.group_by(('X', 'Y'), R=region_name, C=ch_name):
+                pairs = self.catalog.illumination_pairs(R=region_name, C=ch_name, X=tile[0], Y=tile[1])
+                timepoints = {t for t, _ in pairs}
+                complete = timepoints if complete is None else complete & timepoints
+        kept = [tp_name for tp_name in timepoint_names if field_value('t', tp_name) in (complete or set())]
+        if len(kept) < len(timepoint_names):
+            print(f'Trimming {len(timepoint_names) - len(kept)} timepoint(s) that not every channel has from the hyperstack')
+        return kept
+
+    def find_crop(self, region_name, margin = CROP_MARGIN, step = 8, num_samples = CROP_SAMPLES):
+        '''
+        Finds the bounding box of the sample in a region from strided max projections of a few
+        timepoints of every channel. The box holds the sample at every sampled timepoint, and is
+        snapped to the pyramid's coarsest blocks so every level averages whole blocks of the box.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+                    margin (int) - pixels of background kept around the sample in Y and X
+                    step (int) - the pyramid step, see save_regions
+                    num_samples (int) - timepoints sampled, spread over the timelapse
+        Returns: ((z0, z1), (y0, y1), (x0, x1)) in pixels, None for mosaics or when no sample stands
+                 out of the background
+        '''
+        if len(self.catalog.group_by(('X', 'Y'), R=region_name)) > 1:
+            print(f'{region_name} is a mosaic, not cropping it')
+            return None
+        stack_groups = []
+        for ch_name in self.catalog.tokens('C', R=region_name):
+            pairs = self.catalog.illumination_pairs(R=region_name, C=ch_name)
+            keys = sorted(pairs)
+            stack_groups += [[self.file_path / self.catalog.name(index) for index in pairs[keys[t]]]
+                             for t in sample_timepoints(len(keys), num_samples)]
+        if not stack_groups:
+            return None
+        with self.timer.stage('metadata'):
+            shape, _ = self.index.stack_shape(stack_groups[0][0])
+            voxel_size = self.get_voxel_size(region_name)
+        factors = pyramid_factors(step, voxel_size[1], voxel_size[0])
+        alignment = tuple(max(factor[axis] for factor in factors) for axis in range(3))
+        with self.timer.stage('crop'):
+            crop = find_crop(stack_groups, shape, margin=margin, alignment=alignment)
+        if crop is None:
+            print(f'No sample found in {region_name}, converting the full field')
+            return None
+        kept = np.prod(crop_shape(crop)) / np.prod(shape)
+        print(f'Cropping {region_name} to z {crop[0][0]}:{crop[0][1]}, y {crop[1][0]}:{crop[1][1]}, x {crop[2][0]}:{crop[2][1]} '
+              f'({kept:.0%} of the stack)')
+        return crop
+
+    def open_max_hyperstack(self, region_name, hyperstack, plane_shape, dtype):
+        '''
+        Creates the max projection hyperstack of a region the first time a channel writes to it.
+        Channels converted at once by separate batch jobs may race to create it, so it is built
+        under a temporary name and linked into place only if no other channel got there first.
+        Where the file system has no hard links (exFAT, many SMB shares) it is moved into place
+        instead, under a lock on a hidden file next to it so only the first channel's copy lands.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+                    hyperstack (dict) - 'path', 'timepoints', 'channels' and 'interval', see max_hyperstack
+                    plane_shape (tuple) - (Y, X) of the projections, the canvas shape for mosaics
+                    dtype (np.dtype) - pixel type of the projections
+        Returns: True if the hyperstack takes planes of this shape and type
+        '''
+        path = hyperstack['path']
+        if not path.exists():
+            pixel_size = self.get_voxel_size(region_name)[1] if self.objmag else None
+            handle, tmp_path = tempfile.mkstemp(suffix='.tif', dir=path.parent)
+            os.close(handle)
+            try:
+                create_hyperstack(tmp_path, len(hyperstack['timepoints']), hyperstack['channels'], plane_shape, dtype,
+                                  pixel_size=pixel_size, interval=hyperstack['interval'])
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            except OSError:
+                with open(path.parent / f'.{path.name}.lock', 'a') as handle, locked(handle, exclusive=True):
+                    if not path.exists():
+                        os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        layout = hyperstack_layout(path)
+        expected = (len(hyperstack['timepoints']), len(hyperstack['channels']), *plane_shape)
+        if tuple(layout['shape']) != expected or layout['dtype'] != dtype:
+            print(f'{path.name} holds {layout["dtype"]} planes of {tuple(layout["shape"])}, not {dtype} {expected}, '
+                  f'leaving these projections out of it')
+            return False
+        return True
+
+    def max_timepoints(self, region_name, timepoint_names, channel_names, num_frames):
+        '''
+        The timepoint names of the frames of a region's max projection hyperstack, which has every
+        timepoint unless save_regions trimmed it (uneven = 'trim').
+        '''
+        if num_frames == len(timepoint_names):
+            return list(timepoint_names)
+        return self.hyperstack_timepoints(region_name, timepoint_names, channel_names, 'trim')[:num_frames]
+
+    def correct_drift(self, region_name, ch_name = None, source = None, reference = 'previous', level = None, binning = DRIFT_BIN,
+                      upsample = DRIFT_UPSAMPLE):
+        '''
+        Estimates how a region drifts over the timelapse from one channel by phase correlation of
+        small projections, see drift.py, and records the shifts in {region}_Drift.json and in the
+        attributes of every channel's volume. Nothing is resampled or rewritten: view_volumes and
+        save_preview apply the shifts as they read the data.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+                    ch_name (str) - the channel to register on, the first by default; its shifts are
+                                    used for every channel
+                    source (str) - 'max' correlates binned max projections, which gives Z as well only
+                                   when save_ortho wrote the XZ/YZ projections; 'volume' correlates XY, XZ
+                                   and YZ projections of a level of the channel's volume pyramid; None uses
+                                   the max projections when there are any
+                    reference (str) - 'previous' or 'first', see drift.estimate_drift
+                    level (int) - pyramid level for 'volume', None for the coarsest one binned no more
+                                  than binning in XY
+                    binning (int) - XY binning of the projections
+                    upsample (int) - the shifts are refined to 1/upsample of a correlated pixel
+        Returns: the drift record, None when there is nothing to register
+        '''
+        interval, timepoint_names, channel_names, illum_names, plane_names = self.get_region_info(region_name)
+        ch_name = ch_name or channel_names[0]
+        region_save_path = self.file_path / f'{region_name}_processed'
+        vol_path = region_save_path / f'{region_name}_{ch_name}_volume.zarr'
+        hyperstack_path = region_save_path / hyperstack_name(region_name)
+        layout = hyperstack_layout(hyperstack_path) if hyperstack_path.exists() else None
+        if layout is not None and ch_name in layout['channels']:
+            c = layout['channels'].index(ch_name)
+            max_names = self.max_timepoints(region_name, timepoint_names, channel_names, layout['shape'][0])
+            read_xy = lambda t, tp_name: read_plane(hyperstack_path, t, c, layout=layout)
+        else:
+            paths = {tp_name: region_save_path / f'{region_name}_{ch_name}_{tp_name}_Max.tiff' for tp_name in timepoint_names}
+            max_names = [tp_name for tp_name, path in paths.items() if path.exists()]
+            read_xy = lambda t, tp_name: tiff_read(paths[tp_name])
+        source = source or ('max' if max_names else 'volume')
+        if source not in ('volume', 'max'):
+            raise ValueError(f"source must be 'volume' or 'max', got {source}")
+
+        start = time.perf_counter()
+        with self.timer.stage('drift'):
+            if source == 'volume':
+                if not vol_path.exists():
+                    print(f'No volume found for {region_name} {ch_name}. Please run save_regions(save_vol = True) first.')
+                    return None
+                frames, scale, names = volume_frames(vol_path, timepoint_names, level, binning)
+            else:
+                def read_frame(t, tp_name):
+                    frame = {'xy': binned(read_xy(t, tp_name), binning)}
+                    for axes in ('XZ', 'YZ'):
+                        ortho_path = region_save_path / f'{region_name}_{ch_name}_{tp_name}_Max{axes}.tiff'
+                        frame[axes.lower()] = binned(tiff_read(ortho_path), binning) if ortho_path.exists() else None
+                    return frame
+
+                names = max_names
+                frames = (read_frame(t, tp_name) for t, tp_name in enumerate(names))
+                scale = (binning, binning, binning)
+            if len(names) < 2:
+                print(f'{region_name} {ch_name} has fewer than two timepoints, there is no drift to correct')
+                return None
+            print(f'Estimating the drift of {region_name} over {len(names)} timepoints from the {ch_name} {source}...')
+            shifts, peaks = estimate_drift(frames, scale=scale, reference=reference, upsample=upsample)
+
+            voxel_size = self.get_voxel_size(region_name)
+            record = {'channel': ch_name, 'source': source, 'reference': reference, 'voxel_size': list(voxel_size),
+                      'timepoints': names, 'shifts': [[round(float(value), 3) for value in shift] for shift in shifts],
+                      'peaks': [round(float(peak), 3) for peak in peaks]}
+            write_drift(region_save_path / drift_name(region_name), record)
+            for ch in channel_names:
+                ch_vol_path = region_save_path / f'{region_name}_{ch}_volume.zarr'
+                if ch_vol_path.exists():
+                    annotate_volume(ch_vol_path, record, timepoint_names)
+
+        weak = [tp_name for tp_name, peak in zip(names, peaks) if peak < LOW_PEAK]
+        if weak:
+            print(f'The correlation was weak for {len(weak)} timepoint(s) ({", ".join(weak[:5])}{", ..." if len(weak) > 5 else ""}), '
+                  f'their shifts may be off')
+        largest = np.abs(shifts * np.array(voxel_size)).max(axis=0)
+        print(f'Largest drift z {largest[0]:.2f} um, y {largest[1]:.2f} um, x {largest[2]:.2f} um, '
+              f'estimated in {round(time.perf_counter() - start, 3)} seconds')
+        return record
+
+    def save_channel(self, region_name, ch_name, save_vol = False, save_max = True, step = 8, num_workers = None, region_info = None,
+                     chunks = DEFAULT_CHUNKS, codec = DEFAULT_CODEC, fusion = None, mosaic = True, max_files = True, hyperstack = None,
+                     read_ahead = READ_AHEAD, memory_mb = PLANE_MEMORY_MB, save_ortho = False, qc = False, crop = None,
+                     temporal_reductions = None):
+        '''
+        Converts one channel of one region, the unit of work that save_regions and the batch driver
+        are built from. The region folder is created if needed and existing outputs are replaced.
+        Parameters: region_name (str) - the region to convert, e.g. 'R0000'
+                    ch_name (str) - the channel to convert, e.g. 'C01'
+                    save_vol, save_max, step, chunks, codec, fusion, memory_mb, save_ortho, qc - see save_regions
+                    crop - None, 'auto' or a ((z0, z1), (y0, y1), (x0, x1)) box, see save_regions
+                    temporal_reductions (tuple) - see save_regions
+                    num_workers (int) - number of timepoints converted at once, None for the default (the
+                                        dask default with a Client, the number of CPUs without)
+                    read_ahead (int) - slabs of planes read ahead of each timepoint's conversion when no
+                                       Client is running, see pipeline.PlaneReader
+                    region_info (tuple) - the output of get_region_info, looked up when not given
+                    mosaic (bool) - blend multi-tile regions into a mosaic after converting the tiles,
+                                    see save_mosaic; the tile outputs are kept
+                    max_files (bool) - write a max projection TIFF per timepoint; the tiles of a
+                                       mosaic always get them, they are what the mosaic is blended from
+                    hyperstack (dict) - the region's max projection hyperstack to write into, see
+                                        save_regions, None to skip
+        Returns: dict of the outputs written, {'max': [paths], 'vol': [path], 'ortho': [paths], 'qc': [path],
+                 'temporal': [paths]}
+        '''
+        if region_info is None:
+            with self.timer.stage('metadata'):
+                region_info = self.get_region_info(region_name)
+        interval, timepoint_names, channel_names, illum_names, plane_names = region_info
+        region_save_path = self.file_path / f'{region_name}_processed'
+        Path.mkdir(region_save_path, parents=True, exist_ok=True)
+        outputs = {'max': [], 'vol': [], 'ortho': [], 'qc': [], 'temporal': []}
+        fusion = fusion or default_reducer(ch_name)
+        if len(illum_names) == 2:
+            print(f'two-sided illumination detected, fusing I0 and I1 with {fusion} while streaming')
+
+        # pair up the illumination sides of every tile and timepoint, skipping incomplete timepoints;
+        # multi-tile regions get per-tile outputs that are blended into a mosaic afterwards
+        tiles = list(self.catalog.group_by(('X', 'Y'), R=region_name, C=ch_name))
+        write_files = save_max and (max_files or hyperstack is None or len(tiles) > 1)
+        stack_timepoints = {}
+        if hyperstack is not None and len(tiles) == 1:
+            stack_timepoints = {tp_name: t for t, tp_name in enumerate(hyperstack['timepoints'])}
+        tile_jobs = {}
+        jobs = []
+        job_tiles = []
+        for tile in tiles:
+            tile_name = f'_{token("X", tile[0])}_{token("Y", tile[1])}' if len(tiles) > 1 else ''
+            pairs = self.catalog.illumination_pairs(R=region_name, C=ch_name, X=tile[0], Y=tile[1])
+            tile_jobs[tile] = {}
+            for tp_name in timepoint_names:
+                stack_indices = pairs.get((field_value('t', tp_name), field_value('C', ch_name)))
+                if stack_indices is None:
+                    print(f'{tp_name}{tile_name} is missing an illumination side for {ch_name}, skipping')
+                    continue
+                stack_paths = [self.file_path / self.catalog.name(index) for index in stack_indices]
+                if self.temporal:
+                    max_path = region_save_path / f'{region_name}{tile_name}_{ch_name}_{tp_name}_Max.tiff'
+                else:
+                    max_path = region_save_path / f'{region_name}{tile_name}_{ch_name}_Max.tiff'
+                job = {'stack_paths': stack_paths, 'max_path': max_path if write_files else None, 'fusion': fusion}
+                if tp_name in stack_timepoints:
+                    job['hyperstack'] = (hyperstack['path'], stack_timepoints[tp_name], hyperstack['channels'].index(ch_name))
+                elif not write_files and not save_vol and len(tiles) == 1:
+                    continue # trimmed from the hyperstack and nothing else to write
+                if save_ortho:
+                    job['ortho_paths'] = tuple(max_path.with_name(max_path.name.replace('_Max.tiff', f'_Max{axes}.tiff'))
+                                               for axes in ('XZ', 'YZ'))
+                    outputs['ortho'] += job['ortho_paths']
+                if qc:
+                    job['qc'] = True
+                tile_jobs[tile][tp_name] = job
+                jobs.append(job)
+                job_tiles.append(f'{token("X", tile[0])}_{token("Y", tile[1])}')
+                if write_files:
+                    outputs['max'].append(max_path)
+
+        if not jobs:
+            print(f'No complete stacks found for {ch_name}, skipping')
+            return outputs
+
+        if crop is not None and len(tiles) > 1:
+            print(f'{region_name} is a {len(tiles)} tile mosaic, converting the full field of every tile instead of cropping')
+            crop = None
+        elif isinstance(crop, str) and crop == 'auto':
+            crop = self.find_crop(region_name, step=step)
+        with self.timer.stage('metadata'):
+            shape, dtype = self.index.stack_shape(jobs[0]['stack_paths'][0])
+        if crop is not None:
+            crop = check_crop(crop, shape)
+            shape = crop_shape(crop)
+            for job in jobs:
+                job['crop'] = crop
+
+        if stack_timepoints:
+            with self.timer.stage('metadata'):
+                if self.open_max_hyperstack(region_name, hyperstack, shape[1:], dtype):
+                    outputs['max'].append(hyperstack['path'])
+                else:
+                    for job in jobs:
+                        job.pop('hyperstack', None)
+
+        # create the pyramids up front so every timepoint can write into them in parallel
+        if save_vol:
+            with self.timer.stage('metadata'):
+                voxel_size = self.get_voxel_size(region_name)
+            factors = pyramid_factors(step, voxel_size[1], voxel_size[0])
+            timestamps = self.get_timestamps(region_name) if self.temporal else {}
+            for tile, tp_jobs in tile_jobs.items():
+                tile_name = f'_{token("X", tile[0])}_{token("Y", tile[1])}' if len(tiles) > 1 else ''
+                chan_path = region_save_path / f'{region_name}{tile_name}_{ch_name}_volume.zarr'
+                root = create_pyramid(chan_path, len(tp_jobs) if self.temporal else None, shape, dtype, factors, voxel_size,
+                                      interval=interval, chunks=chunks, codec=codec, name=f'{region_name}{tile_name}_{ch_name}', crop=crop)
+                root.attrs['timepoints'] = list(tp_jobs)
+                if timestamps:
+                    root.attrs['timestamps'] = {str(tp): timestamps[tp_name].isoformat() for tp, tp_name in enumerate(tp_jobs) if tp_name in timestamps}
+                for tp, job in enumerate(tp_jobs.values()):
+                    job['vol_path'] = chan_path
+                    job['tp'] = tp if self.temporal else None
+                outputs['vol'].append(chan_path)
+
+        # the reductions over time are updated by every timepoint as it is converted
+        projection_reductions = volume_reductions = None
+        if temporal_reductions and len(tiles) > 1:
+            print(f'{region_name} is a mosaic, temporal reductions are only computed for single tile regions')
+        elif temporal_reductions:
+            projection_reductions = TemporalAccumulator(shape[1:], dtype, temporal_reductions)
+            if save_vol:
+                volume_reductions = TemporalAccumulator(shape, dtype, temporal_reductions, state_dtype=np.float32,
+                                                        state_dir=region_save_path / f'.{region_name}_{ch_name}_temporal_state')
+            for t, job in enumerate(tile_jobs[tiles[0]].values()):
+                job['temporal'] = (t, projection_reductions, volume_reductions)
+
+        self.index.save()
+
+        # one read per stack produces the fusion, the max projection and the volume
+        print(f'Converting {len(jobs)} timepoint(s) for {ch_name}, please be patient...')
+        channel_timer = StageTimer()
+        start = time.perf_counter()
+        qc_records = []
+        with self.run_log.task_stream() as task_stream:
+            results = convert_timepoints(jobs, num_workers=num_workers, read_ahead=read_ahead, memory_mb=memory_mb)
+            for job, tile_name, stats in zip(jobs, job_tiles, results):
+                channel_timer.merge(stats)
+                qc_records += [(stack_keys(path, tile=tile_name), stack_stats) for path, stack_stats in zip(job['stack_paths'], stats.get('qc', []))]
+        if qc_records:
+            with channel_timer.stage('write'):
+                qc_path = region_save_path / qc_name(region_name)
+                write_qc(qc_path, qc_records)
+            outputs['qc'].append(qc_path)
+        if projection_reductions is not None:
+            with channel_timer.stage('write'):
+                outputs['temporal'] += projection_reductions.write_images(
+                    lambda reduction: region_save_path / f'{region_name}_{ch_name}_{temporal_name(reduction)}.tiff')
+        if volume_reductions is not None:
+            outputs['temporal'] += volume_reductions.write_volumes(
+                lambda reduction: region_save_path / f'{region_name}_{ch_name}_{temporal_name(reduction)}_volume.zarr',
+                factors, voxel_size, chunks=chunks, codec=codec, crop=crop, timer=channel_timer)
+            volume_reductions.close()
+        seconds = time.perf_counter() - start
+        self.timer.merge(channel_timer)
+        self.run_log.record('channel', channel_timer, dir_path=self.file_path, region=region_name, channel=ch_name,
+                            timepoints=len(jobs), wall_seconds=seconds, task_stream=task_stream or None)
+        print(f'Saved channel {ch_name} in {round(seconds, 3)} seconds')
+
+        if mosaic and len(tiles) > 1:
+            mosaics = self.save_mosaic(region_name, ch_name, tile_jobs, interval=interval, chunks=chunks, codec=codec,
+                                       max_files=max_files or hyperstack is None, hyperstack=hyperstack)
+            outputs['max'] += mosaics['max']
+            outputs['vol'] += mosaics['vol']
+        return outputs
+
+    def save_mosaic(self, region_name, ch_name, tile_jobs, interval = 0, chunks = DEFAULT_CHUNKS, codec = DEFAULT_CODEC, overlap = DEFAULT_OVERLAP,
+                    max_files = True, hyperstack = None):
+        '''
+        Blends the converted tiles of a channel into one mosaic per timepoint. Tiles are placed by
+        the stage positions in their settings files (or on a grid with the given overlap when the
+        files do not record them) and blended linearly where they overlap. Only timepoints every
+        tile has are mosaicked. Volumes are blended at full resolution into a pyramid with the same
+        levels as the tiles'. The per-tile projections and volumes are kept.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+                    ch_name (str) - the channel, e.g. 'C01'
+                    tile_jobs (dict) - (X, Y) -> {tp_name: convert_timepoint job}, as built by save_channel
+                    interval, chunks, codec - see save_regions
+                    overlap (float) - fraction of a tile shared with its neighbours, without stage positions
+                    max_files, hyperstack - where the mosaic projections go, see save_channel
+        Returns: dict of the mosaics written, {'max': [paths], 'vol': [path]}
+        '''
+        region_save_path = self.file_path / f'{region_name}_processed'
+        outputs = {'max': [], 'vol': []}
+        tp_names = [tp_name for tp_name in next(iter(tile_jobs.values())) if all(tp_name in jobs for jobs in tile_jobs.values())]
+        if not tp_names:
+            print(f'No timepoint has every tile of {ch_name}, skipping the mosaic')
+            return outputs
+
+        with self.timer.stage('metadata'):
+            positions = {}
+            for tile in tile_jobs:
+                settings = self.settings_catalog.select(R=region_name, X=tile[0], Y=tile[1])
+                position = self.index.settings(self.settings_catalog.name(settings[0]))['position'] if len(settings) else None
+                if position is not None:
+                    positions[tile] = tuple(position)
+            first_job = tile_jobs[next(iter(tile_jobs))][tp_names[0]]
+            tile_shape, _ = self.index.stack_shape(first_job['stack_paths'][0])
+            voxel_size = self.get_voxel_size(region_name)
+            self.index.save()
+        offsets, canvas_shape = tile_offsets(list(tile_jobs), positions, tile_shape[1:], voxel_size[1], overlap=overlap)
+        ramp = overlap_widths(offsets, tile_shape[1:])
+        print(f'Blending {len(tile_jobs)} tiles of {ch_name} into a {canvas_shape[1]} x {canvas_shape[0]} mosaic')
+
+        with self.timer.stage('mosaic'):
+            if first_job['max_path'] is not None:
+                weights = tile_weights(tile_shape[1:], ramp)
+                stack_timepoints = {}
+                if hyperstack is not None and self.open_max_hyperstack(region_name, hyperstack, canvas_shape, tiff_read(first_job['max_path']).dtype):
+                    stack_timepoints = {tp_name: t for t, tp_name in enumerate(hyperstack['timepoints'])}
+                    outputs['max'].append(hyperstack['path'])
+                for tp_name in tp_names:
+                    max_path = None
+                    if max_files and self.temporal:
+                        max_path = region_save_path / f'{region_name}_{ch_name}_{tp_name}_Max.tiff'
+                    elif max_files:
+                        max_path = region_save_path / f'{region_name}_{ch_name}_Max.tiff'
+                    plane = None
+                    if tp_name in stack_timepoints:
+                        plane = (hyperstack['path'], stack_timepoints[tp_name], hyperstack['channels'].index(ch_name))
+                    if max_path is None and plane is None:
+                        continue
+                    mosaic_projection({tile: jobs[tp_name]['max_path'] for tile, jobs in tile_jobs.items()},
+                                      offsets, canvas_shape, weights, out_path=max_path, hyperstack=plane)
+                    if max_path is not None:
+                        outputs['max'].append(max_path)
+
+            if 'vol_path' in first_job:
+                vol_path = region_save_path / f'{region_name}_{ch_name}_volume.zarr'
+                tile_volumes = {tile: (jobs[tp_names[0]]['vol_path'], {out_tp: jobs[tp_name]['tp'] for out_tp, tp_name in enumerate(tp_names)})
+                                for tile, jobs in tile_jobs.items()}
+                mosaic_volume(tile_volumes, offsets, canvas_shape, tile_shape, ramp, vol_path, voxel_size, interval=interval,
+                              chunks=chunks, codec=codec, name=f'{region_name}_{ch_name}')
+                outputs['vol'].append(vol_path)
+        return outputs
+
+    def watch(self, save_vol = True, save_max = True, step = 8, poll_interval = 5, idle_timeout = 600, settle_time = 10, max_format = 'both',
+              temporal_reductions = None):
+        '''
+        Live mode. Converts timepoints while the microscope is still acquiring, as soon as all of a
+        timepoint's channel/illumination stacks have been written, instead of waiting for the whole
+        acquisition to finish.
+        Parameters: save_vol, save_max, step, max_format, temporal_reductions - see save_regions
+                    poll_interval (float) - seconds between looks at the folder
+                    idle_timeout (float) - stop once no new stack has appeared for this many seconds
+                    settle_time (float) - seconds a stack must go unmodified before it is read
+        Returns: None
+        '''
+        converter = LiveConverter(self, save_vol=save_vol, save_max=save_max, step=step, settle_time=settle_time, max_format=max_format,
+                                  temporal_reductions=temporal_reductions)
+        start = time.perf_counter()
+        for region_name, t, converted in converter.watch(poll_interval=poll_interval, idle_timeout=idle_timeout):
+            print(f'Converted {region_name} timepoint {t} ({len(converted)} channel(s))')
+        print(f'done watching {self.file_path}')
+        self.run_log.summary(self.timer, wall_seconds=time.perf_counter() - start, dir_path=self.file_path)
+        self.timer = StageTimer()
+
+    def view_live(self, region, save_vol = False, poll_interval = 5, idle_timeout = 600, settle_time = 10):
+        '''
+        Runs the live mode in the background and shows the max projections of a region in napari,
+        adding each timepoint as soon as it has been converted.
+        Parameters: region (str) - the region to show, e.g. 'R0000'
+                    save_vol, poll_interval, idle_timeout, settle_time - see watch
+        '''
+        from napari.qt.threading import thread_worker
+
+        converter = LiveConverter(self, save_vol=save_vol, save_max=True, settle_time=settle_time)
+        viewer = napari.Viewer(title="Live Kkpo Viewer")
+        projections = {}
+
+        def add_timepoint(event):
+            region_name, t, converted = event
+            if region_name != region:
+                return
+            for ch_name, max_path in converted:
+                projections.setdefault(ch_name, []).append(tiff_read(max_path))
+                stack = np.stack(projections[ch_name])
+                if ch_name in viewer.layers:
+                    viewer.layers[ch_name].data = stack
+                else:
+                    viewer.add_image(stack, name=ch_name, blending='additive')
+            viewer.dims.set_point(0, len(next(iter(projections.values()))) - 1)
+
+        worker = thread_worker(converter.watch)(poll_interval=poll_interval, idle_timeout=idle_timeout)
+        worker.yielded.connect(add_timepoint)
+        worker.start()
+        napari.run()
+
+    def save_preview(self, region_name, out_path = None, luts = None, limits = None, scale = 0.5, fps = 10, scale_bar = True,
+                     timestamp = True, num_threads = None, drift = True):
+        '''
+        Renders a preview movie of a region from the max projections written by save_regions (the
+        region hyperstack when there is one, the per-timepoint TIFFs otherwise), with the channels
+        composited in colour, a scale bar and the elapsed time burnt in.
+        Parameters: region_name (str) - the region, e.g. 'R0000'
+                    out_path (str/Path) - .mp4 (needs imageio-ffmpeg) or .tif for an animated TIFF,
+                                          by default {region}_preview.mp4 in the region folder
+                    luts (list) - LUT per channel, see preview.LUTS, the FlamingoConverter.ijm defaults when None
+                    limits (list) - (low, high) display limits per channel, picked automatically when None
+                    scale (float) - output size relative to the projections
+                    fps (float) - frames per second
+                    scale_bar, timestamp (bool) - what to burn in
+                    num_threads (int) - frames rendered at once, None for the number of CPUs
+                    drift (bool) - shift every frame by the drift recorded by correct_drift, when there is one
+        Returns: Path of the movie
+        '''
+        with self.timer.stage('metadata'):
+            interval, timepoint_names, channel_names, illum_names, plane_names = self.get_region_info(region_name)
+            pixel_size = self.get_voxel_size(region_name)[1] if self.objmag else None
+        region_save_path = self.file_path / f'{region_name}_processed'
+        hyperstack_path = region_save_path / hyperstack_name(region_name)
+        channel_paths = []
+        reader = tiff_read
+        if hyperstack_path.exists():
+            # frames are read straight out of the hyperstack, a plane at a time
+            layout = hyperstack_layout(hyperstack_path)
+            channel_paths = [[(t, c) for t in range(layout['shape'][0])] for c in range(layout['shape'][1])]
+            reader = lambda plane: read_plane(hyperstack_path, *plane, layout=layout)
+            interval = layout['interval'] or interval
+            frame_names = self.max_timepoints(region_name, timepoint_names, channel_names, layout['shape'][0])
+            frame_name = lambda plane: frame_names[plane[0]]
+        else:
+            frame_names = {}
+            frame_name = frame_names.get
+            for ch_name in channel_names:
+                if self.temporal:
+                    paths = [region_save_path / f'{region_name}_{ch_name}_{tp_name}_Max.tiff' for tp_name in timepoint_names]
+                    frame_names.update(zip(paths, timepoint_names))
+                else:
+                    paths = [region_save_path / f'{region_name}_{ch_name}_Max.tiff']
+                paths = [path for path in paths if path.exists()]
+                if paths:
+                    channel_paths.append(paths)
+                else:
+                    print(f'No max projections found for {ch_name}, leaving it out of the preview')
+        if not channel_paths:
+            print(f'No max projections found for region {region_name}. Please run save_regions(save_max = True) first.')
+            return None
+        record = read_drift(region_save_path / drift_name(region_name)) if drift else None
+        if record is not None:
+            # the frames are registered as they are read, the projections on disk stay as they are
+            read_frame = reader
+            reader = lambda frame: shift_image(read_frame(frame), timepoint_shift(record, frame_name(frame))[1:])
+            print(f'Correcting the drift recorded from {record["channel"]}')
+
+        out_path = Path(out_path) if out_path else region_save_path / f'{region_name}_preview.mp4'
+        print(f'Rendering a {min(len(paths) for paths in channel_paths)} frame preview of region {region_name}...')
+        start = time.perf_counter()
+        render_preview(channel_paths, out_path, luts=luts, limits=limits, scale=scale, pixel_size=pixel_size, interval=interval,
+                       fps=fps, scale_bar=scale_bar, timestamp=timestamp, num_threads=num_threads, reader=reader)
+        print(f'Saved {out_path} in {round(time.perf_counter() - start, 3)} seconds')
+        return out_path
+
+    def benchmark_storage(self, region_name, ch_name, num_timepoints = 2, out_dir = None, profiles = None):
+        '''
+        Benchmarks every chunk/codec profile on real stacks of this acquisition and reports write
+        throughput, compression ratio and random XY/XZ read latency.
+        Parameters: region_name (str) - region to sample, e.g. 'R0000'
+                    ch_name (str) - channel to sample, e.g. 'C01'
+                    num_timepoints (int) - number of stacks to write per profile
+                    out_dir (str/Path) - scratch folder, by default inside the acquisition folder
+                    profiles (list) - (chunk profile, codec profile) pairs, every combination by default
+        Returns: list of result dicts, see storage.benchmark_profiles
+        '''
+        indices = self.catalog.select(R=region_name, C=ch_name, I=self.catalog.values('I', R=region_name)[0])[:num_timepoints]
+        stack_paths = [self.file_path / self.catalog.name(index) for index in indices]
+        out_dir = out_dir or self.file_path / 'storage_benchmark'
+        return benchmark_profiles(stack_paths, out_dir, profiles=profiles)
+
+    def archive(self, out_dir = None, codec = ARCHIVE_CODEC, num_workers = None, delete_originals = False):
+        '''
+        Re-encodes every raw stack losslessly into compressed zarr stacks, see archive.py. Archived
+        stacks keep their names (with a .zarr suffix) and the settings files are kept, so a Kkpo
+        opened on the archive works exactly like one opened on the originals.
+        Parameters: out_dir (str/Path) - where to write the archive, None to archive in place
+                    codec (str) - lossless codec profile, see storage.CODEC_PROFILES
+                    num_workers (int) - stacks archived at once in separate processes, None for one per CPU
+                    delete_originals (bool) - delete each original once its archive is verified against
+                                              it; archiving in place needs this
+        Returns: the archive manifest, see archive.archive_acquisition
+        '''
+        manifest = archive_acquisition(self.file_path, out_dir=out_dir, codec=codec, num_workers=num_workers,
+                                       delete_originals=delete_originals)
+        self.refresh()
+        return manifest
+
+    def view_raw(self, region, tile = None, projection = False, fusion = None, cache_mb = CACHE_MB, prefetch = PREFETCH, num_threads = 4):
+        '''
+        Shows a region straight from the raw stacks, with no conversion pass. Each channel is a lazy
+        (T, Z, Y, X) array whose planes are read and fused only when they are on screen, kept in an
+        LRU cache, and whose neighbouring timepoints and planes are prefetched in the background.
+        Parameters: region (str) - the region to show, e.g. 'R0000'
+                    tile (tuple) - (X, Y) tile of a multi-tile region, the first tile by default
+                    projection (bool) - show fused max projections (T, Y, X) instead of planes
+                    fusion (str) - see save_regions, None picks per channel
+                    cache_mb (float) - memory for cached planes and projections, shared by the channels
+                    prefetch (int) - timepoints/planes read ahead on either side of the one shown
+                    num_threads (int) - prefetching threads
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        interval, timepoint_names, channel_names, illum_names, plane_names = self.get_region_info(region)
+        voxel_size = self.get_voxel_size(region)
+        tiles = list(self.catalog.group_by(('X', 'Y'), R=region))
+        tile = tuple(tile) if tile is not None else tiles[0]
+        if len(tiles) > 1:
+            print(f'Region {region} has {len(tiles)} tiles, showing tile {tile}')
+        cache = LRUCache(max_bytes=cache_mb * 2**20)
+        executor = ThreadPoolExecutor(max_workers=num_threads)
+
+        viewer = napari.Viewer(title="Raw Kkpo Viewer")
+        for ch_name in channel_names:
+            pairs = self.catalog.illumination_pairs(R=region, C=ch_name, X=tile[0], Y=tile[1])
+            stack_paths = []
+            for tp_name in timepoint_names:
+                indices = pairs.get((field_value('t', tp_name), field_value('C', ch_name)))
+                stack_paths.append([self.file_path / self.catalog.name(index) for index in indices] if indices is not None else None)
+            first = next((paths for paths in stack_paths if paths is not None), None)
+            if first is None:
+                print(f'No complete stacks found for {ch_name}, leaving it out')
+                continue
+            shape, dtype = self.index.stack_shape(first[0])
+            channel = LazyChannel(stack_paths, shape, dtype, fusion=fusion or default_reducer(ch_name), projection=projection,
+                                  cache=cache, executor=executor, prefetch=prefetch)
 
+            # contrast from a few frames spread over the acquisition: middle planes, or when projecting
+            # a few planes spread through each stack rather than whole projections
+            samples = [(t,) if projection else (t, shape[0] // 2) for t, paths in enumerate(stack_paths) if paths is not None]
+            reader = (lambda index: channel.sample_projection(index[0])) if projection else channel.read
+            limits = contrast_limits(samples, reader=reader)
+            scale = (interval or 1, *voxel_size[1:]) if projection else (interval or 1, *voxel_size)
+            viewer.add_image(channel, name=f'Region {region}, {ch_name}', scale=scale, contrast_limits=limits, blending='additive')
+        self.index.save()
+        napari.run()
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    def view_volumes(self, region):
+    def view_volumes(self, region, drift = True):
         ''' 
         Dask/Napari interactive workflow
+        Parameters: region (str) - the region to show, e.g. 'R0000'
+                    drift (bool) - apply the drift recorded by correct_drift, lazily as the volumes are read
         '''
         # check for volume data
         region_save_path = self.file_path / f'{region}_processed'
         interval, timepoint_names, channel_names, illum_names, plane_names = self.get_region_info(region)
         volume_names = [f'{region}_{ch}_volume.zarr' for ch in channel_names]
         if not all(os.path.exists(region_save_path / volume_name) for volume_name in volume_names):
-            print(f'One or more channels for region {region} have not been processed. Please run save_regions(save_vol = True) before trying to interact with saved volumes.')
+            print(f'One or more channels for region {region} have not been processed. Please run save_regions(save_vol = True) before trying to interact with saved volumes, or view_raw to look at the raw stacks.')
 
-        channels = [da.from_zarr(region_save_path / f'{region}_{ch}_volume.zarr') for ch in channel_names]
+        channels = [(open_registered if drift else open_pyramid)(region_save_path / f'{region}_{ch}_volume.zarr') for ch in channel_names]
 
+        # napari picks the pyramid level to load from the zoom, so full resolution is only read where it is visible
         viewer = napari.Viewer(title="Interactive Kkpo Viewer")
-        for chan_num, channel in enumerate(channels):
-            viewer.add_image(channel, name=f'Region {region}, Ch {chan_num+1}', contrast_limits=[0, 20000], blending='additive') # T, Z, X, Y)
-        napari.run()
\ No newline at end of file
+        for chan_num, (levels, scales) in enumerate(channels):
+            # contrast from the coarsest level, which is small enough to sample whole volumes of
+            coarsest = levels[-1]
+            samples = list(range(coarsest.shape[0])) if coarsest.ndim == 4 else [None]
+            limits = contrast_limits(samples, reader=lambda t: np.asarray(coarsest[t] if t is not None else coarsest))
+            viewer.add_image(levels, multiscale=True, scale=scales[0], name=f'Region {region}, Ch {chan_num+1}', contrast_limits=limits, blending='additive') # T, Z, Y, X)
+        napari.run()
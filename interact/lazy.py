@@ -0,0 +1,228 @@
+'''
+Lazy viewing of raw acquisitions. Each channel of a region is opened as a (T, Z, Y, X) array-like
+that reads and fuses the illumination/detection sides of a plane only when napari asks for it.
+Fused planes and projections are kept in a bounded LRU cache and the neighbouring timepoints and
+planes are prefetched on a thread pool while the current one is on screen, so a fresh acquisition
+can be scrubbed through without a conversion pass.
+'''
+import threading
+import numpy as np
+from collections import OrderedDict
+from interact.readers import open_stack
+from interact.fusion import Fuser, DEFAULT_REDUCER
+from interact.engine import illumination_sides
+
+CACHE_MB = 1024 # fused planes and projections kept in memory, shared by every channel
+PREFETCH = 2 # timepoints and planes read ahead on either side of the one on screen
+OPEN_STACKS = 32 # stacks kept open at once
+DECODED_MB = 2048 # memory for stacks that had to be decoded whole; mapped and zarr stacks hold none
+CONTRAST_PLANES = 8 # planes spread through a stack that stand in for its projection when picking contrast
+
+
+def held_bytes(stack):
+    '''
+    Memory an open stack holds: nothing for memory-mapped and zarr stacks, which are read as they
+    are sliced, the whole stack for decoded ones.
+    '''
+    return stack.nbytes if type(stack) is np.ndarray else 0
+
+
+class LRUCache:
+    '''
+    Thread-safe least recently used cache, bounded by the total bytes of the arrays it holds and/or
+    by the number of entries.
+    '''
+
+    def __init__(self, max_bytes=None, max_items=None, size=None):
+        '''
+        Parameters: max_bytes (int) - bytes held, None for no limit
+                    max_items (int) - entries held, None for no limit
+                    size (callable) - bytes an entry holds, its nbytes by default
+        '''
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.size = size or (lambda value: getattr(value, 'nbytes', 0))
+        self.items = OrderedDict()
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.num_bytes -= self.size(self.items.pop(key))
+            self.items[key] = value
+            self.num_bytes += self.size(value)
+            while len(self.items) > 1 and ((self.max_bytes is not None and self.num_bytes > self.max_bytes) or
+                                           (self.max_items is not None and len(self.items) > self.max_items)):
+                _, evicted = self.items.popitem(last=False)
+                self.num_bytes -= self.size(evicted)
+        return value
+
+
+class LazyChannel:
+    '''
+    One channel of a region as a (T, Z, Y, X) array, or (T, Y, X) max projections, that napari
+    can slice like a numpy array. Only the requested planes are read and fused.
+    '''
+
+    def __init__(self, stack_paths, stack_shape, dtype, fusion=DEFAULT_REDUCER, projection=False, cache=None, executor=None,
+                 prefetch=PREFETCH):
+        '''
+        Parameters: stack_paths (list) - per timepoint, the aligned stack paths of every side, or
+                                         None where the timepoint is incomplete (shown black)
+                    stack_shape (tuple) - (Z, Y, X) of a stack
+                    dtype (np.dtype) - pixel type
+                    fusion (str) - reducer from fusion.REDUCERS
+                    projection (bool) - show max projections over Z instead of planes
+                    cache (LRUCache) - where fused planes and projections are kept, shareable
+                                       between channels; a private CACHE_MB cache by default
+                    executor (ThreadPoolExecutor) - runs the prefetching, None to not prefetch
+                    prefetch (int) - timepoints/planes read ahead on either side
+        '''
+        self.stack_paths = stack_paths
+        self.stack_shape = tuple(stack_shape)
+        self.dtype = np.dtype(dtype)
+        self.projection = projection
+        self.shape = (len(stack_paths), *self.stack_shape[1:]) if projection else (len(stack_paths), *self.stack_shape)
+        self.ndim = len(self.shape)
+        self.cache = cache if cache is not None else LRUCache(max_bytes=CACHE_MB * 2**20)
+        self.stacks = LRUCache(max_bytes=DECODED_MB * 2**20, max_items=OPEN_STACKS, size=held_bytes)
+        self.executor = executor
+        self.prefetch = prefetch
+        self.pending = set()
+        self.lock = threading.Lock()
+        first = next((paths for paths in stack_paths if paths is not None), None)
+        self.illuminations = illumination_sides(first) if first is not None else None
+        self.fusion = fusion
+        self.fusers = threading.local() # Fuser buffers are reused every call, so each thread gets its own
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[(slice(None),) * self.ndim]
+        return array.astype(dtype) if dtype is not None else array
+
+    def stack(self, path):
+        stack = self.stacks.get(path)
+        if stack is None:
+            stack = self.stacks.put(path, open_stack(path))
+        return stack
+
+    def fuse(self, planes):
+        if len(planes) == 1:
+            return np.array(planes[0])
+        fuser = getattr(self.fusers, 'fuser', None)
+        if fuser is None:
+            fuser = self.fusers.fuser = Fuser(self.fusion, planes[0].shape, self.dtype, illuminations=self.illuminations)
+        return fuser.fuse(planes).copy()
+
+    def plane(self, t, z):
+        '''
+        The fused plane z of timepoint t, from the cache when possible.
+        '''
+        key = (id(self), t, z)
+        plane = self.cache.get(key)
+        if plane is None:
+            paths = self.stack_paths[t]
+            if paths is None:
+                plane = np.zeros(self.stack_shape[1:], self.dtype)
+            else:
+                plane = self.fuse([self.stack(path)[z] for path in paths])
+            self.cache.put(key, plane)
+        return plane
+
+    def max_projection(self, t):
+        '''
+        The max projection of the fused stack of timepoint t, from the cache when possible.
+        '''
+        key = (id(self), t, 'max')
+        projection = self.cache.get(key)
+        if projection is None:
+            projection = np.zeros(self.stack_shape[1:], self.dtype)
+            if self.stack_paths[t] is not None:
+                stacks = [self.stack(path) for path in self.stack_paths[t]]
+                for z in range(self.stack_shape[0]):
+                    np.maximum(projection, self.fuse([stack[z] for stack in stacks]), out=projection)
+            self.cache.put(key, projection)
+        return projection
+
+    def sample_projection(self, t, num_planes=CONTRAST_PLANES):
+        '''
+        A cheap stand-in for the max projection of timepoint t, over num_planes planes spread
+        through the stack, for picking contrast limits without reading whole stacks. The real
+        projection is returned when it is already cached.
+        '''
+        projection = self.cache.get((id(self), t, 'max'))
+        if projection is not None:
+            return projection
+        planes = np.unique(np.linspace(0, self.stack_shape[0] - 1, min(num_planes, self.stack_shape[0])).round().astype(int))
+        return np.max([self.plane(t, int(z)) for z in planes], axis=0)
+
+    def read(self, index):
+        return self.max_projection(index[0]) if self.projection else self.plane(*index)
+
+    def prefetch_around(self, index):
+        '''
+        Queues the neighbouring timepoints (and planes) of index on the executor, nearest first.
+        '''
+        if self.executor is None:
+            return
+        neighbours = []
+        for step in range(1, self.prefetch + 1):
+            for sign in (1, -1):
+                neighbours.append((index[0] + sign * step, *index[1:]))
+                if not self.projection:
+                    neighbours.append((index[0], index[1] + sign * step))
+        for neighbour in neighbours:
+            if not all(0 <= i < size for i, size in zip(neighbour, self.shape)):
+                continue
+            key = (id(self), neighbour[0], 'max' if self.projection else neighbour[1])
+            with self.lock:
+                if key in self.pending or key in self.cache:
+                    continue
+                self.pending.add(key)
+            self.executor.submit(self._prefetch, neighbour, key)
+
+    def _prefetch(self, index, key):
+        try:
+            self.read(index)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def __getitem__(self, key):
+        '''
+        Numpy-style indexing with integers and slices, e.g. [t, z] or [t, z, 100:200, :].
+        '''
+        key = key if isinstance(key, tuple) else (key,)
+        if any(item is Ellipsis for item in key):
+            at = key.index(Ellipsis)
+            key = key[:at] + (slice(None),) * (self.ndim - len(key) + 1) + key[at + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        leading = self.ndim - 2
+        ranges = []
+        for item, size in zip(key[:leading], self.shape[:leading]):
+            if isinstance(item, (int, np.integer)):
+                ranges.append([int(item) % size])
+            else:
+                ranges.append(range(*item.indices(size)))
+        indices = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, leading) if all(len(r) for r in ranges) else []
+        planes = [self.read(tuple(int(i) for i in index))[key[-2:]] for index in indices]
+        if len(indices) == 1:
+            self.prefetch_around(tuple(int(i) for i in indices[0]))
+        out_shape = [len(r) for item, r in zip(key[:leading], ranges) if not isinstance(item, (int, np.integer))]
+        if not planes:
+            return np.zeros((*out_shape, *np.empty(self.stack_shape[1:], bool)[key[-2:]].shape), self.dtype)
+        return np.stack(planes).reshape((*out_shape, *np.shape(planes[0])))
@@ -0,0 +1,274 @@
+'''
+Live mode. Watches an acquisition folder while the microscope is still writing to it and converts
+each timepoint as soon as all of its stacks have landed, appending to the growing outputs.
+'''
+import os
+import time
+import zarr
+import numpy as np
+from pathlib import Path
+from interact.engine import convert_timepoint
+from interact.catalog import token
+from interact.pyramid import create_pyramid, pyramid_factors
+from interact.instrument import StageTimer
+from interact.fusion import default_reducer
+from interact.hyperstack import create_hyperstack, hyperstack_layout, hyperstack_name, resize_hyperstack
+from interact.temporal import TemporalAccumulator, temporal_name
+
+
+class LiveConverter:
+
+    def __init__(self, kkpo, save_vol=True, save_max=True, step=8, settle_time=10, channels=None, illuminations=None, fusion=None,
+                 max_format='both', temporal_reductions=None):
+        '''
+        Parameters: kkpo (Kkpo) - the acquisition to watch
+                    save_vol (bool) - append each timepoint to the region's multiscale volume
+                    save_max (bool) - write the max projection of each timepoint
+                    step (int) - see Kkpo.save_regions
+                    settle_time (float) - seconds a stack must go unmodified before it is read
+                    channels (list) - channels to expect per timepoint, e.g. ['C00', 'C01'];
+                                      by default every channel seen so far in the region
+                    illuminations (list) - illumination sides to expect, e.g. ['I0', 'I1'];
+                                           by default every side seen so far in the region
+                    fusion (str) - see Kkpo.save_regions, None picks per channel
+                    max_format (str) - see Kkpo.save_regions; the hyperstack is appended to as
+                                       timepoints arrive, the live viewer needs the TIFFs
+                    temporal_reductions (tuple) - see Kkpo.save_regions; the projection reductions are
+                                                  rewritten after every timepoint, the volume ones once
+                                                  the acquisition has finished
+        '''
+        self.kkpo = kkpo
+        self.save_vol = save_vol
+        self.save_max = save_max
+        self.step = step
+        self.settle_time = settle_time
+        self.channels = channels
+        self.illuminations = illuminations
+        self.fusion = fusion
+        self.max_format = max_format
+        self.temporal_reductions = temporal_reductions
+        self.reductions = {}    # (region, channel) -> (projection, volume) TemporalAccumulator
+        self.sizes = {}         # file name -> size at the previous poll
+        self.processed = set()  # (region, t) already converted
+        self.timestamps = {}    # region -> {t: datetime}
+
+    def stable(self, file_name):
+        '''
+        A stack is stable once its size has not changed since the previous poll and it has not been
+        modified for settle_time seconds.
+        '''
+        try:
+            stat = os.stat(self.kkpo.file_path / file_name)
+        except FileNotFoundError:
+            return False
+        previous_size = self.sizes.get(file_name)
+        self.sizes[file_name] = stat.st_size
+        return previous_size == stat.st_size and time.time() - stat.st_mtime >= self.settle_time
+
+    def complete_timepoints(self, finished=False):
+        '''
+        Finds the timepoints that are ready to convert. A timepoint is ready when every expected
+        channel/illumination stack and its settings file are present and stable, and either a later
+        timepoint has started (so no more channels are coming) or the acquisition has finished.
+        Parameters: finished (bool) - treat the acquisition as over, so the last timepoint counts too
+        Returns: list of (region, t) tuples in acquisition order
+        '''
+        catalog = self.kkpo.catalog
+        settings = self.kkpo.settings_catalog
+        has_settings = len(settings) > 0
+        ready = []
+        for region_name in catalog.tokens('R'):
+            channels = self.channels if self.channels is not None else catalog.tokens('C', R=region_name)
+            illuminations = self.illuminations if self.illuminations is not None else catalog.tokens('I', R=region_name)
+            timepoints = catalog.values('t', R=region_name)
+            for t in timepoints:
+                if (region_name, t) in self.processed:
+                    continue
+                stacks = [catalog.find(R=region_name, t=t, C=ch_name, I=illum_name) for ch_name in channels for illum_name in illuminations]
+                if any(index is None for index in stacks):
+                    continue
+                # check every stack so their sizes are all recorded for the next poll
+                if not all([self.stable(catalog.name(index)) for index in stacks]):
+                    continue
+                if has_settings and not len(settings.select(R=region_name, t=t)):
+                    continue
+                if t == timepoints[-1] and not finished:
+                    continue
+                ready.append((region_name, int(t)))
+        return ready
+
+    def timepoint_datetime(self, region_name, t):
+        indices = self.kkpo.settings_catalog.select(R=region_name, t=t)
+        if not len(indices):
+            return None
+        return self.kkpo.index.settings_datetime(self.kkpo.settings_catalog.name(indices[0]))
+
+    def grow_volume(self, vol_path, t, stack_paths, region_name, ch_name):
+        '''
+        Creates the region's pyramid on the first timepoint and grows its T axis to fit t, keeping
+        the frame interval in the metadata up to date with the timestamps seen so far.
+        '''
+        if not os.path.exists(vol_path):
+            shape, dtype = self.kkpo.index.stack_shape(stack_paths[0])
+            voxel_size = self.kkpo.get_voxel_size(region_name)
+            factors = pyramid_factors(self.step, voxel_size[1], voxel_size[0])
+            create_pyramid(vol_path, t + 1, shape, dtype, factors, voxel_size, name=f'{region_name}_{ch_name}')
+        root = zarr.open_group(str(vol_path), mode='r+')
+        multiscales = root.attrs['multiscales']
+        for dataset in multiscales[0]['datasets']:
+            array = root[dataset['path']]
+            if array.shape[0] <= t:
+                array.resize((t + 1, *array.shape[1:]))
+
+        interval = self.frame_interval(region_name)
+        if interval is not None:
+            for dataset in multiscales[0]['datasets']:
+                dataset['coordinateTransformations'][0]['scale'][0] = interval
+            root.attrs['multiscales'] = multiscales
+            root.attrs['timestamps'] = {str(key): value.isoformat() for key, value in sorted(self.timestamps[region_name].items())}
+
+    def frame_interval(self, region_name):
+        '''
+        Seconds between timepoints from the timestamps seen so far, None until there are two.
+        '''
+        timestamps = self.timestamps.get(region_name, {})
+        if len(timestamps) < 2:
+            return None
+        first, last = min(timestamps), max(timestamps)
+        return (timestamps[last] - timestamps[first]).total_seconds() / (last - first)
+
+    def grow_hyperstack(self, hyperstack_path, t, channels, stack_paths, region_name):
+        '''
+        Creates the region's max projection hyperstack on the first timepoint and grows its T axis
+        to fit t. The file has to be rewritten to grow, so T is doubled each time and the spare
+        timepoints are trimmed by finish_hyperstacks.
+        Returns: hyperstack_layout of the file
+        '''
+        if not os.path.exists(hyperstack_path):
+            shape, dtype = self.kkpo.index.stack_shape(stack_paths[0])
+            pixel_size = self.kkpo.get_voxel_size(region_name)[1] if self.kkpo.objmag else None
+            create_hyperstack(hyperstack_path, t + 1, list(channels), shape[1:], dtype, pixel_size=pixel_size)
+        layout = hyperstack_layout(hyperstack_path)
+        if layout['shape'][0] <= t:
+            layout = resize_hyperstack(hyperstack_path, max(t + 1, 2 * layout['shape'][0]), interval=self.frame_interval(region_name))
+        return layout
+
+    def accumulators(self, region_name, ch_name, stack_paths):
+        '''
+        The temporal accumulators of a channel, created on its first timepoint.
+        Returns: (projection, volume) TemporalAccumulator, the volume one None without save_vol
+        '''
+        key = (region_name, ch_name)
+        if key not in self.reductions:
+            shape, dtype = self.kkpo.index.stack_shape(stack_paths[0])
+            volume = None
+            if self.save_vol:
+                state_dir = self.kkpo.file_path / f'{region_name}_processed' / f'.{region_name}_{ch_name}_temporal_state'
+                volume = TemporalAccumulator(shape, dtype, self.temporal_reductions, state_dir=state_dir, state_dtype=np.float32)
+            self.reductions[key] = (TemporalAccumulator(shape[1:], dtype, self.temporal_reductions), volume)
+        return self.reductions[key]
+
+    def finish_temporal(self):
+        '''
+        Writes the volume reductions over time and drops their state.
+        '''
+        for (region_name, ch_name), (_, volume) in self.reductions.items():
+            if volume is None:
+                continue
+            region_save_path = self.kkpo.file_path / f'{region_name}_processed'
+            voxel_size = self.kkpo.get_voxel_size(region_name)
+            volume.write_volumes(lambda reduction: region_save_path / f'{region_name}_{ch_name}_{temporal_name(reduction)}_volume.zarr',
+                                 pyramid_factors(self.step, voxel_size[1], voxel_size[0]), voxel_size)
+            volume.close()
+        self.reductions = {}
+
+    def finish_hyperstacks(self):
+        '''
+        Trims the spare timepoints the hyperstacks were grown by and records the measured frame interval.
+        '''
+        for region_name in sorted({region_name for region_name, _ in self.processed}):
+            hyperstack_path = self.kkpo.file_path / f'{region_name}_processed' / hyperstack_name(region_name)
+            if os.path.exists(hyperstack_path):
+                num_timepoints = max(t for region, t in self.processed if region == region_name) + 1
+                resize_hyperstack(hyperstack_path, num_timepoints, interval=self.frame_interval(region_name))
+
+    def convert(self, region_name, t):
+        '''
+        Fuses, max-projects and appends one timepoint of every channel of a region.
+        Returns: list of (channel, max projection path) tuples, the path is None when only the
+                 hyperstack is written
+        '''
+        catalog = self.kkpo.catalog
+        region_save_path = self.kkpo.file_path / f'{region_name}_processed'
+        Path.mkdir(region_save_path, parents=True, exist_ok=True)
+        tp_name = token('t', t)
+        timestamp = self.timepoint_datetime(region_name, t)
+        if timestamp is not None:
+            self.timestamps.setdefault(region_name, {})[t] = timestamp
+
+        converted = []
+        timer = StageTimer()
+        start = time.perf_counter()
+        channels = self.channels if self.channels is not None else catalog.tokens('C', R=region_name)
+        illuminations = self.illuminations if self.illuminations is not None else catalog.tokens('I', R=region_name)
+        hyperstack_path = region_save_path / hyperstack_name(region_name) if self.save_max and self.max_format != 'tiff' else None
+        layout = None
+        for ch_name in channels:
+            stack_paths = [self.kkpo.file_path / catalog.name(catalog.find(R=region_name, t=t, C=ch_name, I=illum_name)) for illum_name in illuminations]
+            max_path = None
+            if self.save_max and self.max_format != 'hyperstack':
+                max_path = region_save_path / f'{region_name}_{ch_name}_{tp_name}_Max.tiff'
+            plane = None
+            if hyperstack_path is not None:
+                if layout is None:
+                    layout = self.grow_hyperstack(hyperstack_path, t, channels, stack_paths, region_name)
+                if ch_name in layout['channels']:
+                    plane = (hyperstack_path, t, layout['channels'].index(ch_name))
+            vol_path = None
+            if self.save_vol:
+                vol_path = region_save_path / f'{region_name}_{ch_name}_volume.zarr'
+                self.grow_volume(vol_path, t, stack_paths, region_name, ch_name)
+            temporal = None
+            if self.temporal_reductions:
+                temporal = (None, *self.accumulators(region_name, ch_name, stack_paths))
+            timer.merge(convert_timepoint(stack_paths, max_path=max_path, vol_path=vol_path, tp=t if self.save_vol else None,
+                                          fusion=self.fusion or default_reducer(ch_name), hyperstack=plane, temporal=temporal))
+            if temporal is not None:
+                with timer.stage('write'):
+                    temporal[1].write_images(lambda reduction: region_save_path / f'{region_name}_{ch_name}_{temporal_name(reduction)}.tiff')
+            converted.append((ch_name, max_path))
+        self.processed.add((region_name, t))
+        self.kkpo.index.save()
+        self.kkpo.timer.merge(timer)
+        self.kkpo.run_log.record('timepoint', timer, dir_path=self.kkpo.file_path, region=region_name, t=t,
+                                 channels=[ch_name for ch_name, _ in converted], wall_seconds=time.perf_counter() - start)
+        return converted
+
+    def watch(self, poll_interval=5, idle_timeout=600):
+        '''
+        Polls the folder and converts timepoints as they complete. Stops once no new stack has
+        appeared for idle_timeout seconds, then converts whatever is left.
+        Parameters: poll_interval (float) - seconds between directory listings
+                    idle_timeout (float) - seconds without new stacks before the acquisition is
+                                           considered finished
+        Returns: generator of (region, t, [(channel, max projection path)]) for every converted timepoint
+        '''
+        last_change = time.time()
+        num_files = -1
+        while True:
+            self.kkpo.refresh()
+            if self.kkpo.metadata is None and os.path.exists(self.kkpo.file_path / 'FlamingoMetaData.txt'):
+                self.kkpo.read_metadata()
+            if len(self.kkpo.files) != num_files:
+                num_files = len(self.kkpo.files)
+                last_change = time.time()
+            finished = time.time() - last_change >= idle_timeout
+            for region_name, t in self.complete_timepoints(finished=finished):
+                print(f'Converting {region_name} {token("t", t)}')
+                yield region_name, t, self.convert(region_name, t)
+            if finished:
+                print(f'No new stacks for {idle_timeout} seconds, stopping live conversion')
+                self.finish_hyperstacks()
+                self.finish_temporal()
+                return
+            time.sleep(poll_interval)
@@ -0,0 +1,243 @@
+'''
+Tile mosaics. Multi-tile acquisitions (X000/Y000 tokens) are converted tile by tile as usual and
+the tile outputs are then streamed into one canvas per timepoint, placed by the stage positions in
+the settings files and blended linearly where neighbouring tiles overlap. The weighted running
+sums live in memory-mapped scratch files next to the output, so memory stays at about one tile no
+matter how large the mosaic is. Volumes are blended at full resolution a slab of planes at a time
+and streamed into a new pyramid. The per-tile outputs are kept next to the mosaic.
+'''
+import os
+import re
+import tempfile
+import numpy as np
+import zarr
+from pathlib import Path
+from tifffile import imread as tiff_read
+from tifffile import memmap as tiff_memmap
+from interact.pyramid import create_pyramid, PyramidWriter
+from interact.hyperstack import plane_memmap
+
+# stage position lines such as 'X (mm) = 12.345', millimetres unless the unit says otherwise
+STAGE_PATTERN = re.compile(r'^\s*([XY])\s*(?:\((mm|um|µm)\))?\s*=\s*(-?\d+(?:\.\d*)?)', re.MULTILINE)
+DEFAULT_OVERLAP = 0.1 # fraction of a tile shared with its neighbour when there are no stage positions
+STRIP_ROWS = 256 # canvas rows normalised and written at a time
+
+
+def stage_position(settings_path):
+    '''
+    Reads the stage position of a tile from its settings file.
+    Parameters: settings_path (str/Path) - Settings.txt of any stack of the tile
+    Returns: (y, x) in um, or None if the file does not record it
+    '''
+    with open(settings_path, 'r') as f:
+        return parse_stage_position(f.read())
+
+
+def parse_stage_position(text):
+    '''
+    The (y, x) stage position in um recorded in the text of a settings file, or None.
+    '''
+    position = {}
+    for axis, unit, value in STAGE_PATTERN.findall(text):
+        if axis not in position:
+            position[axis] = float(value) * (1 if unit in ('um', 'µm') else 1000)
+    if 'X' in position and 'Y' in position:
+        return position['Y'], position['X']
+    return None
+
+
+def tile_offsets(tiles, positions, tile_shape, pixel_size, overlap=DEFAULT_OVERLAP):
+    '''
+    Works out where every tile goes on the canvas.
+    Parameters: tiles (list) - (X, Y) tile indices
+                positions (dict) - (X, Y) -> (y, x) stage position in um; unless every tile has
+                                   one, the tiles are laid out on a grid from their indices
+                tile_shape (tuple) - (Y, X) size of a tile in pixels
+                pixel_size (float) - sample pixel size in um
+                overlap (float) - fraction of a tile neighbours share on the grid
+    Returns: dict (X, Y) -> (y0, x0) pixel offset of the tile, (Y, X) canvas shape
+    '''
+    if all(tile in positions for tile in tiles):
+        pixels = {tile: (positions[tile][0] / pixel_size, positions[tile][1] / pixel_size) for tile in tiles}
+    else:
+        print(f'No stage positions found for every tile, placing them on a grid with {overlap:.0%} overlap')
+        pixels = {(x, y): (y * tile_shape[0] * (1 - overlap), x * tile_shape[1] * (1 - overlap)) for x, y in tiles}
+    min_y = min(y for y, _ in pixels.values())
+    min_x = min(x for _, x in pixels.values())
+    offsets = {tile: (int(round(y - min_y)), int(round(x - min_x))) for tile, (y, x) in pixels.items()}
+    shape = (max(y0 for y0, _ in offsets.values()) + tile_shape[0],
+             max(x0 for _, x0 in offsets.values()) + tile_shape[1])
+    return offsets, shape
+
+
+def overlap_widths(offsets, tile_shape):
+    '''
+    The (Y, X) width in pixels of the overlap between neighbouring tiles, 0 along an axis with a
+    single row/column of tiles.
+    '''
+    widths = []
+    for axis, size in enumerate(tile_shape):
+        starts = sorted({offset[axis] for offset in offsets.values()})
+        steps = [b - a for a, b in zip(starts, starts[1:])]
+        widths.append(max(size - min(steps), 0) if steps else 0)
+    return tuple(widths)
+
+
+def tile_weights(tile_shape, ramp):
+    '''
+    Linear blending weights of a tile, 1 in the middle and falling off over ramp pixels towards
+    every edge. Weights never reach 0, so pixels covered by a single tile keep their value.
+    Parameters: tile_shape (tuple) - (Y, X) tile size
+                ramp (tuple) - (Y, X) width of the fall-off, usually the overlap width
+    Returns: float32 ndarray of tile_shape
+    '''
+    axes = []
+    for size, width in zip(tile_shape, ramp):
+        distance = np.minimum(np.arange(1, size + 1), np.arange(size, 0, -1)).astype(np.float32)
+        axes.append(np.minimum(distance / (width + 1), 1) if width > 0 else np.ones(size, np.float32))
+    return np.outer(axes[0], axes[1])
+
+
+def normalise(total, weight, dtype):
+    '''
+    Divides a weighted sum by its weights, leaving pixels no tile covered black.
+    '''
+    values = np.divide(total, weight, out=np.zeros(total.shape, np.float32), where=weight > 0)
+    if np.issubdtype(dtype, np.integer):
+        np.rint(values, out=values)
+    return values.astype(dtype)
+
+
+class MosaicCanvas:
+    '''
+    Weighted running sum of tiles on a canvas, backed by memory-mapped scratch files so only the
+    area under the tile being added is ever touched.
+    '''
+
+    def __init__(self, shape, scratch_dir):
+        '''
+        Parameters: shape (tuple) - canvas shape, (Y, X) or (Z, Y, X)
+                    scratch_dir (str/Path) - folder for the scratch files, ideally on the output disk
+        '''
+        self.shape = tuple(shape)
+        self.paths = []
+        self.sum = self._scratch(scratch_dir, self.shape)
+        self.weight = self._scratch(scratch_dir, self.shape[-2:])
+
+    def _scratch(self, scratch_dir, shape):
+        handle, path = tempfile.mkstemp(suffix='.mosaic', dir=scratch_dir)
+        os.close(handle)
+        self.paths.append(path)
+        return np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+
+    def add(self, tile, offset, weights):
+        '''
+        Adds a tile. Parameters: tile (ndarray) - (Y, X) or (Z, Y, X), matching the canvas
+                                 offset (tuple) - (y0, x0) of the tile on the canvas
+                                 weights (ndarray) - (Y, X) blending weights, see tile_weights
+        '''
+        y0, x0 = offset
+        height = min(tile.shape[-2], self.shape[-2] - y0)
+        width = min(tile.shape[-1], self.shape[-1] - x0)
+        weights = weights[:height, :width]
+        self.sum[..., y0:y0 + height, x0:x0 + width] += tile[..., :height, :width] * weights
+        self.weight[y0:y0 + height, x0:x0 + width] += weights
+
+    def write(self, out, dtype, index=()):
+        '''
+        Normalises the canvas by the summed weights and writes it out a strip of rows at a time.
+        Parameters: out (array-like) - destination supporting slice assignment (memmap, zarr array)
+                    dtype (np.dtype) - output pixel type
+                    index (tuple) - leading indices into out, e.g. (tp,) for a (T, Z, Y, X) zarr
+        '''
+        leading = (slice(None),) * (len(self.shape) - 2)
+        for start in range(0, self.shape[-2], STRIP_ROWS):
+            stop = min(start + STRIP_ROWS, self.shape[-2])
+            out[(*index, *leading, slice(start, stop), slice(None))] = normalise(self.sum[..., start:stop, :], self.weight[start:stop], dtype)
+
+    def plane(self, z, dtype):
+        '''
+        Plane z of a (Z, Y, X) canvas, normalised by the summed weights.
+        '''
+        return normalise(self.sum[z], self.weight, dtype)
+
+    def close(self):
+        del self.sum, self.weight
+        for path in self.paths:
+            os.remove(path)
+
+
+def mosaic_projection(tile_paths, offsets, canvas_shape, weights, out_path=None, hyperstack=None):
+    '''
+    Blends the max projections of every tile of one timepoint into a single TIFF and/or a plane of
+    the region's hyperstack.
+    Parameters: tile_paths (dict) - (X, Y) -> max projection path of the tile
+                offsets, canvas_shape - see tile_offsets
+                weights (ndarray) - blending weights of a tile
+                out_path (Path) - mosaic TIFF to write, None to skip
+                hyperstack (tuple) - (path, t, c) hyperstack plane to write, None to skip
+    Returns: out_path
+    '''
+    scratch_dir = Path(out_path if out_path is not None else hyperstack[0]).parent
+    canvas = MosaicCanvas(canvas_shape, scratch_dir)
+    dtype = None
+    for tile, tile_path in tile_paths.items():
+        projection = tiff_read(tile_path)
+        dtype = projection.dtype
+        canvas.add(projection, offsets[tile], weights)
+    outs = []
+    if out_path is not None:
+        outs.append(tiff_memmap(out_path, shape=canvas_shape, dtype=dtype))
+    if hyperstack is not None:
+        outs.append(plane_memmap(*hyperstack))
+    for out in outs:
+        canvas.write(out, dtype)
+        out.flush()
+    canvas.close()
+    return out_path
+
+
+def mosaic_volume(tile_volumes, offsets, canvas_shape, tile_shape, ramp, vol_path, voxel_size, interval=0, chunks=None, codec=None,
+                  name=None):
+    '''
+    Blends the full resolution tile volumes into an OME-Zarr mosaic with the same pyramid levels as
+    the tiles. Each timepoint is blended a slab of planes (one chunk of Z) at a time and the planes
+    are streamed into every level with PyramidWriter, so the scratch canvas holds one slab. The tile
+    pyramids are only read.
+    Parameters: tile_volumes (dict) - (X, Y) -> (pyramid path, {output tp: tile tp or None})
+                offsets, canvas_shape - see tile_offsets
+                tile_shape (tuple) - (Z, Y, X) tile stack shape
+                ramp (tuple) - (Y, X) blending ramp, see overlap_widths
+                vol_path (Path) - mosaic zarr to write
+                voxel_size (tuple) - (z, y, x) voxel size in um
+                interval, chunks, codec, name - see pyramid.create_pyramid
+    Returns: vol_path
+    '''
+    first_path, timepoints = next(iter(tile_volumes.values()))
+    tile_root = zarr.open_group(str(first_path), mode='r')
+    factors = [tuple(factor) for factor in tile_root.attrs['downsample_factors']]
+    dtype = tile_root['0'].dtype
+    temporal = tile_root['0'].ndim == 4
+    slab = tile_root['0'].chunks[-3]
+
+    options = {key: value for key, value in (('chunks', chunks), ('codec', codec)) if value is not None}
+    create_pyramid(vol_path, len(timepoints) if temporal else None, (tile_shape[0], *canvas_shape), dtype, factors, voxel_size,
+                   interval=interval, name=name, **options)
+    tile_arrays = {tile: (zarr.open_group(str(tile_path), mode='r')['0'], tile_timepoints)
+                   for tile, (tile_path, tile_timepoints) in tile_volumes.items()}
+    weights = tile_weights(tile_shape[1:], ramp)
+
+    for out_tp in sorted(timepoints):
+        writer = PyramidWriter(vol_path, out_tp if temporal else None)
+        for z_start in range(0, tile_shape[0], slab):
+            z_stop = min(z_start + slab, tile_shape[0])
+            canvas = MosaicCanvas((z_stop - z_start, *canvas_shape), Path(vol_path).parent)
+            for tile, (array, tile_timepoints) in tile_arrays.items():
+                tile_tp = tile_timepoints[out_tp]
+                volume = array[tile_tp, z_start:z_stop] if tile_tp is not None else array[z_start:z_stop]
+                canvas.add(volume, offsets[tile], weights)
+            for z in range(z_stop - z_start):
+                writer.add_plane(canvas.plane(z, dtype))
+            canvas.close()
+        writer.close()
+    return vol_path
@@ -0,0 +1,251 @@
+'''
+Threaded pipeline for single machine runs. Reading, computing and writing are separate stages
+connected by bounded queues: stacks are read ahead of the compute stage, and results are handed
+to a pool of writers and written behind it. The disk stays busy while the CPU works and the
+other way round, with no dask cluster needed, and the queue depths and a memory budget bound
+how much is in flight.
+'''
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from interact.readers import open_stack, iter_planes, stack_shape
+
+READ_AHEAD = 2 # items read but not yet being computed on
+SLAB_PLANES = 8 # planes of every side a PlaneReader reads at a time
+PLANE_MEMORY_MB = 2048 # default cap on the planes read ahead by all the PlaneReaders of a conversion
+
+
+def data_nbytes(data):
+    '''
+    Bytes held by the arrays in data, which may be an array or nested tuples/lists/dicts of them.
+    '''
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sum(data_nbytes(item) for item in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(data_nbytes(item) for item in data)
+    return 0
+
+
+def load_stacks(stack_paths, crop=None):
+    '''
+    Reads stacks fully into memory, so the disk reads happen on the read stage rather than when
+    the compute stage first touches a memory-mapped page.
+    Parameters: stack_paths (list) - the stacks to read
+                crop (tuple) - ((z0, z1), (y0, y1), (x0, x1)) box to read, see crop.py; only its
+                               planes and rows are read from memory-mapped stacks. None for all
+    Returns: list of (Z, Y, X) ndarrays
+    '''
+    box = tuple(slice(start, stop) for start, stop in crop) if crop is not None else ()
+    return [np.array(open_stack(path)[box]) for path in stack_paths]
+
+
+class ByteBudget:
+    '''
+    Counts the bytes in flight. Only the reader waits for room; results are always let in, so
+    the compute and write stages can never block each other.
+    '''
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def wait(self, num_bytes):
+        '''
+        Waits until num_bytes fit in the budget, or nothing else is in flight.
+        '''
+        with self.condition:
+            if self.max_bytes is not None:
+                self.condition.wait_for(lambda: self.used == 0 or self.used + num_bytes <= self.max_bytes)
+
+    def acquire(self, num_bytes, stop=None):
+        '''
+        Waits for room like wait and takes it in the same step, so readers on several threads
+        cannot all squeeze into the same room. Gives up when the stop event is set.
+        Returns: True once the bytes are counted, False when stopped
+        '''
+        with self.condition:
+            stopped = lambda: stop is not None and stop.is_set()
+            if self.max_bytes is not None:
+                self.condition.wait_for(lambda: stopped() or self.used == 0 or self.used + num_bytes <= self.max_bytes)
+            if stopped():
+                return False
+            self.used += num_bytes
+            return True
+
+    def add(self, num_bytes):
+        with self.condition:
+            self.used += num_bytes
+
+    def release(self, num_bytes):
+        with self.condition:
+            self.used -= num_bytes
+            self.condition.notify_all()
+
+
+class PlaneReader:
+    '''
+    Reads the planes of a set of aligned stacks on a background thread, a slab of SLAB_PLANES
+    planes of every side at a time, a few slabs ahead of whoever iterates over it. Only the queued
+    slabs are held in memory, never whole stacks, and the slabs of every reader sharing a budget
+    count against it until they have been iterated over.
+    '''
+
+    def __init__(self, stack_paths, crop=None, budget=None, depth=READ_AHEAD, slab=SLAB_PLANES):
+        '''
+        Parameters: stack_paths (list) - one stack per side, read in lockstep with readers.iter_planes
+                    crop (tuple) - ((z0, z1), (y0, y1), (x0, x1)) box to read, see crop.py
+                    budget (ByteBudget) - shared cap on the bytes read ahead, None for no cap
+                    depth (int) - slabs read ahead
+                    slab (int) - planes per side in a slab
+        '''
+        self.stack_paths = list(stack_paths)
+        self.crop = crop
+        self.budget = budget if budget is not None else ByteBudget()
+        self.slab = slab
+        self.seconds = 0.0
+        self.num_bytes = 0
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            shape, dtype = stack_shape(self.stack_paths[0])
+            if self.crop is not None:
+                shape = tuple(stop - start for start, stop in self.crop)
+            slab_bytes = self.slab * len(self.stack_paths) * int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+            sides = zip(*[iter_planes(path, crop=self.crop) for path in self.stack_paths])
+            while not self.stop.is_set():
+                # room is taken before reading, so a reader waiting for it holds nothing
+                if not self.budget.acquire(slab_bytes, stop=self.stop):
+                    break
+                start = time.perf_counter()
+                # copying the planes is what reads them, mapped ones included
+                slab = [tuple(np.array(plane) for plane in planes) for _, planes in zip(range(self.slab), sides)]
+                num_bytes = sum(plane.nbytes for planes in slab for plane in planes)
+                self.budget.release(slab_bytes - num_bytes)
+                if not slab:
+                    break
+                self.seconds += time.perf_counter() - start
+                self.num_bytes += num_bytes
+                self.queue.put((slab, num_bytes, None))
+                del slab # the slab is the consumer's now; holding it here would outlive its budget
+        except BaseException as error:
+            self.queue.put((None, 0, error))
+            return
+        self.queue.put((None, 0, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                slab, num_bytes, error = self.queue.get()
+                if error is not None:
+                    raise error
+                if slab is None:
+                    return
+                try:
+                    yield from slab
+                finally:
+                    del slab
+                    self.budget.release(num_bytes)
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Stops the reader and gives back the budget of the slabs it still holds.
+        '''
+        self.stop.set()
+        self.budget.release(0) # wakes the reader if it is waiting for room
+        while self.thread.is_alive() or not self.queue.empty():
+            try:
+                slab, num_bytes, _ = self.queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            if slab is not None:
+                self.budget.release(num_bytes)
+
+
+def run_pipeline(items, read, compute, write=None, read_ahead=READ_AHEAD, num_workers=1, num_writers=1, memory_mb=None,
+                 size=data_nbytes, timer=None):
+    '''
+    Runs read -> compute -> write over every item. Items are read in order on the calling thread,
+    computed on num_workers threads and written on num_writers threads.
+    Parameters: items (list) - the work, e.g. timepoints or jobs
+                read (callable) - read(item) -> data
+                compute (callable) - compute(item, data) -> result
+                write (callable) - write(item, result), None when compute writes its own outputs
+                read_ahead (int) - items read but not yet picked up by a compute thread
+                num_workers, num_writers (int) - compute and writer threads
+                memory_mb (float) - budget for data and results in flight, None for no limit
+                size (callable) - bytes of a data or result, counted against memory_mb
+                timer (StageTimer) - records the 'read' and 'write' stages, None to skip
+    Returns: list of the write return values, or of the compute results when write is None, in
+             item order
+    '''
+    budget = ByteBudget(memory_mb * 2**20 if memory_mb is not None else None)
+    slots = threading.Semaphore(read_ahead)
+    results = [None] * len(items)
+    failed = threading.Event()
+    lock = threading.Lock()
+
+    def record(stage, start, bytes_read=0, bytes_written=0):
+        if timer is not None:
+            with lock:
+                timer.add(stage, time.perf_counter() - start, bytes_read=bytes_read, bytes_written=bytes_written)
+
+    def run_write(index, item, result, num_bytes):
+        try:
+            start = time.perf_counter()
+            results[index] = write(item, result)
+            record('write', start, bytes_written=num_bytes)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            budget.release(num_bytes)
+
+    def run_compute(index, item, data, num_bytes):
+        slots.release()
+        try:
+            result = compute(item, data)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            del data
+            budget.release(num_bytes)
+        if write is None:
+            results[index] = result
+            return None
+        result_bytes = size(result)
+        budget.add(result_bytes)
+        return writers.submit(run_write, index, item, result, result_bytes)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as workers, ThreadPoolExecutor(max_workers=num_writers) as writers:
+        computing = []
+        num_bytes = 0
+        for index, item in enumerate(items):
+            slots.acquire()
+            # the next item is assumed to be about as large as the last one
+            budget.wait(num_bytes)
+            if failed.is_set():
+                break
+            start = time.perf_counter()
+            data = read(item)
+            num_bytes = size(data)
+            record('read', start, bytes_read=num_bytes)
+            budget.add(num_bytes)
+            computing.append(workers.submit(run_compute, index, item, data, num_bytes))
+            del data
+        writing = [future.result() for future in computing]
+        for future in writing:
+            if future is not None:
+                future.result()
+    return results
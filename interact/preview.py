@@ -0,0 +1,230 @@
+'''
+Preview movies. Replaces the preview step of FlamingoConverter.ijm: the max projections Kkpo has
+already written (per-timepoint TIFFs or the planes of a region hyperstack) are scaled down with area averaging, coloured through precomputed lookup tables,
+composited additively, stamped with a scale bar and the time, and encoded straight to an MP4 or
+animated TIFF. Frames are rendered on a thread pool and never written to intermediate folders.
+'''
+import os
+import importlib.util
+import numpy as np
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tifffile import imread as tiff_read
+from tifffile import TiffWriter
+
+# RGB colour of each lookup table, named as in Fiji
+LUTS = {'Grays': (1, 1, 1),
+        'Red': (1, 0, 0),
+        'Green': (0, 1, 0),
+        'Blue': (0, 0, 1),
+        'Cyan': (0, 1, 1),
+        'Magenta': (1, 0, 1),
+        'Yellow': (1, 1, 0)}
+DEFAULT_LUTS = ('Yellow', 'Magenta', 'Green', 'Blue', 'Grays') # the FlamingoConverter.ijm defaults per channel
+SATURATED = 0.1 # percent of pixels clipped at each end by the automatic contrast, as Fiji's Enhance Contrast
+CONTRAST_SAMPLES = 10 # frames sampled per channel to pick the contrast limits
+
+
+def contrast_limits(frame_paths, saturated=SATURATED, num_samples=CONTRAST_SAMPLES, reader=tiff_read):
+    '''
+    Picks display limits for a channel from a few frames spread over the movie, so the whole movie
+    shares one contrast and does not flicker.
+    Parameters: frame_paths (list) - max projection paths of the channel
+                saturated (float) - percent of pixels to clip at each end
+                num_samples (int) - frames to sample
+                reader (callable) - reads a frame from an item of frame_paths
+    Returns: (low, high)
+    '''
+    picks = np.unique(np.linspace(0, len(frame_paths) - 1, min(num_samples, len(frame_paths))).astype(int))
+    samples = np.concatenate([reader(frame_paths[index]).ravel() for index in picks])
+    low, high = np.percentile(samples, (saturated, 100 - saturated))
+    return float(low), float(max(high, low + 1))
+
+
+def lut_table(lut, low, high, dtype):
+    '''
+    Precomputes the RGB colour of every possible pixel value, so colouring a frame is a single
+    table lookup.
+    Parameters: lut (str or tuple) - name from LUTS or an (r, g, b) colour with components 0-1
+                low, high (float) - display limits
+                dtype (np.dtype) - integer pixel type of the projections
+    Returns: uint16 ndarray of shape (number of pixel values, 3) with values 0-255, wide enough
+             for channels to be added up without overflowing
+    '''
+    colour = np.asarray(LUTS[lut] if isinstance(lut, str) else lut, dtype=np.float32)
+    values = np.arange(np.iinfo(dtype).max + 1, dtype=np.float32)
+    ramp = np.clip((values - low) / (high - low), 0, 1)
+    return np.rint(ramp[:, None] * colour * 255).astype(np.uint16)
+
+
+def scale_bar_length(pixel_size, width):
+    '''
+    A round scale bar length in um, about a fifth of the frame width.
+    Parameters: pixel_size (float) - um per pixel of the preview
+                width (int) - frame width in pixels
+    '''
+    target = pixel_size * width / 5
+    magnitude = 10 ** np.floor(np.log10(target))
+    return float(max(step * magnitude for step in (1, 2, 5) if step * magnitude <= target))
+
+
+def format_time(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class FrameRenderer:
+    '''
+    Turns one timepoint's max projections into an RGB preview frame.
+    '''
+
+    def __init__(self, tables, factor=1, pixel_size=None, interval=0, scale_bar=True, timestamp=True, reader=tiff_read):
+        '''
+        Parameters: tables (list) - lut_table of every channel
+                    factor (int) - area averaging factor, 2 halves the width and height
+                    pixel_size (float) - um per full resolution pixel, needed for the scale bar
+                    interval (float) - seconds between frames, needed for the time stamp
+                    scale_bar, timestamp (bool) - what to burn in
+                    reader (callable) - reads a projection, tifffile.imread of a path by default
+        '''
+        self.tables = tables
+        self.reader = reader
+        self.factor = factor
+        self.pixel_size = pixel_size
+        self.interval = interval
+        self.scale_bar = scale_bar and pixel_size is not None
+        self.timestamp = timestamp and interval > 0
+        self.font = None
+
+    def scale(self, projection):
+        '''
+        Averages factor x factor blocks, dropping the partial blocks at the edges. Summing strided
+        views is several times faster than reshaping and taking the mean.
+        '''
+        factor = self.factor
+        if factor == 1:
+            return projection
+        height = projection.shape[0] // factor * factor
+        width = projection.shape[1] // factor * factor
+        total = np.zeros((height // factor, width // factor), dtype=np.uint32)
+        for y in range(factor):
+            for x in range(factor):
+                total += projection[y:height:factor, x:width:factor]
+        total += factor * factor // 2
+        total //= factor * factor
+        return total.astype(projection.dtype)
+
+    def composite(self, projections):
+        '''
+        Colours every channel through its table and adds them up, clipping at white.
+        '''
+        frame = np.take(self.tables[0], projections[0], axis=0)
+        for projection, table in zip(projections[1:], self.tables[1:]):
+            frame += np.take(table, projection, axis=0)
+        np.minimum(frame, 255, out=frame)
+        # libx264 needs even dimensions
+        return frame[:frame.shape[0] // 2 * 2, :frame.shape[1] // 2 * 2].astype(np.uint8)
+
+    def draw_scale_bar(self, frame):
+        height, width = frame.shape[:2]
+        pixel_size = self.pixel_size * self.factor
+        length = scale_bar_length(pixel_size, width)
+        bar_width = max(int(round(length / pixel_size)), 1)
+        bar_height = max(height // 100, 2)
+        margin = max(width // 40, 4)
+        frame[height - margin - bar_height:height - margin, width - margin - bar_width:width - margin] = 255
+
+    def draw_timestamp(self, frame, index):
+        from PIL import Image, ImageDraw, ImageFont
+        if self.font is None:
+            size = max(frame.shape[0] // 20, 10)
+            try:
+                self.font = ImageFont.load_default(size=size)
+            except TypeError: # Pillow < 10.1 only has the small bitmap font
+                self.font = ImageFont.load_default()
+        # draw on a small strip instead of the whole frame
+        margin = max(frame.shape[1] // 40, 4)
+        text = format_time(index * self.interval)
+        left, top, right, bottom = self.font.getbbox(text)
+        strip = frame[margin:margin + bottom, margin:margin + right]
+        image = Image.fromarray(np.ascontiguousarray(strip))
+        ImageDraw.Draw(image).text((0, 0), text, fill=(255, 255, 255), font=self.font)
+        strip[:] = np.asarray(image)
+
+    def render(self, index, paths):
+        '''
+        Parameters: index (int) - frame number, for the time stamp
+                    paths (list) - max projection path of every channel at this timepoint
+        Returns: uint8 RGB ndarray
+        '''
+        frame = self.composite([self.scale(self.reader(path)) for path in paths])
+        if self.scale_bar:
+            self.draw_scale_bar(frame)
+        if self.timestamp:
+            self.draw_timestamp(frame, index)
+        return frame
+
+
+def render_frames(renderer, timepoints, num_threads):
+    '''
+    Renders frames on a thread pool and yields them in order, keeping only a couple of frames per
+    thread in flight so a long movie is never held in memory.
+    '''
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for index, paths in enumerate(timepoints):
+            pending.append(executor.submit(renderer.render, index, paths))
+            if len(pending) >= 2 * num_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def render_preview(channel_paths, out_path, luts=None, limits=None, scale=0.5, pixel_size=None, interval=0, fps=10,
+                   scale_bar=True, timestamp=True, num_threads=None, reader=tiff_read):
+    '''
+    Renders a preview movie from per-timepoint max projections.
+    Parameters: channel_paths (list) - one list of max projection paths (in time order) per channel
+                out_path (str/Path) - .mp4 (needs imageio-ffmpeg) or .tif/.tiff for an animated TIFF
+                luts (list) - LUT per channel, names from LUTS or (r, g, b), DEFAULT_LUTS by default
+                limits (list) - (low, high) display limits per channel, picked automatically when None
+                scale (float) - output size relative to the projections, averaged over whole pixel blocks
+                pixel_size (float) - um per projection pixel, for the scale bar
+                interval (float) - seconds between timepoints, for the time stamp
+                fps (float) - frames per second of the movie
+                scale_bar, timestamp (bool) - burn in a scale bar and the elapsed time
+                num_threads (int) - frames rendered at once, None for the number of CPUs
+                reader (callable) - reads a projection from an item of channel_paths, e.g. a
+                                    (hyperstack, t, c) plane instead of a path
+    Returns: Path of the movie
+    '''
+    out_path = Path(out_path)
+    luts = luts or DEFAULT_LUTS[:len(channel_paths)]
+    limits = limits or [contrast_limits(paths, reader=reader) for paths in channel_paths]
+    dtype = reader(channel_paths[0][0]).dtype
+    tables = [lut_table(lut, low, high, dtype) for lut, (low, high) in zip(luts, limits)]
+    factor = max(int(round(1 / scale)), 1)
+    renderer = FrameRenderer(tables, factor=factor, pixel_size=pixel_size, interval=interval, scale_bar=scale_bar, timestamp=timestamp,
+                             reader=reader)
+
+    num_frames = min(len(paths) for paths in channel_paths)
+    timepoints = [[paths[index] for paths in channel_paths] for index in range(num_frames)]
+    frames = render_frames(renderer, timepoints, num_threads or os.cpu_count())
+    if out_path.suffix.lower() == '.mp4':
+        try:
+            import imageio.v2 as imageio
+            # imageio finds the ffmpeg binary through this package, it is never used directly
+            if importlib.util.find_spec('imageio_ffmpeg') is None:
+                raise ImportError('No module named imageio_ffmpeg', name='imageio_ffmpeg')
+        except ImportError as error:
+            raise ImportError('Writing MP4 previews needs imageio and imageio-ffmpeg (pip install imageio imageio-ffmpeg), '
+                              'or save an animated TIFF with a .tif out_path instead') from error
+        with imageio.get_writer(out_path, fps=fps, codec='libx264', quality=8, macro_block_size=1) as writer:
+            for frame in frames:
+                writer.append_data(frame)
+    else:
+        with TiffWriter(out_path) as tif:
+            for frame in frames:
+                tif.write(frame, photometric='rgb', contiguous=True)
+    return out_path
@@ -0,0 +1,215 @@
+'''
+Multiscale OME-Zarr pyramid writer. Every level is a block mean of the full resolution data
+(in Z as well as XY) and all levels are built from a single streaming pass over the planes.
+'''
+import time
+import numpy as np
+import zarr
+import dask.array as da
+from interact.storage import chunk_shape, compressor, DEFAULT_CHUNKS, DEFAULT_CODEC
+
+OME_ZARR_VERSION = '0.4'
+CAMERA_PIXEL_SIZE = 6.4 # um, divided by the objective magnification to get the sample pixel size
+DEFAULT_PLANE_SPACING = 2.5 # um, used when the settings file does not say otherwise
+
+
+def pyramid_factors(step, xy_pixel_size, z_spacing):
+    '''
+    Works out the (Z, Y, X) downsampling factor of every pyramid level. XY halves at every level
+    until it reaches step, and Z is only averaged once the XY pixels have grown at least twice as
+    large as the plane spacing, so the coarse levels stay roughly isotropic (step=8 at 10x gives
+    the 8x XY / 2x Z scaling that downsample1.py used).
+    Parameters: step (int) - XY factor of the coarsest level, a power of two
+                xy_pixel_size (float) - sample pixel size in um
+                z_spacing (float) - plane spacing in um
+    Returns: list of (z, y, x) int tuples, starting with (1, 1, 1)
+    '''
+    factors = []
+    xy_factor = 1
+    while xy_factor <= max(step, 1):
+        z_factor = 1
+        while xy_pixel_size * xy_factor >= 2 * z_factor * z_spacing:
+            z_factor *= 2
+        factors.append((z_factor, xy_factor, xy_factor))
+        xy_factor *= 2
+    return factors
+
+
+def block_mean_xy(plane, factor):
+    '''
+    Averages factor x factor blocks of a plane. Edges that do not divide evenly are padded by
+    repeating the last row/column so they are averaged rather than dropped.
+    Parameters: plane (ndarray) - 2D plane
+                factor (int) - block size
+    Returns: float32 ndarray of shape ceil(Y/factor), ceil(X/factor), or the plane itself when
+             factor is 1
+    '''
+    if factor == 1:
+        return plane
+    pad_y = -plane.shape[0] % factor
+    pad_x = -plane.shape[1] % factor
+    if pad_y or pad_x:
+        plane = np.pad(plane, ((0, pad_y), (0, pad_x)), mode='edge')
+    blocks = plane.reshape(plane.shape[0] // factor, factor, plane.shape[1] // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def create_pyramid(vol_path, num_timepoints, stack_shape, dtype, factors, voxel_size, interval=0, chunks=DEFAULT_CHUNKS, codec=DEFAULT_CODEC, name=None,
+                   crop=None):
+    '''
+    Creates an empty OME-Zarr multiscale group with one array per pyramid level.
+    Parameters: vol_path (Path) - where to create the zarr group
+                num_timepoints (int or None) - number of timepoints, None for a single volume
+                stack_shape (tuple) - (Z, Y, X) of the full resolution stack
+                dtype (np.dtype) - pixel type
+                factors (list) - (z, y, x) downsampling factor of each level, see pyramid_factors
+                voxel_size (tuple) - (z, y, x) full resolution voxel size in um
+                interval (float) - time between timepoints in seconds
+                chunks (str or tuple) - chunk profile from storage.CHUNK_PROFILES or a (Z, Y, X) shape;
+                                        the writer buffers one chunk depth of planes per level
+                codec (str or codec) - codec profile from storage.CODEC_PROFILES or a numcodecs codec
+                name (str) - name stored in the multiscales metadata
+                crop (tuple) - ((z0, z1), (y0, y1), (x0, x1)) box of the stacks the volume holds, see
+                               crop.py; stack_shape is then the shape of the box, and its origin is
+                               stored as an OME translation so the volume stays in stage coordinates
+    Returns: zarr group
+    '''
+    root = zarr.open_group(str(vol_path), mode='w')
+    datasets = []
+    for level, factor in enumerate(factors):
+        level_shape = tuple(-(-size // f) for size, f in zip(stack_shape, factor))
+        level_chunks = tuple(min(c, size) for c, size in zip(chunk_shape(chunks), level_shape))
+        scale = [size * f for size, f in zip(voxel_size, factor)]
+        if num_timepoints is not None:
+            level_shape = (num_timepoints, *level_shape)
+            level_chunks = (1, *level_chunks)
+            scale = [interval or 1.0, *scale]
+        root.create_dataset(str(level), shape=level_shape, chunks=level_chunks, dtype=dtype, compressor=compressor(codec),
+                            dimension_separator='/', overwrite=True)
+        transforms = [{'type': 'scale', 'scale': scale}]
+        if crop is not None:
+            translation = [start * size for (start, _), size in zip(crop, voxel_size)]
+            transforms.append({'type': 'translation', 'translation': [0.0, *translation] if num_timepoints is not None else translation})
+        datasets.append({'path': str(level), 'coordinateTransformations': transforms})
+
+    axes = [{'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+            {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+            {'name': 'x', 'type': 'space', 'unit': 'micrometer'}]
+    if num_timepoints is not None:
+        axes.insert(0, {'name': 't', 'type': 'time', 'unit': 'second'})
+    root.attrs['multiscales'] = [{'version': OME_ZARR_VERSION,
+                                  'name': name or vol_path.name,
+                                  'axes': axes,
+                                  'datasets': datasets,
+                                  'type': 'mean'}]
+    root.attrs['downsample_factors'] = [list(factor) for factor in factors]
+    if crop is not None:
+        root.attrs['crop'] = [list(pair) for pair in crop]
+    return root
+
+
+def open_pyramid(vol_path):
+    '''
+    Opens the levels of a pyramid written by create_pyramid as dask arrays.
+    Parameters: vol_path (Path) - path to the zarr group
+    Returns: list of dask arrays (finest first), list of per level scales
+    '''
+    root = zarr.open_group(str(vol_path), mode='r')
+    datasets = root.attrs['multiscales'][0]['datasets']
+    levels = [da.from_zarr(root[dataset['path']]) for dataset in datasets]
+    scales = [dataset['coordinateTransformations'][0]['scale'] for dataset in datasets]
+    return levels, scales
+
+
+class PyramidWriter:
+    '''
+    Accepts full resolution planes one at a time and streams them into every level of a pyramid
+    made by create_pyramid. Each level keeps a running Z sum of the current block of planes and a
+    chunk-deep buffer of finished planes, so memory stays at a few planes per level.
+    '''
+
+    def __init__(self, vol_path, tp=None, timer=None):
+        '''
+        Parameters: vol_path (Path) - pyramid created by create_pyramid
+                    tp (int) - timepoint to write, None for a single volume
+                    timer (StageTimer) - records the downsample and write stages, None to skip
+        '''
+        root = zarr.open_group(str(vol_path), mode='r+')
+        self.tp = tp
+        self.timer = timer
+        self.write_seconds = 0.0
+        self.factors = [tuple(factor) for factor in root.attrs['downsample_factors']]
+        self.arrays = [root[str(level)] for level in range(len(self.factors))]
+        self.z_chunks = [array.chunks[-3] for array in self.arrays]
+        self.sums = [None] * len(self.factors)
+        self.counts = [0] * len(self.factors)
+        self.buffers = [[] for _ in self.factors]
+        self.z_starts = [0] * len(self.factors)
+
+    def add_plane(self, plane):
+        '''
+        Adds the next full resolution plane. XY levels are computed by repeatedly halving the
+        previous level so each pixel is only touched once per level.
+        '''
+        start = time.perf_counter()
+        write_seconds = self.write_seconds
+        level_plane = plane
+        previous_factor = 1
+        for level, (z_factor, xy_factor, _) in enumerate(self.factors):
+            level_plane = block_mean_xy(level_plane, xy_factor // previous_factor)
+            previous_factor = xy_factor
+            if z_factor == 1:
+                self._append(level, level_plane)
+                continue
+            if self.sums[level] is None:
+                self.sums[level] = level_plane.astype(np.float32)
+            else:
+                self.sums[level] += level_plane
+            self.counts[level] += 1
+            if self.counts[level] == z_factor:
+                self._finish_plane(level)
+        if self.timer is not None:
+            # chunks flushed along the way count as writing, not downsampling
+            self.timer.add('downsample', time.perf_counter() - start - (self.write_seconds - write_seconds))
+
+    def _finish_plane(self, level):
+        self._append(level, self.sums[level] / self.counts[level])
+        self.sums[level] = None
+        self.counts[level] = 0
+
+    def _append(self, level, plane):
+        dtype = self.arrays[level].dtype
+        if plane.dtype != dtype:
+            if np.issubdtype(dtype, np.integer):
+                plane = np.rint(plane)
+            plane = plane.astype(dtype)
+        elif level == 0:
+            plane = plane.copy()
+        self.buffers[level].append(plane)
+        if len(self.buffers[level]) == self.z_chunks[level]:
+            self._flush(level)
+
+    def _flush(self, level):
+        start = time.perf_counter()
+        block = np.stack(self.buffers[level])
+        z_start = self.z_starts[level]
+        if self.tp is None:
+            self.arrays[level][z_start:z_start + len(block)] = block
+        else:
+            self.arrays[level][self.tp, z_start:z_start + len(block)] = block
+        seconds = time.perf_counter() - start
+        self.write_seconds += seconds
+        if self.timer is not None:
+            self.timer.add('write', seconds, bytes_written=block.nbytes)
+        self.z_starts[level] += len(block)
+        self.buffers[level] = []
+
+    def close(self):
+        '''
+        Writes out any partially filled Z blocks and chunk buffers.
+        '''
+        for level in range(len(self.factors)):
+            if self.counts[level]:
+                self._finish_plane(level)
+            if self.buffers[level]:
+                self._flush(level)
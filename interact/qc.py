@@ -0,0 +1,152 @@
+'''
+Per-stack quality control. While the engine streams a stack it can also keep per-plane intensity
+profiles, saturation counts, a histogram and a focus score of every raw illumination/detection
+side, plus XZ and YZ max projections of the fused stack. The stats of a region go into one small
+NPZ table with a row per (tile, timepoint, channel, illumination, camera), so a long timelapse can
+be triaged for dim, saturated or out of focus stacks without reading any of it again.
+'''
+import os
+import numpy as np
+from pathlib import Path
+from interact.catalog import parse_name, token, FIELDS
+
+HIST_BINS = 1024 # histogram bins over the full range of the integer pixel type
+PLANE_COLUMNS = ('plane_mean', 'plane_max', 'plane_saturated', 'plane_focus')
+KEY_COLUMNS = ('tile', 'timepoint', 'channel', 'illumination', 'camera')
+
+
+def qc_name(region_name):
+    return f'{region_name}_QC.npz'
+
+
+def focus_score(plane):
+    '''
+    Brenner gradient normalised by the squared mean: the mean squared difference between pixels
+    two apart along X and Y. Blurred planes score low, and the normalisation keeps the score
+    independent of brightness.
+    '''
+    plane = plane.astype(np.float32)
+    mean = plane.mean()
+    if mean == 0:
+        return 0.0
+    energy = np.square(plane[:, 2:] - plane[:, :-2]).mean() + np.square(plane[2:] - plane[:-2]).mean()
+    return float(energy / mean**2)
+
+
+class StackStats:
+    '''
+    Accumulates the stats of one stack a plane at a time.
+    '''
+
+    def __init__(self, dtype, bins=HIST_BINS):
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind in 'ui':
+            info = np.iinfo(self.dtype)
+            self.saturation = info.max
+            self.low = info.min
+            num_values = int(info.max) - int(info.min) + 1
+            self.shift = max(int(np.ceil(np.log2(num_values / bins))), 0)
+            self.histogram = np.zeros(min(bins, num_values), np.int64)
+        else:
+            # float stacks have no fixed range to bin or saturate at
+            self.saturation = None
+            self.histogram = None
+        self.planes = {column: [] for column in PLANE_COLUMNS}
+
+    def add_plane(self, plane):
+        self.planes['plane_mean'].append(float(plane.mean()))
+        self.planes['plane_max'].append(float(plane.max()))
+        self.planes['plane_focus'].append(focus_score(plane))
+        if self.saturation is None:
+            self.planes['plane_saturated'].append(0)
+            return
+        self.planes['plane_saturated'].append(int(np.count_nonzero(plane == self.saturation)))
+        values = plane.reshape(-1)
+        if self.low:
+            values = values.astype(np.int64) - self.low
+        counts = np.bincount(values >> self.shift if self.shift else values, minlength=len(self.histogram))
+        self.histogram += counts[:len(self.histogram)]
+
+    def as_dict(self):
+        '''
+        Returns: dict of the per-plane arrays (PLANE_COLUMNS), 'histogram' (None for float stacks)
+                 and 'bin_edges'
+        '''
+        stats = {column: np.asarray(values, np.float32) for column, values in self.planes.items()}
+        stats['histogram'] = self.histogram
+        stats['bin_edges'] = (self.low + (np.arange(len(self.histogram) + 1, dtype=np.int64) << self.shift)
+                              if self.histogram is not None else None)
+        return stats
+
+
+def stack_keys(stack_path, tile=''):
+    '''
+    The KEY_COLUMNS of a stack, from its file name.
+    '''
+    fields = parse_name(Path(stack_path).stem)
+    if fields is None:
+        return {'tile': tile, 'timepoint': '', 'channel': '', 'illumination': Path(stack_path).stem, 'camera': ''}
+    fields = dict(zip(FIELDS, fields))
+    return {'tile': tile, 'timepoint': token('t', fields['t']), 'channel': token('C', fields['C']),
+            'illumination': token('I', fields['I']), 'camera': token('D', fields['D'])}
+
+
+def qc_table(records):
+    '''
+    Builds the column arrays of a QC table.
+    Parameters: records (list) - (keys, stats) tuples, keys as from stack_keys and stats as from
+                                 StackStats.as_dict
+    Returns: dict of column name -> ndarray, one row per record. Per-plane columns are (rows, Z),
+             padded with NaN for stacks with fewer planes
+    '''
+    num_planes = max((len(stats['plane_mean']) for _, stats in records), default=0)
+    table = {column: np.array([keys[column] for keys, _ in records], dtype=str) for column in KEY_COLUMNS}
+    for column in PLANE_COLUMNS:
+        table[column] = np.full((len(records), num_planes), np.nan, np.float32)
+        for row, (_, stats) in enumerate(records):
+            table[column][row, :len(stats[column])] = stats[column]
+    histograms = [stats['histogram'] for _, stats in records if stats['histogram'] is not None]
+    if histograms and all(len(histogram) == len(histograms[0]) for histogram in histograms):
+        table['histogram'] = np.array([stats['histogram'] if stats['histogram'] is not None else np.zeros(len(histograms[0]), np.int64)
+                                       for _, stats in records])
+        table['bin_edges'] = next(stats['bin_edges'] for _, stats in records if stats['histogram'] is not None)
+    # per-stack summaries, so a whole timelapse can be scanned in one line of numpy
+    with np.errstate(all='ignore'):
+        table['mean'] = np.nanmean(table['plane_mean'], axis=1) if num_planes else np.zeros(len(records), np.float32)
+        table['max'] = np.nanmax(table['plane_max'], axis=1) if num_planes else np.zeros(len(records), np.float32)
+        table['saturated'] = np.nansum(table['plane_saturated'], axis=1).astype(np.int64)
+        table['focus'] = np.nanmax(table['plane_focus'], axis=1) if num_planes else np.zeros(len(records), np.float32)
+    return table
+
+
+def read_qc(path):
+    '''
+    Loads a QC table.
+    Returns: dict of column name -> ndarray, empty if the file does not exist
+    '''
+    if not os.path.exists(path):
+        return {}
+    with np.load(path) as data:
+        return {column: data[column] for column in data.files}
+
+
+def write_qc(path, records):
+    '''
+    Writes the records of one channel into a region's QC table, replacing any rows the table
+    already had for the same stacks so reconverting a channel does not duplicate it.
+    Parameters: path (str/Path) - the .npz, see qc_name
+                records (list) - see qc_table
+    '''
+    keys = {tuple(keys[column] for column in KEY_COLUMNS) for keys, _ in records}
+    existing = read_qc(path)
+    kept = []
+    for row in range(len(existing.get('timepoint', []))):
+        row_keys = {column: str(existing[column][row]) for column in KEY_COLUMNS}
+        if tuple(row_keys.values()) in keys:
+            continue
+        stats = {column: existing[column][row][~np.isnan(existing[column][row])] for column in PLANE_COLUMNS}
+        stats['histogram'] = existing['histogram'][row] if 'histogram' in existing else None
+        stats['bin_edges'] = existing.get('bin_edges')
+        kept.append((row_keys, stats))
+    records = sorted(kept + list(records), key=lambda record: tuple(record[0][column] for column in KEY_COLUMNS))
+    np.savez_compressed(path, **qc_table(records))
@@ -0,0 +1,219 @@
+'''
+Stack readers. Flamingo writes uncompressed 16-bit TIFFs, so most stacks can be memory-mapped and
+read straight from the page cache instead of being decoded into a fresh array. Stacks that cannot
+be mapped (compressed, tiled, etc.) fall back to normal decoding. Headerless .raw stacks are
+always mapped, and archived .zarr stacks (see archive.py) are decompressed a chunk at a time.
+'''
+import os
+import re
+import math
+import numpy as np
+import dask
+import dask.array as da
+import zarr
+from pathlib import Path
+from functools import lru_cache
+from tifffile import TiffFile
+from tifffile import memmap as tiff_memmap
+from interact.catalog import parse_name, FIELDS
+
+RAW_DTYPE = np.dtype('<u2') # Flamingo raw stacks are 16-bit unsigned little-endian
+SIZE_PATTERNS = {'width': re.compile(r'width\D*?=\s*(\d+)', re.IGNORECASE),
+                 'height': re.compile(r'height\D*?=\s*(\d+)', re.IGNORECASE)}
+
+
+@lru_cache(maxsize=None)
+def metadata_image_size(dir_path):
+    '''
+    Looks for the camera image width and height in FlamingoMetaData.txt and then in the settings
+    files of an acquisition folder. Cached per folder, so the text files are only read once.
+    Parameters: dir_path (str) - acquisition folder
+    Returns: (height, width) or None if the files do not record it
+    '''
+    candidates = [os.path.join(dir_path, 'FlamingoMetaData.txt')]
+    candidates += sorted(os.path.join(dir_path, name) for name in os.listdir(dir_path) if name.endswith('Settings.txt') and not name.startswith('.'))
+    for candidate in candidates[:2]:
+        try:
+            with open(candidate, 'r') as f:
+                text = f.read()
+        except (FileNotFoundError, UnicodeDecodeError):
+            continue
+        width = SIZE_PATTERNS['width'].search(text)
+        height = SIZE_PATTERNS['height'].search(text)
+        if width and height:
+            return int(height.group(1)), int(width.group(1))
+    return None
+
+
+def raw_shape(stack_path):
+    '''
+    Works out the (Z, Y, X) shape of a headerless .raw stack. The image size comes from the
+    metadata/settings files when they record it, otherwise from the file size and the plane count
+    in the file name, assuming square images as the Flamingo camera writes by default.
+    Parameters: stack_path (str/Path) - path to the stack
+    Returns: (Z, Y, X) tuple
+    '''
+    stack_path = Path(stack_path)
+    num_pixels = os.path.getsize(stack_path) // RAW_DTYPE.itemsize
+    fields = parse_name(stack_path.stem)
+    num_planes = fields[FIELDS.index('P')] if fields is not None else -1
+
+    image_size = metadata_image_size(str(stack_path.parent))
+    if image_size is not None:
+        height, width = image_size
+        if num_planes <= 0:
+            num_planes = num_pixels // (height * width)
+        if num_planes * height * width == num_pixels:
+            return num_planes, height, width
+
+    if num_planes > 0 and num_pixels % num_planes == 0:
+        side = math.isqrt(num_pixels // num_planes)
+        if side * side * num_planes == num_pixels:
+            return num_planes, side, side
+
+    raise ValueError(f'Could not work out the image size of {stack_path.name} ({num_pixels} pixels). '
+                     'Add the image width and height to FlamingoMetaData.txt.')
+
+
+def map_raw(stack_path):
+    return np.memmap(stack_path, dtype=RAW_DTYPE, mode='r', shape=raw_shape(stack_path))
+
+
+def stack_layout(stack_path):
+    '''
+    Works out how a stack can be read.
+    Parameters: stack_path (str/Path) - path to the stack
+    Returns: 'raw' for headerless .raw stacks, 'zarr' for archived stacks,
+             'contiguous' if the whole stack is one block of pixels that maps to a single array,
+             'pages' if every plane is an uncompressed block that can be mapped on its own,
+             'decode' otherwise
+    '''
+    if str(stack_path).endswith('.raw'):
+        return 'raw'
+    if str(stack_path).endswith('.zarr'):
+        return 'zarr'
+    with TiffFile(stack_path) as tif:
+        if tif.series[0].dataoffset is not None:
+            return 'contiguous'
+        if all(page.is_memmappable for page in tif.pages):
+            return 'pages'
+    return 'decode'
+
+
+def map_pages(stack_path):
+    '''
+    Memory-maps every plane of a stack whose planes are uncompressed but not stored back to back.
+    Returns: list of 2D np.memmap
+    '''
+    with TiffFile(stack_path) as tif:
+        dtype = tif.pages[0].dtype.newbyteorder(tif.byteorder)
+        return [np.memmap(stack_path, dtype=dtype, mode='r', offset=page.dataoffsets[0], shape=page.shape)
+                for page in tif.pages]
+
+
+def open_stack(stack_path):
+    '''
+    Opens a stack as a (Z, Y, X) array without copying it when possible.
+    Parameters: stack_path (str/Path) - path to the stack
+    Returns: read-only np.memmap for contiguous stacks, a read-only zarr array for archived stacks
+             (decompressed as it is sliced), otherwise the decoded ndarray
+    '''
+    layout = stack_layout(stack_path)
+    if layout == 'raw':
+        return map_raw(stack_path)
+    if layout == 'zarr':
+        return zarr.open_array(str(stack_path), mode='r')
+    if layout == 'contiguous':
+        return tiff_memmap(stack_path, mode='r')
+    with TiffFile(stack_path) as tif:
+        return tif.asarray()
+
+
+def iter_planes(stack_path, crop=None):
+    '''
+    Yields the planes of a stack one at a time. Mapped planes are views on the page cache and are
+    read-only, decoded planes are decoded one page at a time so only one plane is held in memory.
+    Parameters: stack_path (str/Path) - path to the stack
+                crop (tuple) - ((z0, z1), (y0, y1), (x0, x1)) to yield only that box, see crop.py;
+                               mapped planes outside it and rows outside it are never read
+    Returns: generator of 2D ndarrays
+    '''
+    z_slice, y_slice, x_slice = (slice(*pair) for pair in crop) if crop is not None else (slice(None),) * 3
+    layout = stack_layout(stack_path)
+    if layout in ('raw', 'contiguous'):
+        stack = map_raw(stack_path) if layout == 'raw' else tiff_memmap(stack_path, mode='r')
+        for z in range(stack.shape[0])[z_slice]:
+            yield stack[z, y_slice, x_slice]
+    elif layout == 'zarr':
+        stack = zarr.open_array(str(stack_path), mode='r')
+        for z in range(stack.shape[0])[z_slice]:
+            yield stack[z, y_slice, x_slice]
+    elif layout == 'pages':
+        for plane in map_pages(stack_path)[z_slice]:
+            yield plane[y_slice, x_slice]
+    else:
+        with TiffFile(stack_path) as tif:
+            for page in tif.pages[z_slice]:
+                yield page.asarray()[y_slice, x_slice]
+
+
+def stack_shape(stack_path):
+    '''
+    Reads the (Z, Y, X) shape and dtype of a stack from its header without reading any pixels.
+    Parameters: stack_path (str/Path) - path to the stack
+    Returns: shape (tuple), dtype (np.dtype)
+    '''
+    layout = stack_layout(stack_path)
+    if layout == 'raw':
+        return raw_shape(stack_path), RAW_DTYPE
+    if layout == 'zarr':
+        stack = zarr.open_array(str(stack_path), mode='r')
+        return stack.shape, stack.dtype
+    with TiffFile(stack_path) as tif:
+        page = tif.pages[0]
+        return (len(tif.pages), *page.shape), page.dtype
+
+
+def read_slab(stack_path, z_start, z_stop):
+    '''
+    Reads planes z_start:z_stop of a stack. For mapped stacks this is a view on the page cache.
+    '''
+    layout = stack_layout(stack_path)
+    if layout == 'raw':
+        return map_raw(stack_path)[z_start:z_stop]
+    if layout == 'contiguous':
+        return tiff_memmap(stack_path, mode='r')[z_start:z_stop]
+    if layout == 'zarr':
+        return zarr.open_array(str(stack_path), mode='r')[z_start:z_stop]
+    if layout == 'pages':
+        return np.stack(map_pages(stack_path)[z_start:z_stop])
+    with TiffFile(stack_path) as tif:
+        return np.stack([tif.pages[z].asarray() for z in range(z_start, z_stop)])
+
+
+def dask_stack(stack_path, z_chunk=16, shape=None, dtype=None):
+    '''
+    Wraps a stack in a lazy dask array whose chunks are Z-slabs of the memory map, so each task
+    only touches the planes it needs and nothing is copied until it is computed on.
+    Parameters: stack_path (str/Path) - path to the stack
+                z_chunk (int) - planes per chunk
+                shape, dtype - the stack shape and dtype, read from the header when not given
+    Returns: dask array of shape (Z, Y, X)
+    '''
+    if shape is None or dtype is None:
+        shape, dtype = stack_shape(stack_path)
+    slabs = []
+    for z_start in range(0, shape[0], z_chunk):
+        z_stop = min(z_start + z_chunk, shape[0])
+        slab = dask.delayed(read_slab, pure=True)(str(stack_path), z_start, z_stop)
+        slabs.append(da.from_delayed(slab, shape=(z_stop - z_start, *shape[1:]), dtype=dtype))
+    return da.concatenate(slabs, axis=0)
+
+
+def dask_stacks(stack_paths, z_chunk=16):
+    '''
+    Stacks several same-shaped stacks (e.g. every timepoint of a channel) into a lazy (T, Z, Y, X)
+    dask array. Only the first header is read, the rest are assumed to match.
+    '''
+    shape, dtype = stack_shape(stack_paths[0])
+    return da.stack([dask_stack(path, z_chunk=z_chunk, shape=shape, dtype=dtype) for path in stack_paths])
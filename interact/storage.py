@@ -0,0 +1,118 @@
+'''
+Chunk and compression profiles for the zarr volumes, plus a benchmark that compares them on real
+data. Chunk shapes are (Z, Y, X) per timepoint; every chunk holds a single timepoint.
+'''
+import time
+import shutil
+import numpy as np
+import zarr
+from pathlib import Path
+from numcodecs import Blosc
+from interact.readers import iter_planes, stack_shape
+
+# (Z, Y, X) chunk shapes, clipped to the size of each pyramid level
+CHUNK_PROFILES = {'default': (8, 512, 512),     # a few planes deep, cheap to buffer while streaming
+                  'planes': (1, 256, 256),      # one plane per chunk, fastest XY scrolling in napari
+                  'blocks': (64, 256, 256),     # balanced XY scrolling and analysis reads
+                  'ortho': (128, 128, 128)}     # deep cubes for XZ/YZ views and 3D rendering
+
+# bit-shuffling groups the rarely used high bits of sparse 16-bit fluorescence, which compresses very well
+CODEC_PROFILES = {'none': None,
+                  'blosc-lz4': Blosc(cname='lz4', clevel=5, shuffle=Blosc.BITSHUFFLE),
+                  'blosc-zstd': Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE),
+                  'blosc-zstd-max': Blosc(cname='zstd', clevel=9, shuffle=Blosc.BITSHUFFLE)}
+DEFAULT_CHUNKS = 'default'
+DEFAULT_CODEC = 'blosc-zstd'
+
+
+def chunk_shape(chunks):
+    '''
+    Accepts a profile name or an explicit (Z, Y, X) tuple and returns the tuple.
+    '''
+    if isinstance(chunks, str):
+        if chunks not in CHUNK_PROFILES:
+            raise ValueError(f'Unknown chunk profile {chunks}, choose one of {list(CHUNK_PROFILES)}')
+        return CHUNK_PROFILES[chunks]
+    return tuple(chunks)
+
+
+def compressor(codec):
+    '''
+    Accepts a profile name or a numcodecs codec and returns the codec.
+    '''
+    if isinstance(codec, str):
+        if codec not in CODEC_PROFILES:
+            raise ValueError(f'Unknown codec profile {codec}, choose one of {list(CODEC_PROFILES)}')
+        return CODEC_PROFILES[codec]
+    return codec
+
+
+def stored_size(path):
+    '''
+    Bytes a zarr takes on disk.
+    '''
+    return sum(file.stat().st_size for file in Path(path).rglob('*') if file.is_file())
+
+
+def benchmark_profiles(stack_paths, out_dir, profiles=None, num_reads=50, keep=False, seed=0):
+    '''
+    Writes the same stacks once per (chunk profile, codec profile) and measures how each does.
+    The stacks are read into memory once up front so only zarr encoding and writing is timed.
+    Parameters: stack_paths (list) - stacks to write, one per timepoint
+                out_dir (str/Path) - scratch folder for the test zarrs, ideally on the output disk
+                profiles (list) - (chunk profile, codec profile) pairs, every combination by default
+                num_reads (int) - random XY planes and XZ slices read back per profile
+                keep (bool) - keep the test zarrs instead of deleting them
+                seed (int) - seed for the random read positions
+    Returns: list of dicts with write MB/s, compression ratio and median read latencies in ms
+    '''
+    out_dir = Path(out_dir)
+    Path.mkdir(out_dir, parents=True, exist_ok=True)
+    if profiles is None:
+        profiles = [(chunks, codec) for chunks in CHUNK_PROFILES for codec in CODEC_PROFILES]
+
+    shape, dtype = stack_shape(stack_paths[0])
+    data = np.stack([np.stack(list(iter_planes(path))) for path in stack_paths])
+    raw_bytes = data.nbytes
+    rng = np.random.default_rng(seed)
+
+    results = []
+    for chunks, codec in profiles:
+        zarr_path = out_dir / f'benchmark_{chunks}_{codec}.zarr'
+        level_chunks = tuple(min(c, s) for c, s in zip(chunk_shape(chunks), shape))
+        array = zarr.open(str(zarr_path), mode='w', shape=data.shape, chunks=(1, *level_chunks), dtype=dtype,
+                          compressor=compressor(codec), dimension_separator='/')
+        start = time.perf_counter()
+        for tp in range(data.shape[0]):
+            array[tp] = data[tp]
+        write_seconds = time.perf_counter() - start
+
+        # reopen so nothing is served from the in-memory array object
+        array = zarr.open(str(zarr_path), mode='r')
+        plane_times = []
+        ortho_times = []
+        for _ in range(num_reads):
+            tp, z, y = rng.integers(data.shape[0]), rng.integers(shape[0]), rng.integers(shape[1])
+            start = time.perf_counter()
+            array[tp, z]
+            plane_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            array[tp, :, y]
+            ortho_times.append(time.perf_counter() - start)
+
+        size = stored_size(zarr_path)
+        results.append({'chunks': chunks if isinstance(chunks, str) else list(chunks),
+                        'codec': codec if isinstance(codec, str) else repr(codec),
+                        'write_MBps': raw_bytes / 1e6 / write_seconds,
+                        'compression_ratio': raw_bytes / size,
+                        'xy_read_ms': 1000 * float(np.median(plane_times)),
+                        'xz_read_ms': 1000 * float(np.median(ortho_times)),
+                        'stored_MB': size / 1e6})
+        if not keep:
+            shutil.rmtree(zarr_path)
+
+    print(f'{"chunks":>10} {"codec":>16} {"write MB/s":>11} {"ratio":>7} {"XY ms":>8} {"XZ ms":>8}')
+    for result in results:
+        print(f'{str(result["chunks"]):>10} {result["codec"]:>16} {result["write_MBps"]:>11.1f} '
+              f'{result["compression_ratio"]:>7.2f} {result["xy_read_ms"]:>8.2f} {result["xz_read_ms"]:>8.2f}')
+    return results
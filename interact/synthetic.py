@@ -0,0 +1,94 @@
+'''
+Synthetic Flamingo acquisitions for testing and benchmarking. The folders look like the real thing:
+54 character S/t/V/R/X/Y/C/I/D/P stack names, a Settings.txt per stack with a 'Date time stamp'
+and FlamingoMetaData.txt with the objective name, filled with noisy blob-like samples so the
+compression and cropping behaviour is realistic.
+'''
+import numpy as np
+from pathlib import Path
+from datetime import datetime, timedelta
+from tifffile import TiffWriter
+from interact.catalog import token
+
+
+def sample_plane(rng, z, num_planes, height, width, blobs, background=100):
+    '''
+    One plane of a synthetic sample: Poisson background plus Gaussian blobs that drift a little
+    between planes, clipped to 16 bits.
+    '''
+    yy, xx = np.ogrid[:height, :width]
+    plane = np.zeros((height, width), dtype=np.float32)
+    for centre_z, centre_y, centre_x, radius, brightness in blobs:
+        dz = (z - centre_z) / max(num_planes / 4, 1)
+        plane += brightness * np.exp(-((yy - centre_y) ** 2 + (xx - centre_x) ** 2) / (2 * radius ** 2) - dz ** 2)
+    plane = rng.poisson(plane + background)
+    return np.clip(plane, 0, 65535).astype(np.uint16)
+
+
+def make_acquisition(out_dir, num_timepoints=3, channels=('C00', 'C01'), illuminations=('I0', 'I1'), regions=('R0000',),
+                     tiles=((0, 0),), num_planes=32, height=256, width=256, objective='Olympus 10x', plane_spacing=2.5,
+                     interval=30, start=datetime(2022, 4, 21, 12, 54, 27), raw=False, tile_overlap=0.1, seed=0):
+    '''
+    Writes a fake acquisition folder.
+    Parameters: out_dir (str/Path) - folder to write into, created if needed
+                num_timepoints (int) - timepoints per region
+                channels, illuminations, regions (tuple) - file name tokens to generate
+                tiles (tuple) - (X, Y) tile indices, cut from one sample with stage positions in the settings
+                num_planes, height, width (int) - stack shape
+                objective (str) - objective name, the magnification is read from its last digits
+                plane_spacing (float) - Z step in um written to the settings files
+                interval (float) - seconds between timepoints in the timestamps
+                start (datetime) - timestamp of the first timepoint
+                raw (bool) - write headerless .raw stacks instead of TIFFs
+                tile_overlap (float) - fraction of a tile shared with its neighbours
+                seed (int) - random seed
+    Returns: Path of the folder
+    '''
+    out_dir = Path(out_dir)
+    Path.mkdir(out_dir, parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    with open(out_dir / 'FlamingoMetaData.txt', 'w') as f:
+        f.write('<Instrument>\n  <Objective>\n')
+        f.write(f'    Name = {objective}\n')
+        f.write('  </Objective>\n  <Camera>\n')
+        f.write(f'    Image width = {width}\n    Image height = {height}\n')
+        f.write('  </Camera>\n</Instrument>\n')
+
+    # tiles are windows onto one sample, stepped by a tile less the overlap
+    pixel_size = 6.4 / int(objective[-3:-1])
+    tile_step = (height * (1 - tile_overlap), width * (1 - tile_overlap))
+    extent = (height + max(y for _, y in tiles) * tile_step[0], width + max(x for x, _ in tiles) * tile_step[1])
+    num_blobs = 6 * len(tiles)
+    blobs = [(rng.uniform(0, num_planes), rng.uniform(0.3, 0.7) * extent[0], rng.uniform(0.3, 0.7) * extent[1],
+              rng.uniform(0.03, 0.08) * min(height, width), rng.uniform(500, 4000)) for _ in range(num_blobs)]
+
+    for region_name in regions:
+        for t in range(num_timepoints):
+            timestamp = start + timedelta(seconds=t * interval)
+            for tile_x, tile_y in tiles:
+                for ch_name in channels:
+                    for illum_name in illuminations:
+                        base = '_'.join(['S000', token('t', t), 'V000', region_name, token('X', tile_x), token('Y', tile_y),
+                                         ch_name, illum_name, 'D0', token('P', num_planes)])
+                        # the far illumination side is dimmer, as on the real instrument
+                        gain = 1.0 if illum_name == 'I0' else 0.7
+                        offset_y, offset_x = tile_y * tile_step[0], tile_x * tile_step[1]
+                        drifted = [(z, y + t - offset_y, x + 0.5 * t - offset_x, radius, brightness * gain) for z, y, x, radius, brightness in blobs]
+                        if raw:
+                            with open(out_dir / f'{base}.raw', 'wb') as f:
+                                for z in range(num_planes):
+                                    f.write(sample_plane(rng, z, num_planes, height, width, drifted).astype('<u2').tobytes())
+                        else:
+                            with TiffWriter(out_dir / f'{base}.tif') as tif:
+                                for z in range(num_planes):
+                                    tif.write(sample_plane(rng, z, num_planes, height, width, drifted), contiguous=True)
+                        with open(out_dir / f'{base}_Settings.txt', 'w') as f:
+                            f.write('<Experiment Settings>\n')
+                            f.write(f'    Date time stamp = {timestamp:%Y%m%d_%H%M%S}\n')
+                            f.write(f'    Plane spacing (um) = {plane_spacing}\n')
+                            f.write(f'    Number of planes = {num_planes}\n')
+                            f.write(f'    X (mm) = {offset_x * pixel_size / 1000:.6f}\n')
+                            f.write(f'    Y (mm) = {offset_y * pixel_size / 1000:.6f}\n')
+                            f.write('</Experiment Settings>\n')
+    return out_dir
@@ -0,0 +1,192 @@
+'''
+Reductions along time. A TemporalAccumulator keeps the running state of per-pixel max, min, mean
+and standard deviation (Welford's update, which stays accurate over thousands of timepoints where
+a sum of squares would not) and an exponential running average, and is updated as each timepoint
+is converted. Its memory is a few images (or volumes) however long the timelapse is; volume state
+can be kept in memory-mapped files so it does not have to fit in RAM at all.
+'''
+import shutil
+import threading
+import numpy as np
+from pathlib import Path
+from tifffile import imwrite as tiff_write
+from interact.pyramid import create_pyramid, PyramidWriter
+from interact.storage import DEFAULT_CHUNKS, DEFAULT_CODEC
+
+TEMPORAL_REDUCTIONS = ('max', 'min', 'mean', 'std', 'running')
+RUNNING_ALPHA = 0.1 # weight of the newest timepoint in the running average
+
+
+def temporal_name(reduction):
+    '''
+    'mean' -> 'TMean', the tag the outputs of a reduction are named with.
+    '''
+    return f'T{reduction.capitalize()}'
+
+
+class TemporalAccumulator:
+    '''
+    Streaming per-pixel reductions over timepoints of images (Y, X) or volumes (Z, Y, X). Volumes
+    are added a plane at a time from the conversion pass; different timepoints can be added from
+    different threads at once, every plane has its own lock.
+    '''
+
+    def __init__(self, shape, dtype, reductions=TEMPORAL_REDUCTIONS, state_dir=None, alpha=RUNNING_ALPHA, state_dtype=np.float64):
+        '''
+        Parameters: shape (tuple) - (Y, X) or (Z, Y, X) of every timepoint
+                    dtype (np.dtype) - pixel type of the data, kept by max and min
+                    reductions (tuple) - any of TEMPORAL_REDUCTIONS; 'running' needs timepoints in order
+                                         and is only kept for images
+                    state_dir (str/Path) - folder to memory-map the state into, None to keep it in RAM
+                    alpha (float) - weight of each new timepoint in the running average
+                    state_dtype (np.dtype) - precision of the mean/std/running state
+        '''
+        unknown = set(reductions) - set(TEMPORAL_REDUCTIONS)
+        if unknown:
+            raise ValueError(f'Unknown temporal reductions {sorted(unknown)}, choose from {list(TEMPORAL_REDUCTIONS)}')
+        self.shape = tuple(shape)
+        self.volume = len(self.shape) == 3
+        self.dtype = np.dtype(dtype)
+        self.reductions = tuple(reduction for reduction in reductions if not (self.volume and reduction == 'running'))
+        self.alpha = alpha
+        self.state_dir = Path(state_dir) if state_dir is not None else None
+        if self.state_dir is not None:
+            Path.mkdir(self.state_dir, parents=True, exist_ok=True)
+        planes = self.shape if self.volume else (1, *self.shape)
+        self.state = {}
+        if 'max' in self.reductions:
+            self.state['max'] = self.allocate('max', planes, self.dtype)
+        if 'min' in self.reductions:
+            self.state['min'] = self.allocate('min', planes, self.dtype)
+        if 'mean' in self.reductions or 'std' in self.reductions:
+            self.state['mean'] = self.allocate('mean', planes, state_dtype)
+        if 'std' in self.reductions:
+            self.state['m2'] = self.allocate('m2', planes, state_dtype)
+        if 'running' in self.reductions:
+            self.state['running'] = self.allocate('running', planes, state_dtype)
+        self.counts = np.zeros(planes[0], np.int64)
+        self.locks = [threading.Lock() for _ in range(planes[0])]
+        # the running average is order dependent, so timepoints that arrive early wait here; only
+        # as many as are converted at once can be waiting
+        self.pending = {}
+        self.next_t = 0
+        self.order_lock = threading.Lock()
+
+    def allocate(self, name, shape, dtype):
+        if self.state_dir is None:
+            return np.zeros(shape, dtype)
+        return np.lib.format.open_memmap(self.state_dir / f'{name}.npy', mode='w+', dtype=dtype, shape=shape)
+
+    @property
+    def num_timepoints(self):
+        return int(self.counts.max()) if len(self.counts) else 0
+
+    def add_plane(self, z, plane):
+        '''
+        Adds plane z of one timepoint. Every plane of a volume has to be added once per timepoint.
+        '''
+        with self.locks[z]:
+            count = self.counts[z] + 1
+            if 'max' in self.state:
+                if count == 1:
+                    self.state['max'][z] = plane
+                else:
+                    np.maximum(self.state['max'][z], plane, out=self.state['max'][z])
+            if 'min' in self.state:
+                if count == 1:
+                    self.state['min'][z] = plane
+                else:
+                    np.minimum(self.state['min'][z], plane, out=self.state['min'][z])
+            if 'mean' in self.state:
+                mean = self.state['mean'][z]
+                delta = plane - mean
+                mean += delta / count
+                if 'm2' in self.state:
+                    # Welford: m2 += (x - old mean) * (x - new mean)
+                    delta *= plane - mean
+                    self.state['m2'][z] += delta
+            self.counts[z] = count
+
+    def add(self, image, t=None):
+        '''
+        Adds a whole timepoint, an image or a volume.
+        Parameters: image (ndarray) - of the accumulator's shape
+                    t (int) - position of the timepoint in the timelapse, for the running average;
+                              None takes timepoints in the order they are added
+        '''
+        planes = image if self.volume else image[np.newaxis]
+        for z, plane in enumerate(planes):
+            self.add_plane(z, plane)
+        if 'running' in self.state:
+            with self.order_lock:
+                t = self.next_t + len(self.pending) if t is None else t
+                self.pending[t] = np.array(image, copy=True)
+                while self.next_t in self.pending:
+                    frame = self.pending.pop(self.next_t)
+                    running = self.state['running'][0]
+                    if self.next_t == 0:
+                        running[:] = frame
+                    else:
+                        running += self.alpha * (frame - running)
+                    self.next_t += 1
+
+    def result(self, reduction, z=None):
+        '''
+        The current value of a reduction: max and min in the data's pixel type, mean, std (over
+        the timepoints seen, ddof=0) and running as float32.
+        Parameters: reduction (str) - one of self.reductions
+                    z (int) - plane of a volume, None for the whole image/volume
+        '''
+        if reduction not in self.reductions:
+            raise ValueError(f'{reduction} is not kept by this accumulator, it keeps {list(self.reductions)}')
+        planes = slice(None) if z is None else z
+        if reduction in ('max', 'min'):
+            result = self.state[reduction][planes]
+        elif reduction == 'mean' or reduction == 'running':
+            result = self.state[reduction][planes].astype(np.float32)
+        else:
+            counts = np.maximum(self.counts, 1)[:, np.newaxis, np.newaxis] if z is None else max(int(self.counts[z]), 1)
+            result = np.sqrt(self.state['m2'][planes] / counts).astype(np.float32)
+        return result[0] if not self.volume and z is None else result
+
+    def write_images(self, path_for):
+        '''
+        Writes every reduction of an image accumulator as a TIFF.
+        Parameters: path_for (callable) - reduction -> output path
+        Returns: list of paths
+        '''
+        paths = []
+        for reduction in self.reductions:
+            tiff_write(path_for(reduction), self.result(reduction))
+            paths.append(path_for(reduction))
+        return paths
+
+    def write_volumes(self, path_for, factors, voxel_size, chunks=DEFAULT_CHUNKS, codec=DEFAULT_CODEC, crop=None, timer=None):
+        '''
+        Writes every reduction of a volume accumulator as a multiscale OME-Zarr pyramid, streamed a
+        plane at a time from the state.
+        Parameters: path_for (callable) - reduction -> pyramid path
+                    factors, voxel_size, chunks, codec, crop - see pyramid.create_pyramid
+                    timer (StageTimer) - records the downsample and write stages
+        Returns: list of paths
+        '''
+        paths = []
+        for reduction in self.reductions:
+            dtype = self.dtype if reduction in ('max', 'min') else np.float32
+            path = path_for(reduction)
+            create_pyramid(path, None, self.shape, dtype, factors, voxel_size, chunks=chunks, codec=codec, name=Path(path).stem,
+                           crop=crop)
+            writer = PyramidWriter(path, timer=timer)
+            for z in range(self.shape[0]):
+                writer.add_plane(self.result(reduction, z))
+            writer.close()
+            paths.append(path)
+        return paths
+
+    def close(self):
+        '''
+        Drops the state, deleting its files when it was memory-mapped.
+        '''
+        self.state = {}
+        if self.state_dir is not None and self.state_dir.exists():
+            shutil.rmtree(self.state_dir)
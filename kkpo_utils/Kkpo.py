@@ -4,11 +4,10 @@ import numpy as np
 from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime
-from tifffile import imread as tiff_read
 from tifffile import imwrite as tiff_write
-from dask_image.imread import imread as dask_read
-#from dask.array.image import imread as dask_read 
-import dask.array as da
+from interact.catalog import Catalog, FIELDS, token
+from interact.readers import open_stack
+from interact.pipeline import run_pipeline, READ_AHEAD
 
 class Kkpo:
 
@@ -19,41 +18,42 @@ class Kkpo:
             print('*****'*9)
             sys.exit()
         self.file_path = Path(file_path)
-        self.files = [file for file in os.listdir(self.file_path) if all([file.endswith('.tif')]) and not any([file.startswith('.'),
-                                                                                                              'MP' in file,
-                                                                                                              'max' in file])]
+        dir_list = os.listdir(self.file_path)
+        self.catalog = Catalog(dir_list)
+        self.settings_catalog = Catalog(dir_list, suffix='_Settings.txt')
+        self.files = self.catalog.names
 
-        self.sample_names = [file.split('_')[0] for file in self.files]
-        self.timepoint_names = [file.split('_')[1] for file in self.files]
-        self.view_names = [file.split('_')[2] for file in self.files]
-        self.region_names = [file.split('_')[3] for file in self.files]
-        self.tileX_names = [file.split('_')[4] for file in self.files]
-        self.tileY_names = [file.split('_')[5] for file in self.files]
-        self.channel_names = [file.split('_')[6] for file in self.files]
-        self.illum_names = [file.split('_')[7] for file in self.files]
-        self.camera_names = [file.split('_')[8] for file in self.files]
-        self.planes = [file.split('_')[9] for file in self.files]
+        self.sample_names = self.catalog.tokens('S')
+        self.timepoint_names = self.catalog.tokens('t')
+        self.view_names = self.catalog.tokens('V')
+        self.region_names = self.catalog.tokens('R')
+        self.tileX_names = self.catalog.tokens('X')
+        self.tileY_names = self.catalog.tokens('Y')
+        self.channel_names = self.catalog.tokens('C')
+        self.illum_names = self.catalog.tokens('I')
+        self.camera_names = self.catalog.tokens('D')
+        self.planes = self.catalog.tokens('P')
 
-        print(f'unique sample names are {np.unique(self.sample_names)}')
-        print(f'unique timepoint names are {np.unique(self.timepoint_names)}')
-        print(f'unique view names are {np.unique(self.view_names)}')
-        print(f'unique region names are {np.unique(self.region_names)}')
-        print(f'unique tileX names are {np.unique(self.tileX_names)}')
-        print(f'unique tileY names are {np.unique(self.tileY_names)}')
-        print(f'unique channel names are {np.unique(self.channel_names)}')
-        print(f'unique illum names are {np.unique(self.illum_names)}')
-        print(f'unique camera names are {np.unique(self.camera_names)}')
-        print(f'unique planes are {np.unique(self.planes)}')
+        print(f'unique sample names are {self.sample_names}')
+        print(f'unique timepoint names are {self.timepoint_names}')
+        print(f'unique view names are {self.view_names}')
+        print(f'unique region names are {self.region_names}')
+        print(f'unique tileX names are {self.tileX_names}')
+        print(f'unique tileY names are {self.tileY_names}')
+        print(f'unique channel names are {self.channel_names}')
+        print(f'unique illum names are {self.illum_names}')
+        print(f'unique camera names are {self.camera_names}')
+        print(f'unique planes are {self.planes}')
 
-        self.num_samples = len(np.unique(self.sample_names))
-        self.num_timepoints = len(np.unique(self.timepoint_names))
-        self.num_views = len(np.unique(self.view_names))
-        self.num_regions = len(np.unique(self.region_names))
-        self.num_tilesX = len(np.unique(self.tileX_names))
-        self.num_tilesY = len(np.unique(self.tileY_names))
-        self.num_channels = len(np.unique(self.channel_names))
-        self.num_illum = len(np.unique(self.illum_names))
-        self.num_cameras = len(np.unique(self.camera_names))
+        self.num_samples = len(self.sample_names)
+        self.num_timepoints = len(self.timepoint_names)
+        self.num_views = len(self.view_names)
+        self.num_regions = len(self.region_names)
+        self.num_tilesX = len(self.tileX_names)
+        self.num_tilesY = len(self.tileY_names)
+        self.num_channels = len(self.channel_names)
+        self.num_illum = len(self.illum_names)
+        self.num_cameras = len(self.camera_names)
 
     def get_interval(self):
         '''
@@ -62,9 +62,9 @@ class Kkpo:
         and the frame interval from the number of time points.
         Returns: frame interval in seconds/frame.
         '''
-        setting_files = [file for file in os.listdir(self.file_path) if "Settings.txt" in file and not file.startswith('.')]
-        first_timepoint_name = [file for file in setting_files if all(match in file for match in [self.timepoint_names[0], self.region_names[0], self.channel_names[0], self.illum_names[0]])]
-        last_timepoint_name = [file for file in setting_files if all(match in file for match in [self.timepoint_names[-1], self.region_names[0], self.channel_names[0], self.illum_names[0]])]
+        settings = self.settings_catalog
+        first_timepoint_name = [settings.name(i) for i in settings.select(t=self.timepoint_names[0], R=self.region_names[0], C=self.channel_names[0], I=self.illum_names[0])]
+        last_timepoint_name = [settings.name(i) for i in settings.select(t=self.timepoint_names[-1], R=self.region_names[0], C=self.channel_names[0], I=self.illum_names[0])]
         
         # quality control
         if len(first_timepoint_name) != 1 or len(last_timepoint_name) != 1:
@@ -93,21 +93,26 @@ class Kkpo:
             return datetime(start_year, start_month, start_day, start_hour, start_minute, start_second)
 
         # read the settings file, get the start and end times
-        first_timepoint_file = np.loadtxt(self.file_path / first_timepoint_name[0], dtype='str', delimiter = '/n')
+        with open(self.file_path / first_timepoint_name[0], "r") as f:
+            first_timepoint_file = [line.rstrip() for line in f]
         self.start_datetime = get_datetime(first_timepoint_file)
-        last_timepoint_file = np.loadtxt(self.file_path / last_timepoint_name[0], dtype='str', delimiter = '/n')
+        with open(self.file_path / last_timepoint_name[0], "r") as f:
+            last_timepoint_file = [line.rstrip() for line in f]
         self.end_datetime = get_datetime(last_timepoint_file)
         self.total_seconds = (self.end_datetime - self.start_datetime).total_seconds()
         self.interval = self.total_seconds / (self.num_timepoints - 1)
         return self.interval
 
-    def save_max_project(self, save_vol = False, downsample = False):
+    def save_max_project(self, save_vol = False, downsample = False, read_ahead = READ_AHEAD, num_workers = 2, memory_mb = None):
         '''
         Loads each timepoint, channel, stage position, etc (still working out the deets), calculates a max projection,
         and saves the projection to file.
         Accepts: 
          - save_vol (bool) - whether or not to also save the full volume to file.
          - downsample - whether or not to downsample the volume.
+         - read_ahead (int) - stacks read ahead of the projections.
+         - num_workers (int) - stacks projected at once.
+         - memory_mb (float) - cap on the stacks and projections held in memory, None for no cap.
         Returns:
          not sure yet.
         '''
@@ -116,32 +121,25 @@ class Kkpo:
         if not os.path.exists(self.max_proj_path):
             os.mkdir(self.max_proj_path)
         
-        max_projection = np.zeros((2048,2048))
-        its = self.num_samples*self.num_timepoints*self.num_views*self.num_regions*self.num_tilesX*self.num_tilesY*self.num_channels*self.num_illum*self.num_cameras
-        with tqdm(total = its, miniters=its/100) as pbar:
+        # every stack in the catalog is one (S, t, V, R, X, Y, C, I, D) combination, so there is nothing to search for.
+        # Stacks are read ahead of the projections and the projections written behind them on other threads
+        def read(index):
+            return np.array(open_stack(self.file_path / self.catalog.name(index)))
+
+        def project(index, img):
+            return np.max(img, axis=0)
+
+        def write(index, max_projection):
+            fields = self.catalog.entry(index)
+            prefix = '_'.join(token(field, fields[field]) for field in FIELDS[:-1])
+            tiff_write(self.max_proj_path / f'{prefix}_max_projection.tif', max_projection)
+            pbar.update(1)
+
+        its = len(self.catalog)
+        with tqdm(total = its, miniters=max(its/100, 1)) as pbar:
             pbar.set_description('Calculating max projections')
-            for samp in range(self.num_samples):
-                for time in range(self.num_timepoints):
-                    for view in range(self.num_views):
-                        for reg in range(self.num_regions):
-                            for tileX in range(self.num_tilesX):
-                                for tileY in range(self.num_tilesY):
-                                    for chan in range(self.num_channels):
-                                        for illum in range(self.num_illum):
-                                            for cam in range(self.num_cameras):
-                                                file_name = [file for file in self.files if all([match in file for match in [ self.sample_names[samp], 
-                                                                                                                              self.timepoint_names[time], 
-                                                                                                                              self.view_names[view], 
-                                                                                                                              self.region_names[reg], 
-                                                                                                                              self.tileX_names[tileX], 
-                                                                                                                              self.tileY_names[tileY], 
-                                                                                                                              self.channel_names[chan], 
-                                                                                                                              self.illum_names[illum], 
-                                                                                                                              self.camera_names[cam]]])][0]
-                                                img = tiff_read(self.file_path / file_name)
-                                                max_projection = np.max(img, axis=0)
-                                                tiff_write(self.max_proj_path /  f'{self.sample_names[samp]}_{self.timepoint_names[time]}_{self.view_names[view]}_{self.region_names[reg]}_{self.tileX_names[tileX]}_{self.tileY_names[tileY]}_{self.channel_names[chan]}_{self.illum_names[illum]}_{self.camera_names[cam]}_max_projection.tif', max_projection)
-                                                pbar.update(1)
+            run_pipeline(list(range(its)), read, project, write, read_ahead=read_ahead, num_workers=num_workers, memory_mb=memory_mb)
+
     def interact(self):
         ''' 
         Dask/Napari interactive workflow
@@ -0,0 +1,15 @@
+import sys
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from interact.synthetic import make_acquisition
+
+
+@pytest.fixture
+def acquisition(tmp_path):
+    '''
+    A small synthetic acquisition: 3 timepoints of two channels with two illumination sides each.
+    '''
+    return make_acquisition(tmp_path / 'acquisition', num_timepoints=3, num_planes=8, height=64, width=80)
@@ -0,0 +1,112 @@
+import os
+import types
+import numpy as np
+import pytest
+import zarr
+from concurrent.futures import ThreadPoolExecutor
+from interact import archive
+from interact.archive import archive_acquisition, archive_stack, archive_name, pixel_checksum, ARCHIVE_MANIFEST, PARTIAL_SUFFIX
+from interact.catalog import Catalog
+from interact.readers import iter_planes, stack_shape
+from interact.synthetic import make_acquisition
+
+STACK = 'S000_t000000_V000_R0000_X000_Y000_C00_I0_D0_P00008.tif'
+
+
+def source_stack(path):
+    return np.stack(list(iter_planes(path)))
+
+
+@pytest.mark.parametrize('raw', [False, True])
+def test_round_trip_is_bit_exact(tmp_path, raw):
+    dir_path = make_acquisition(tmp_path / 'acquisition', num_timepoints=2, num_planes=8, height=64, width=80, raw=raw)
+    out_dir = tmp_path / 'archive'
+    manifest = archive_acquisition(dir_path, out_dir, num_workers=2)
+    catalog = Catalog.from_dir(dir_path)
+    assert not manifest['failures'] and sorted(manifest['stacks']) == catalog.names
+    for name in catalog.names:
+        stack = source_stack(dir_path / name)
+        archived = zarr.open_array(str(out_dir / archive_name(name)), mode='r')
+        assert archived.dtype == stack.dtype
+        np.testing.assert_array_equal(archived[:], stack)
+        assert archived.attrs['checksum'] == pixel_checksum(stack, *stack_shape(dir_path / name))
+    # the readers and the catalog see the same acquisition
+    assert Catalog.from_dir(out_dir).names == [archive_name(name) for name in catalog.names]
+    assert (out_dir / 'FlamingoMetaData.txt').read_bytes() == (dir_path / 'FlamingoMetaData.txt').read_bytes()
+    assert all((dir_path / name).exists() for name in catalog.names)
+
+
+def wrong_checksum(planes, shape, dtype):
+    return '0' * 32
+
+
+class LosesWrites:
+    '''
+    An archive array that only keeps its first block, as if the rest never reached the disk.
+    '''
+
+    def __init__(self, array):
+        self.array = array
+
+    def __getattr__(self, name):
+        return getattr(self.array, name)
+
+    def __setitem__(self, key, value):
+        if key.start == 0:
+            self.array[key] = value
+
+
+def truncating_zarr():
+    def open_array(path, mode='r', **kwargs):
+        array = zarr.open_array(path, mode=mode, **kwargs)
+        return LosesWrites(array) if mode == 'w' else array
+    return types.SimpleNamespace(open_array=open_array)
+
+
+@pytest.mark.parametrize('fault', ['checksum', 'truncated'])
+def test_bad_archive_keeps_the_source(acquisition, tmp_path, monkeypatch, fault):
+    if fault == 'checksum':
+        monkeypatch.setattr(archive, 'pixel_checksum', wrong_checksum)
+    else:
+        monkeypatch.setattr(archive, 'zarr', truncating_zarr())
+    source = acquisition / STACK
+    expected = source.read_bytes()
+    archive_path = tmp_path / archive_name(STACK)
+    with pytest.raises(ValueError):
+        archive_stack(source, archive_path, delete_source=True)
+    assert source.read_bytes() == expected
+    assert not archive_path.exists() and not archive_path.with_name(archive_path.name + PARTIAL_SUFFIX).exists()
+
+
+def test_failures_are_reported_and_retried(acquisition, monkeypatch, capsys):
+    # one thread instead of processes, so the fault reaches the worker and hits one stack only
+    monkeypatch.setattr(archive, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    archive_one = archive.archive_stack
+
+    def archive_faulty(source_path, *args):
+        with monkeypatch.context() as patch:
+            if source_path.name == STACK:
+                patch.setattr(archive, 'pixel_checksum', wrong_checksum)
+            return archive_one(source_path, *args)
+
+    monkeypatch.setattr(archive, 'archive_stack', archive_faulty)
+    names = Catalog.from_dir(acquisition).names
+    manifest = archive_acquisition(acquisition, num_workers=1, delete_originals=True)
+    assert list(manifest['failures']) == [STACK] and STACK not in manifest['stacks']
+    assert (acquisition / STACK).exists() and not (acquisition / archive_name(STACK)).exists()
+    assert not any((acquisition / name).exists() for name in names if name != STACK)
+
+    # the next run only archives what failed
+    monkeypatch.setattr(archive, 'archive_stack', archive_one)
+    capsys.readouterr()
+    manifest = archive_acquisition(acquisition, num_workers=1, delete_originals=True)
+    assert 'Archiving 1 of 1 stacks' in capsys.readouterr().out
+    assert not manifest['failures'] and sorted(manifest['stacks']) == names
+    assert Catalog.from_dir(acquisition).names == [archive_name(name) for name in names]
+
+
+def test_in_place_needs_delete_originals(acquisition):
+    before = sorted(os.listdir(acquisition))
+    with pytest.raises(ValueError):
+        archive_acquisition(acquisition)
+    assert sorted(os.listdir(acquisition)) == before and not (acquisition / ARCHIVE_MANIFEST).exists()
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from interact import batch
+from interact.batch import Manifest, plan_jobs, run_batch, MANIFEST_NAME
+from interact.synthetic import make_acquisition
+
+pytest.importorskip('napari')
+RUN_JOB = batch.run_job
+
+
+class JobSpy:
+    '''
+    Wraps run_job to record the jobs run and the most running at once per disk, and to fail the
+    jobs of the given channels.
+    '''
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.jobs = []
+        self.running = {}
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, dir_path, region_name, ch_name, outputs, **kwargs):
+        disk = os.stat(dir_path).st_dev
+        with self.lock:
+            self.jobs.append((os.path.basename(dir_path), ch_name, list(outputs)))
+            self.running[disk] = self.running.get(disk, 0) + 1
+            self.most_running = max(self.most_running, self.running[disk])
+        try:
+            time.sleep(0.05) # long enough for the other jobs to be started if the disk allowed it
+            if ch_name in self.fail:
+                raise RuntimeError(f'{ch_name} died')
+            return RUN_JOB(dir_path, region_name, ch_name, outputs, **kwargs)
+        finally:
+            with self.lock:
+                self.running[disk] -= 1
+
+
+def test_rerun_only_redoes_what_is_missing(acquisition, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    dirs = [acquisition, make_acquisition(tmp_path / 'second', num_timepoints=2, num_planes=8, height=64, width=80)]
+    manifest_path = tmp_path / MANIFEST_NAME
+
+    spy = JobSpy(fail=['C01'])
+    monkeypatch.setattr(batch, 'run_job', spy)
+    manifest = run_batch(dirs, manifest_path, step=2, max_jobs=4, max_jobs_per_disk=1)
+    assert len(spy.jobs) == 4 and spy.most_running == 1
+    assert len(manifest.failures()) == 4 # max and vol of C01 in both folders
+    done = [unit for unit in manifest.units.values() if unit['status'] == 'done']
+    assert len(done) == 4
+    written = {record['path']: os.stat(record['path']).st_mtime_ns for unit in done for record in unit['files']}
+
+    # a job killed after writing its projections but before its volume
+    volume = acquisition / 'R0000_processed' / 'R0000_C00_volume.zarr'
+    assert str(volume) in written
+    for path in sorted(volume.rglob('*'), reverse=True):
+        path.unlink() if path.is_file() else path.rmdir()
+    volume.rmdir()
+
+    spy = JobSpy()
+    monkeypatch.setattr(batch, 'run_job', spy)
+    manifest = run_batch(dirs, manifest_path, step=2, max_jobs=4, max_jobs_per_disk=1)
+    assert sorted(spy.jobs) == [('acquisition', 'C00', ['vol']), ('acquisition', 'C01', ['max', 'vol']),
+                                ('second', 'C01', ['max', 'vol'])]
+    assert not manifest.failures()
+    # the outputs that survived the first run were left alone, apart from the region hyperstacks
+    # the reconverted channels write into
+    for path, mtime_ns in written.items():
+        if path != str(volume) and not path.endswith('_hyperstack.tif'):
+            assert os.stat(path).st_mtime_ns == mtime_ns, path
+    assert not plan_jobs(dirs, Manifest(manifest_path))
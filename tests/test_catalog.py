@@ -0,0 +1,65 @@
+import os
+import numpy as np
+from interact.catalog import Catalog, parse_name, token, field_value
+
+
+def test_parse_name():
+    assert parse_name('S000_t000012_V000_R0003_X001_Y002_C01_I1_D0_P00100') == (0, 12, 0, 3, 1, 2, 1, 1, 0, 100)
+    assert parse_name('S000_t000012_V000_R0003_X001_Y002_C01_I1_D0')[-1] == -1
+    assert parse_name('R0003_C01_Max') is None
+
+
+def test_tokens_round_trip():
+    assert token('R', 2) == 'R0002'
+    assert token('t', 11) == 't000011'
+    assert field_value('t', 't000011') == 11
+    assert field_value('C', 4) == 4
+
+
+def test_catalog_from_dir(acquisition):
+    catalog = Catalog.from_dir(acquisition)
+    # 3 timepoints x 2 channels x 2 illumination sides; settings, metadata and hidden files are left out
+    assert len(catalog) == 12
+    assert all(name.endswith('.tif') for name in catalog.names)
+    assert catalog.tokens('C').tolist() == ['C00', 'C01']
+    assert catalog.tokens('t').tolist() == ['t000000', 't000001', 't000002']
+    assert catalog.values('I', C='C01').tolist() == [0, 1]
+    settings = Catalog.from_dir(acquisition, suffix='_Settings.txt')
+    assert len(settings) == 12
+
+
+def test_catalog_ignores_hidden_and_foreign_names():
+    catalog = Catalog(['._S000_t000000_V000_R0000_X000_Y000_C00_I0_D0_P00008.tif',
+                       'S000_t000000_V000_R0000_X000_Y000_C00_I0_D0_P00008.tif',
+                       'R0000_C00_Max.tiff', 'notes.txt'])
+    assert catalog.names == ['S000_t000000_V000_R0000_X000_Y000_C00_I0_D0_P00008.tif']
+
+
+def test_find(acquisition):
+    catalog = Catalog.from_dir(acquisition)
+    index = catalog.find(t=1, C='C01', I=1, R='R0000')
+    assert catalog.name(index) == 'S000_t000001_V000_R0000_X000_Y000_C01_I1_D0_P00008.tif'
+    assert catalog.find(t=5, C='C01', I=1, R='R0000') is None
+
+
+def test_illumination_pairs(acquisition):
+    catalog = Catalog.from_dir(acquisition)
+    pairs = catalog.illumination_pairs(R='R0000')
+    assert sorted(pairs) == [(t, c) for t in range(3) for c in range(2)]
+    for (t, c), indices in pairs.items():
+        assert [catalog.entry(index)['I'] for index in indices] == [0, 1]
+        assert {(catalog.entry(index)['t'], catalog.entry(index)['C']) for index in indices} == {(t, c)}
+
+
+def test_illumination_pairs_skip_incomplete_timepoints(acquisition):
+    os.remove(acquisition / 'S000_t000001_V000_R0000_X000_Y000_C00_I1_D0_P00008.tif')
+    pairs = Catalog.from_dir(acquisition).illumination_pairs(R='R0000', C='C00')
+    assert sorted(pairs) == [(0, 0), (2, 0)]
+
+
+def test_from_fields_round_trip(acquisition):
+    catalog = Catalog.from_dir(acquisition)
+    rebuilt = Catalog.from_fields(catalog.names, catalog.fields.tolist())
+    assert rebuilt.names == catalog.names
+    np.testing.assert_array_equal(rebuilt.fields, catalog.fields)
+    assert rebuilt.illumination_pairs(R='R0000') == catalog.illumination_pairs(R='R0000')
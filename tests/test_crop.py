@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from tifffile import imread, imwrite
+from interact.crop import find_crop, check_crop, align_box, sample_timepoints
+
+SHAPE = (32, 128, 160)
+
+
+def write_stack(path, bright=(), level=2000, seed=0):
+    '''
+    A noisy background stack with bright boxes, ((z0, z1), (y0, y1), (x0, x1)) each.
+    '''
+    stack = np.random.default_rng(seed).normal(100, 5, SHAPE).astype(np.uint16)
+    for (z0, z1), (y0, y1), (x0, x1) in bright:
+        stack[z0:z1, y0:y1, x0:x1] = level
+    imwrite(path, stack, contiguous=True)
+    return path
+
+
+def contains(crop, box):
+    return all(start <= box_start and box_stop <= stop for (start, stop), (box_start, box_stop) in zip(crop, box))
+
+
+def test_box_is_found_on_the_sampling_grid(tmp_path):
+    box = ((8, 20), (40, 72), (48, 100))
+    path = write_stack(tmp_path / 'stack.tif', [box])
+    # every 4th plane and 8th row and column is sampled, so the edges land on that grid, the far
+    # ones past the last sampled bright pixel, and Z is padded by a sampling step
+    assert find_crop([[path]], SHAPE, margin=0) == ((4, 24), (40, 72), (48, 104))
+    crop = find_crop([[path]], SHAPE, margin=16)
+    assert crop == ((4, 24), (24, 88), (32, 120))
+    assert contains(crop, box)
+
+
+def test_box_is_clamped_to_the_stack(tmp_path):
+    # a sample touching the first row, the last column and the last plane
+    box = ((26, 32), (0, 24), (128, 160))
+    path = write_stack(tmp_path / 'stack.tif', [box])
+    crop = find_crop([[path]], SHAPE, margin=32, alignment=(2, 16, 16))
+    # plane 28 is the first sampled bright one
+    assert crop == ((24, 32), (0, 64), (96, 160))
+    assert contains(crop, box)
+    # snapping outwards stops at the edge of a stack that is not a whole number of blocks
+    assert align_box(((25, 31), (100, 120), (140, 150)), (31, 125, 150), margin=8, alignment=(2, 16, 16), z_margin=0) == \
+        ((24, 31), (80, 125), (128, 150))
+
+
+def test_box_covers_every_side_and_timepoint(tmp_path):
+    sides = [write_stack(tmp_path / 'I0.tif', [((8, 12), (40, 56), (40, 56))]),
+             write_stack(tmp_path / 'I1.tif', [((8, 12), (40, 56), (104, 120))], seed=1)]
+    later = [write_stack(tmp_path / 'later.tif', [((16, 24), (96, 112), (72, 88))], seed=2)]
+    crop = find_crop([sides, later], SHAPE, margin=0)
+    assert crop == ((4, 28), (40, 112), (40, 120))
+
+
+def test_empty_stacks_are_not_cropped(tmp_path):
+    imwrite(tmp_path / 'flat.tif', np.full(SHAPE, 100, np.uint16), contiguous=True)
+    assert find_crop([[tmp_path / 'flat.tif']], SHAPE) is None
+
+
+def test_check_crop():
+    assert check_crop((None, (-4, 40), (10, 500)), SHAPE) == ((0, 32), (0, 40), (10, 160))
+    with pytest.raises(ValueError):
+        check_crop(((0, 4), (40, 40), None), SHAPE)
+    with pytest.raises(ValueError):
+        check_crop(((0, 4), None), SHAPE)
+
+
+def test_sample_timepoints():
+    assert sample_timepoints(3) == [0, 1, 2]
+    assert sample_timepoints(100, 4) == [0, 33, 66, 99]
+
+
+def test_kkpo_crop_holds_the_sample_at_every_timepoint(acquisition):
+    pytest.importorskip('napari')
+    from interact.kkpo import Kkpo
+    # replace the synthetic sample with boxes: one that moves down in C00, one that stays put in C01
+    rng = np.random.default_rng(0)
+    for path in acquisition.glob('*_R0000_*.tif'):
+        t, ch_name = int(path.name.split('_')[1][1:]), path.name.split('_')[6]
+        stack = rng.normal(100, 5, (8, 64, 80)).astype(np.uint16)
+        if ch_name == 'C00':
+            stack[2:6, 16 + 8 * t:32 + 8 * t, 24:40] = 2000
+        else:
+            stack[2:6, 16:40, 48:64] = 2000
+        imwrite(path, stack, contiguous=True)
+    kkpo = Kkpo(acquisition)
+    # the sampled union is z 4:8, y 16:48, x 24:64; Z is always padded by a sampling step, and at
+    # 10x a pyramid to step 8 snaps the padded box to 2 x 8 x 8 blocks
+    assert kkpo.find_crop('R0000', margin=0, step=8) == ((0, 8), (16, 48), (24, 64))
+    assert kkpo.find_crop('R0000', margin=4, step=8) == ((0, 8), (8, 56), (16, 72))
+    assert kkpo.find_crop('R0000', margin=32, step=8) == ((0, 8), (0, 64), (0, 80))
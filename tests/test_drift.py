@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from interact.drift import phase_correlation, estimate_drift, prepare, projections, binned, translate, shift_image
+from interact.synthetic import sample_plane
+
+
+def sample(shift=(0, 0, 0), shape=(16, 128, 128)):
+    '''
+    A noisy blob volume moved by a whole number of pixels per axis.
+    '''
+    rng = np.random.default_rng(0)
+    blobs = [(8, 50, 40, 5, 3000), (6, 80, 90, 6, 2000), (10, 40, 80, 4, 2500)]
+    volume = np.stack([sample_plane(rng, z, shape[0], shape[1], shape[2], blobs) for z in range(shape[0])])
+    for axis, offset in enumerate(shift):
+        volume = translate(volume, axis, offset)
+    return volume
+
+
+def test_phase_correlation_finds_integer_shift():
+    reference = sample()
+    moved = sample((0, -3, 2))
+    shift, peak = phase_correlation(prepare(reference.max(axis=0)), prepare(moved.max(axis=0)))
+    np.testing.assert_allclose(shift, (3, -2), atol=0.05)
+    assert peak > 0.5
+
+
+def test_phase_correlation_finds_subpixel_shift():
+    reference = sample().max(axis=0).astype(np.float32)
+    moved = shift_image(reference, (1.5, -2.25))
+    shift, _ = phase_correlation(prepare(reference), prepare(moved))
+    np.testing.assert_allclose(shift, (-1.5, 2.25), atol=0.1)
+
+
+@pytest.mark.parametrize('reference', ['previous', 'first'])
+def test_estimate_drift_from_binned_projections(reference):
+    offsets = [(0, 0, 0), (0, -3, 2), (0, -6, 4)]
+    frames = [{name: binned(image, 2) for name, image in projections(sample(offset)).items()} for offset in offsets]
+    shifts, peaks = estimate_drift(frames, scale=(2, 2, 2), reference=reference)
+    np.testing.assert_allclose(shifts[:, 1:], -np.array(offsets)[:, 1:], atol=0.15)
+    assert shifts[0].tolist() == [0, 0, 0]
+    assert (peaks > 0.5).all()
+
+
+def test_estimate_drift_rejects_unknown_reference():
+    with pytest.raises(ValueError):
+        estimate_drift([], reference='last')
+
+
+def test_shift_image_round_trip():
+    image = sample().max(axis=0)
+    shifted = shift_image(shift_image(image, (4, -3)), (-4, 3))
+    np.testing.assert_array_equal(shifted[8:-8, 8:-8], image[8:-8, 8:-8])
+
+
+def test_correct_drift_recovers_synthetic_drift(acquisition):
+    pytest.importorskip('napari')
+    from interact.kkpo import Kkpo
+    kkpo = Kkpo(acquisition)
+    kkpo.save_regions(save_vol=True, max_format='tiff')
+    record = kkpo.correct_drift('R0000')
+    # make_acquisition moves the sample 1 px in Y and 0.5 px in X per timepoint
+    shifts = np.array(record['shifts'])
+    np.testing.assert_allclose(shifts[:, 1], [0, -1, -2], atol=0.25)
+    np.testing.assert_allclose(shifts[:, 2], [0, -0.5, -1], atol=0.25)
@@ -0,0 +1,52 @@
+import numpy as np
+from tifffile import imread
+from interact.engine import convert_timepoint, convert_timepoints
+from interact.pipeline import PlaneReader, ByteBudget
+
+
+def stack_paths(acquisition, t=0, ch_name='C00'):
+    return [acquisition / f'S000_t{t:06d}_V000_R0000_X000_Y000_{ch_name}_{side}_D0_P00008.tif' for side in ('I0', 'I1')]
+
+
+def test_local_and_streamed_runs_record_the_same_stages(acquisition, tmp_path):
+    jobs = [{'stack_paths': stack_paths(acquisition, t), 'max_path': tmp_path / f'{t}.tiff'} for t in range(3)]
+    streamed = convert_timepoint(**jobs[0])
+    local = convert_timepoints(jobs, num_workers=2)
+    stack_bytes = sum(imread(path).nbytes for path in jobs[0]['stack_paths'])
+    for stats in [streamed] + local:
+        assert set(stats['stages']) == set(streamed['stages'])
+        assert stats['stages']['read']['bytes_read'] == stack_bytes
+    for job in jobs:
+        np.testing.assert_array_equal(imread(job['max_path']), np.maximum(*[imread(path) for path in job['stack_paths']]).max(axis=0))
+
+
+def test_plane_reader_holds_only_its_budget(acquisition):
+    paths = stack_paths(acquisition)
+    stacks = [imread(path) for path in paths]
+    slab_bytes = 2 * sum(stack[0].nbytes for stack in stacks)
+    budget = ByteBudget(slab_bytes)
+    reader = PlaneReader(paths, crop=((1, 7), (0, 64), (8, 72)), budget=budget, depth=4, slab=2)
+    read = []
+    for planes in reader:
+        assert budget.used <= slab_bytes
+        read.append(planes)
+    for side, stack in enumerate(stacks):
+        np.testing.assert_array_equal(np.stack([planes[side] for planes in read]), stack[1:7, :, 8:72])
+    assert reader.num_bytes == sum(stack[1:7, :, 8:72].nbytes for stack in stacks)
+    assert budget.used == 0
+
+
+def test_plane_reader_gives_back_its_budget_when_closed_early(acquisition):
+    budget = ByteBudget()
+    reader = PlaneReader(stack_paths(acquisition), budget=budget, slab=1)
+    next(iter(reader))
+    reader.close()
+    assert budget.used == 0 and not reader.thread.is_alive()
+
+
+def test_small_memory_cap_converts_the_same(acquisition, tmp_path):
+    jobs = [{'stack_paths': stack_paths(acquisition, t), 'max_path': tmp_path / f'{t}.tiff'} for t in range(3)]
+    # less than one slab: the readers take turns instead of stalling
+    convert_timepoints(jobs, num_workers=3, read_ahead=1, memory_mb=0.01)
+    for job in jobs:
+        np.testing.assert_array_equal(imread(job['max_path']), np.maximum(*[imread(path) for path in job['stack_paths']]).max(axis=0))
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from tifffile import imread
+from interact.fusion import Fuser, blend_weights, default_reducer
+
+
+def side_planes(acquisition, z=4):
+    '''
+    Plane z of the I0 and I1 stacks of the first timepoint of C00.
+    '''
+    return [imread(acquisition / f'S000_t000000_V000_R0000_X000_Y000_C00_{side}_D0_P00008.tif')[z] for side in ('I0', 'I1')]
+
+
+def reference(method, planes):
+    stack = np.stack(planes).astype(np.float64)
+    if method == 'max':
+        return stack.max(axis=0)
+    if method == 'min':
+        return stack.min(axis=0)
+    if method == 'mean':
+        return np.rint(stack.mean(axis=0))
+    weight = blend_weights(method, stack.shape[-1]).astype(np.float64)
+    return np.rint(weight * stack[0] + (1 - weight) * stack[1])
+
+
+@pytest.mark.parametrize('method', ['max', 'min', 'mean', 'linear', 'sigmoid'])
+def test_fuser_matches_numpy(acquisition, method):
+    planes = side_planes(acquisition)
+    fuser = Fuser(method, planes[0].shape, planes[0].dtype, illuminations=[0, 1])
+    fused = fuser.fuse(planes)
+    assert fused.dtype == planes[0].dtype
+    # the weighted sums are accumulated in float32, so they may round the other way at .5
+    np.testing.assert_allclose(fused, reference(method, planes), atol=1)
+    if method in ('max', 'min'):
+        np.testing.assert_array_equal(fused, reference(method, planes))
+
+
+def test_fuser_reuses_its_buffer(acquisition):
+    planes = side_planes(acquisition)
+    fuser = Fuser('mean', planes[0].shape, planes[0].dtype)
+    first = fuser.fuse(planes)
+    assert fuser.fuse(planes[::-1]) is first
+
+
+def test_weighted_fusion_of_four_sides(acquisition):
+    # with two cameras the detection sides of an illumination share its weight
+    planes = side_planes(acquisition)
+    fuser = Fuser('linear', planes[0].shape, planes[0].dtype, illuminations=[0, 1, 0, 1])
+    fused = fuser.fuse([planes[0], planes[1], planes[0], planes[1]])
+    np.testing.assert_allclose(fused, reference('linear', planes), atol=1)
+
+
+def test_cropped_weights_follow_the_full_field(acquisition):
+    planes = side_planes(acquisition)
+    full = Fuser('sigmoid', planes[0].shape, np.float32, illuminations=[0, 1]).fuse([plane.astype(np.float32) for plane in planes])
+    cropped = Fuser('sigmoid', (planes[0].shape[0], 30), np.float32, illuminations=[0, 1], x_start=20,
+                    full_width=planes[0].shape[1]).fuse([plane[:, 20:50].astype(np.float32) for plane in planes])
+    np.testing.assert_allclose(cropped, full[:, 20:50], rtol=1e-6)
+
+
+def test_single_plane_is_returned_as_is(acquisition):
+    plane = side_planes(acquisition)[0]
+    assert Fuser('max', plane.shape, plane.dtype).fuse([plane]) is plane
+
+
+def test_fuser_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        Fuser('median', (4, 4), np.uint16)
+    with pytest.raises(ValueError):
+        Fuser('linear', (4, 4), np.uint16, illuminations=[0, 0])
+
+
+def test_default_reducer():
+    assert default_reducer('C04') == 'min'
+    assert default_reducer('C01') == 'max'
@@ -0,0 +1,44 @@
+import os
+import shutil
+import time
+from interact.index import AcquisitionIndex, INDEX_NAME
+
+STACK = 'S000_t000000_V000_R0000_X000_Y000_C00_I0_D0_P00008.tif'
+COPY = 'S000_t000003_V000_R0000_X000_Y000_C00_I0_D0_P00008.tif'
+
+
+def scan_names(acquisition):
+    '''
+    Stack names seen by a fresh index reopened from the sidecar.
+    '''
+    index = AcquisitionIndex(acquisition)
+    stacks, _ = index.scan()
+    index.save()
+    return stacks.names
+
+
+def keep_folder_time(acquisition, mtime_ns):
+    # a file system or network share whose folder time did not move
+    os.utime(acquisition, ns=(mtime_ns, mtime_ns))
+
+
+def test_index_is_reused(acquisition):
+    names = scan_names(acquisition)
+    assert (acquisition / INDEX_NAME).exists()
+    assert len(names) == 12 and scan_names(acquisition) == names
+
+
+def test_adding_or_removing_a_file_invalidates_the_index(acquisition):
+    # old enough that the folder time alone would say the index is current
+    mtime_ns = time.time_ns() - 60 * 10**9
+    keep_folder_time(acquisition, mtime_ns)
+    names = scan_names(acquisition)
+    assert COPY not in names
+
+    shutil.copy(acquisition / STACK, acquisition / COPY)
+    keep_folder_time(acquisition, mtime_ns)
+    assert scan_names(acquisition) == sorted(names + [COPY])
+
+    os.remove(acquisition / STACK)
+    keep_folder_time(acquisition, mtime_ns)
+    assert scan_names(acquisition) == sorted(set(names) - {STACK} | {COPY})
@@ -0,0 +1,30 @@
+import os
+import errno
+import numpy as np
+import pytest
+from interact.hyperstack import hyperstack_layout
+
+pytest.importorskip('napari')
+from interact.kkpo import Kkpo
+
+
+@pytest.mark.parametrize('link_error', [None, errno.EPERM, errno.ENOTSUP])
+def test_max_hyperstack_is_created_once(acquisition, monkeypatch, link_error):
+    if link_error is not None:
+        # exFAT and many SMB shares have no hard links
+        def link(src, dst):
+            raise OSError(link_error, os.strerror(link_error))
+        monkeypatch.setattr(os, 'link', link)
+    kkpo = Kkpo(acquisition)
+    hyperstack = kkpo.max_hyperstack('R0000', kkpo.get_region_info('R0000'))
+    hyperstack['path'].parent.mkdir()
+    assert kkpo.open_max_hyperstack('R0000', hyperstack, (64, 80), np.uint16)
+    # a second channel keeps the first one's file, and a mismatched one is left out of it
+    inode = os.stat(hyperstack['path']).st_ino
+    assert kkpo.open_max_hyperstack('R0000', hyperstack, (64, 80), np.uint16)
+    assert not kkpo.open_max_hyperstack('R0000', hyperstack, (32, 40), np.uint16)
+    assert os.stat(hyperstack['path']).st_ino == inode
+    assert hyperstack_layout(hyperstack['path'])['shape'] == (3, 2, 64, 80)
+    # no temporary copies are left behind
+    name = hyperstack['path'].name
+    assert {path.name for path in hyperstack['path'].parent.iterdir()} <= {name, f'.{name}.lock'}
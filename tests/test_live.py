@@ -0,0 +1,87 @@
+import shutil
+import threading
+import time
+import numpy as np
+import pytest
+import zarr
+from tifffile import imread
+
+pytest.importorskip('napari')
+from interact.kkpo import Kkpo
+from interact.live import LiveConverter
+
+CHANNELS = ('C00', 'C01')
+
+
+def stack_names(t, ch_name):
+    return [f'S000_t{t:06d}_V000_R0000_X000_Y000_{ch_name}_{side}_D0_P00008' for side in ('I0', 'I1')]
+
+
+def start_timepoint(acquisition, live_dir, t):
+    '''
+    Writes the settings files and stacks of a timepoint into the watched folder, leaving the last
+    stack half written, as when the microscope's writer lags behind the next timepoint.
+    Returns: (open file, the rest of its bytes)
+    '''
+    names = [name for ch_name in CHANNELS for name in stack_names(t, ch_name)]
+    for name in names:
+        shutil.copy(acquisition / f'{name}_Settings.txt', live_dir / f'{name}_Settings.txt')
+    for name in names[:-1]:
+        shutil.copy(acquisition / f'{name}.tif', live_dir / f'{name}.tif')
+    data = (acquisition / f'{names[-1]}.tif').read_bytes()
+    f = open(live_dir / f'{names[-1]}.tif', 'wb')
+    f.write(data[:len(data) // 2])
+    f.flush()
+    return f, data[len(data) // 2:]
+
+
+def finish_stack(pending):
+    f, rest = pending
+    f.write(rest)
+    f.close()
+
+
+def fused(acquisition, t, ch_name):
+    return np.maximum(*[imread(acquisition / f'{name}.tif') for name in stack_names(t, ch_name)])
+
+
+def test_timepoints_are_converted_as_they_land(acquisition, tmp_path):
+    live_dir = tmp_path / 'live'
+    live_dir.mkdir()
+    shutil.copy(acquisition / 'FlamingoMetaData.txt', live_dir)
+    # a stack has to sit unchanged for longer than the writer pauses before it is read
+    converter = LiveConverter(Kkpo(live_dir), save_vol=True, step=2, settle_time=0.5, max_format='both', temporal_reductions=('max',))
+    events = []
+    watcher = threading.Thread(target=lambda: events.extend(converter.watch(poll_interval=0.02, idle_timeout=1.5)))
+    watcher.start()
+    pending = None
+    for t in range(3):
+        started = start_timepoint(acquisition, live_dir, t)
+        if pending is not None:
+            # the previous timepoint looks complete but its last stack is still growing
+            time.sleep(0.2)
+            finish_stack(pending)
+        pending = started
+    finish_stack(pending)
+    watcher.join(timeout=60)
+    assert not watcher.is_alive()
+    assert [(region_name, t) for region_name, t, _ in events] == [('R0000', 0), ('R0000', 1), ('R0000', 2)]
+
+    out_dir = live_dir / 'R0000_processed'
+    volumes = {ch_name: np.stack([fused(acquisition, t, ch_name) for t in range(3)]) for ch_name in CHANNELS}
+    # the hyperstack was grown by doubling and trimmed back once the acquisition finished
+    hyperstack = imread(out_dir / 'R0000_Max_hyperstack.tif')
+    assert hyperstack.shape == (3, 2, 64, 80)
+    for c, ch_name in enumerate(CHANNELS):
+        projections = volumes[ch_name].max(axis=1)
+        np.testing.assert_array_equal(hyperstack[:, c], projections)
+        for t in range(3):
+            np.testing.assert_array_equal(imread(out_dir / f'R0000_{ch_name}_t{t:06d}_Max.tiff'), projections[t])
+        root = zarr.open_group(str(out_dir / f'R0000_{ch_name}_volume.zarr'), mode='r')
+        assert root['0'].shape == (3, 8, 64, 80)
+        np.testing.assert_array_equal(root['0'][:], volumes[ch_name])
+        # the frame interval comes from the settings timestamps
+        assert root.attrs['multiscales'][0]['datasets'][0]['coordinateTransformations'][0]['scale'][0] == 30
+        np.testing.assert_array_equal(imread(out_dir / f'R0000_{ch_name}_TMax.tiff'), projections.max(axis=0))
+        temporal = zarr.open_group(str(out_dir / f'R0000_{ch_name}_TMax_volume.zarr'), mode='r')
+        np.testing.assert_array_equal(temporal['0'][:], volumes[ch_name].max(axis=0))
@@ -0,0 +1,105 @@
+import numpy as np
+import zarr
+from tifffile import imread, imwrite
+from interact.mosaic import tile_offsets, overlap_widths, tile_weights, mosaic_projection, mosaic_volume, parse_stage_position
+from interact.pyramid import create_pyramid
+
+TILE_SHAPE = (64, 80)
+TILES = [(0, 0), (1, 0)] # side by side in X, sharing 8 columns
+PIXEL_SIZE = 0.64
+
+
+def reference_weights(shape, ramp):
+    '''
+    Linear ramps written out pixel by pixel: the distance to the nearest edge, counting the edge
+    pixel as 1, over the ramp width plus one, capped at 1.
+    '''
+    weights = np.ones(shape)
+    for y in range(shape[0]):
+        for x in range(shape[1]):
+            for axis, index in enumerate((y, x)):
+                if ramp[axis]:
+                    distance = min(index + 1, shape[axis] - index)
+                    weights[y, x] *= min(distance / (ramp[axis] + 1), 1)
+    return weights
+
+
+def reference_blend(tiles, offsets, canvas_shape, ramp):
+    '''
+    Weighted mean of the tiles in float64, rounded, black where no tile lands.
+    '''
+    leading = next(iter(tiles.values())).shape[:-2]
+    total = np.zeros((*leading, *canvas_shape))
+    weight = np.zeros(canvas_shape)
+    for tile, image in tiles.items():
+        y0, x0 = offsets[tile]
+        weights = reference_weights(image.shape[-2:], ramp)
+        total[..., y0:y0 + image.shape[-2], x0:x0 + image.shape[-1]] += image * weights
+        weight[y0:y0 + image.shape[-2], x0:x0 + image.shape[-1]] += weights
+    return np.rint(np.divide(total, weight, out=np.zeros_like(total), where=weight > 0))
+
+
+def layout():
+    # stage positions in mm as the settings files record them, the second tile 72 pixels along X
+    positions = {tile: parse_stage_position(f'X (mm) = {1 + tile[0] * 72 * PIXEL_SIZE / 1000:.6f}\nY (mm) = 2.5\n') for tile in TILES}
+    return tile_offsets(TILES, positions, TILE_SHAPE, PIXEL_SIZE)
+
+
+def test_tile_offsets_and_overlap():
+    offsets, canvas_shape = layout()
+    assert offsets == {(0, 0): (0, 0), (1, 0): (0, 72)} and canvas_shape == (64, 152)
+    assert overlap_widths(offsets, TILE_SHAPE) == (0, 8)
+    # without stage positions the tiles go on a grid with the default overlap
+    assert tile_offsets(TILES, {}, TILE_SHAPE, PIXEL_SIZE, overlap=0.1) == (offsets, canvas_shape)
+
+
+def test_tile_weights_match_the_reference():
+    np.testing.assert_allclose(tile_weights((12, 20), (3, 5)), reference_weights((12, 20), (3, 5)), rtol=1e-6)
+    np.testing.assert_allclose(tile_weights(TILE_SHAPE, (0, 8))[:, 0], 1 / 9, rtol=1e-6)
+    assert tile_weights(TILE_SHAPE, (0, 8)).dtype == np.float32
+
+
+def test_mosaic_projection_matches_numpy(tmp_path):
+    offsets, canvas_shape = layout()
+    ramp = overlap_widths(offsets, TILE_SHAPE)
+    rng = np.random.default_rng(0)
+    tiles = {tile: rng.integers(100, 4000, TILE_SHAPE, dtype=np.uint16) for tile in TILES}
+    tile_paths = {tile: tmp_path / f'X{tile[0]:03d}_Max.tiff' for tile in TILES}
+    for tile, image in tiles.items():
+        imwrite(tile_paths[tile], image)
+    out_path = mosaic_projection(tile_paths, offsets, canvas_shape, tile_weights(TILE_SHAPE, ramp), out_path=tmp_path / 'mosaic.tiff')
+    mosaic = imread(out_path)
+    expected = reference_blend(tiles, offsets, canvas_shape, ramp)
+    # float32 sums may round the other way at .5
+    np.testing.assert_allclose(mosaic, expected, atol=1)
+    # where only one tile lands its pixels are kept as they are
+    np.testing.assert_array_equal(mosaic[:, :72], tiles[(0, 0)][:, :72])
+    np.testing.assert_array_equal(mosaic[:, 80:], tiles[(1, 0)][:, 8:])
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['X000_Max.tiff', 'X001_Max.tiff', 'mosaic.tiff']
+
+
+def test_mosaic_volume_is_blended_slab_by_slab(tmp_path):
+    offsets, canvas_shape = layout()
+    ramp = overlap_widths(offsets, TILE_SHAPE)
+    shape = (10, *TILE_SHAPE)
+    factors = [(1, 1, 1), (1, 2, 2)]
+    rng = np.random.default_rng(1)
+    volumes = {tile: rng.integers(100, 4000, (2, *shape), dtype=np.uint16) for tile in TILES}
+    tile_volumes = {}
+    for tile, volume in volumes.items():
+        tile_path = tmp_path / f'X{tile[0]:03d}_volume.zarr'
+        # 4 plane chunks, so the mosaic is blended in slabs of 4, 4 and 2 planes
+        create_pyramid(tile_path, 2, shape, volume.dtype, factors, (2.5, PIXEL_SIZE, PIXEL_SIZE), chunks=(4, 32, 32))
+        zarr.open_group(str(tile_path), mode='r+')['0'][:] = volume
+        tile_volumes[tile] = (tile_path, {0: 0, 1: 1})
+    # the second tile's timepoints are stored the other way round
+    volumes[(1, 0)] = volumes[(1, 0)][::-1]
+    tile_volumes[(1, 0)] = (tile_volumes[(1, 0)][0], {0: 1, 1: 0})
+
+    vol_path = mosaic_volume(tile_volumes, offsets, canvas_shape, shape, ramp, tmp_path / 'mosaic.zarr', (2.5, PIXEL_SIZE, PIXEL_SIZE))
+    root = zarr.open_group(str(vol_path), mode='r')
+    assert root['0'].shape == (2, 10, *canvas_shape) and root['1'].shape == (2, 10, 32, 76)
+    for tp in range(2):
+        expected = reference_blend({tile: volume[tp] for tile, volume in volumes.items()}, offsets, canvas_shape, ramp)
+        np.testing.assert_allclose(root['0'][tp], expected, atol=1)
+    assert not list(tmp_path.glob('*.mosaic'))
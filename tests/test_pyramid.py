@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+import zarr
+from tifffile import imread
+from interact.pyramid import pyramid_factors, block_mean_xy, create_pyramid, open_pyramid, PyramidWriter
+from interact.engine import convert_timepoint
+
+
+def stack_paths(acquisition, t=0, ch_name='C00'):
+    return [acquisition / f'S000_t{t:06d}_V000_R0000_X000_Y000_{ch_name}_{side}_D0_P00008.tif' for side in ('I0', 'I1')]
+
+
+def level_reference(volume, factor):
+    '''
+    Block mean of a volume with edge padding in XY and partial blocks averaged in Z, rounded to
+    the volume's integer type.
+    '''
+    planes = [block_mean_xy(plane, factor[1]).astype(np.float64) for plane in volume]
+    blocks = [np.mean(planes[start:start + factor[0]], axis=0) for start in range(0, len(planes), factor[0])]
+    return np.rint(np.stack(blocks)).astype(volume.dtype)
+
+
+def write_volume(vol_path, volume, factors):
+    create_pyramid(vol_path, None, volume.shape, volume.dtype, factors, (2.5, 0.64, 0.64), interval=30)
+    writer = PyramidWriter(vol_path)
+    for plane in volume:
+        writer.add_plane(plane)
+    writer.close()
+    return zarr.open_group(str(vol_path), mode='r')
+
+
+def test_pyramid_factors():
+    # 10x: 0.64 um pixels, 2.5 um planes; Z is only averaged once the XY pixels pass 5 um
+    assert pyramid_factors(8, 0.64, 2.5) == [(1, 1, 1), (1, 2, 2), (1, 4, 4), (2, 8, 8)]
+    assert pyramid_factors(1, 0.64, 2.5) == [(1, 1, 1)]
+
+
+def test_block_mean_xy_pads_edges():
+    plane = np.arange(15, dtype=np.uint16).reshape(3, 5)
+    mean = block_mean_xy(plane, 2)
+    assert mean.shape == (2, 3)
+    assert mean[1, 2] == plane[2, 4]
+    assert mean[0, 0] == plane[:2, :2].mean()
+
+
+@pytest.mark.parametrize('factors', [[(1, 1, 1), (1, 2, 2)], [(1, 1, 1), (2, 2, 2), (4, 4, 4)]])
+def test_pyramid_levels(acquisition, tmp_path, factors):
+    # an odd shape, so every level has partial blocks at the edges
+    volume = imread(stack_paths(acquisition)[0])[:7, :61, :75]
+    root = write_volume(tmp_path / 'volume.zarr', volume, factors)
+    np.testing.assert_array_equal(root['0'][:], volume)
+    for level, factor in enumerate(factors[1:], start=1):
+        expected = level_reference(volume, factor)
+        assert root[str(level)].shape == expected.shape
+        # float32 block sums may round the other way at .5
+        np.testing.assert_allclose(root[str(level)][:], expected, atol=1)
+
+
+def test_pyramid_timepoints(acquisition, tmp_path):
+    factors = [(1, 1, 1), (1, 2, 2)]
+    volumes = [imread(stack_paths(acquisition, t)[0]) for t in range(3)]
+    vol_path = tmp_path / 'volume.zarr'
+    create_pyramid(vol_path, 3, volumes[0].shape, volumes[0].dtype, factors, (2.5, 0.64, 0.64), interval=30)
+    for tp in (2, 0, 1):
+        writer = PyramidWriter(vol_path, tp)
+        for plane in volumes[tp]:
+            writer.add_plane(plane)
+        writer.close()
+    root = zarr.open_group(str(vol_path), mode='r')
+    np.testing.assert_array_equal(root['0'][:], np.stack(volumes))
+    assert root['1'].shape == (3, 8, 32, 40)
+
+
+def test_ome_scales(tmp_path):
+    factors = pyramid_factors(8, 0.64, 2.5)
+    root = create_pyramid(tmp_path / 'volume.zarr', 4, (8, 64, 80), np.uint16, factors, (2.5, 0.64, 0.64), interval=30,
+                          crop=((2, 10), (16, 80), (8, 88)))
+    multiscales = root.attrs['multiscales'][0]
+    assert [axis['name'] for axis in multiscales['axes']] == ['t', 'z', 'y', 'x']
+    for dataset, factor in zip(multiscales['datasets'], factors):
+        scale, translation = dataset['coordinateTransformations']
+        np.testing.assert_allclose(scale['scale'], [30, 2.5 * factor[0], 0.64 * factor[1], 0.64 * factor[2]])
+        np.testing.assert_allclose(translation['translation'], [0, 5, 10.24, 5.12])
+    assert root.attrs['downsample_factors'] == [list(factor) for factor in factors]
+    levels, scales = open_pyramid(tmp_path / 'volume.zarr')
+    assert [level.shape for level in levels] == [(4, 8, 64, 80), (4, 8, 32, 40), (4, 8, 16, 20), (4, 4, 8, 10)]
+    assert scales[1] == [30, 2.5, 1.28, 1.28]
+
+
+def test_converted_level_0_is_the_fusion(acquisition, tmp_path):
+    paths = stack_paths(acquisition)
+    shape = imread(paths[0]).shape
+    vol_path = tmp_path / 'volume.zarr'
+    create_pyramid(vol_path, None, shape, np.uint16, [(1, 1, 1), (1, 2, 2)], (2.5, 0.64, 0.64))
+    convert_timepoint(paths, max_path=tmp_path / 'max.tiff', vol_path=vol_path, fusion='max')
+    fused = np.maximum(*[imread(path) for path in paths])
+    root = zarr.open_group(str(vol_path), mode='r')
+    np.testing.assert_array_equal(root['0'][:], fused)
+    np.testing.assert_allclose(root['1'][:], level_reference(fused, (1, 2, 2)), atol=1)
+    np.testing.assert_array_equal(imread(tmp_path / 'max.tiff'), fused.max(axis=0))
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from tifffile import imread
+from interact.catalog import Catalog
+from interact.engine import convert_timepoint
+from interact.qc import StackStats, stack_keys, write_qc, read_qc, qc_name, focus_score, KEY_COLUMNS
+
+
+def channel_records(acquisition, ch_name):
+    '''
+    QC records of every stack of a channel, collected by the engine.
+    '''
+    catalog = Catalog.from_dir(acquisition)
+    records = []
+    for indices in catalog.illumination_pairs(R='R0000', C=ch_name).values():
+        paths = [acquisition / catalog.name(index) for index in indices]
+        stats = convert_timepoint(paths, qc=True)['qc']
+        records += [(stack_keys(path), stack_stats) for path, stack_stats in zip(paths, stats)]
+    return records
+
+
+def test_qc_has_a_row_per_stack(acquisition, tmp_path):
+    path = tmp_path / qc_name('R0000')
+    for ch_name in ('C00', 'C01'):
+        write_qc(path, channel_records(acquisition, ch_name))
+    table = read_qc(path)
+    # 3 timepoints x 2 channels x 2 illumination sides
+    assert len(table['timepoint']) == 12
+    assert table['plane_mean'].shape == (12, 8)
+    assert len(set(zip(*(table[column] for column in KEY_COLUMNS)))) == 12
+
+    # reconverting a channel replaces its rows instead of adding more
+    write_qc(path, channel_records(acquisition, 'C01'))
+    assert len(read_qc(path)['timepoint']) == 12
+
+
+def test_qc_columns_match_the_stack(acquisition, tmp_path):
+    keys, stats = channel_records(acquisition, 'C00')[0]
+    assert keys == {'tile': '', 'timepoint': 't000000', 'channel': 'C00', 'illumination': 'I0', 'camera': 'D0'}
+    stack = imread(acquisition / 'S000_t000000_V000_R0000_X000_Y000_C00_I0_D0_P00008.tif')
+    np.testing.assert_allclose(stats['plane_mean'], stack.mean(axis=(1, 2)), rtol=1e-6)
+    np.testing.assert_array_equal(stats['plane_max'], stack.max(axis=(1, 2)))
+    assert stats['histogram'].sum() == stack.size
+
+
+def test_stack_stats_saturation_and_bins():
+    plane = np.zeros((4, 4), np.uint16)
+    plane[0, :3] = [1, 64, 128]
+    plane[1, :2] = 65535
+    stats = StackStats(np.uint16)
+    stats.add_plane(plane)
+    result = stats.as_dict()
+    assert result['plane_saturated'].tolist() == [2]
+    assert len(result['histogram']) == 1024
+    # 64 values per bin over the 16 bit range
+    assert result['histogram'][:3].tolist() == [12, 1, 1] and result['histogram'][-1] == 2
+    assert result['bin_edges'][1] == 64
+
+
+def test_focus_score_prefers_sharp_planes():
+    rng = np.random.default_rng(0)
+    sharp = rng.uniform(100, 1000, (64, 64))
+    blurred = (sharp + np.roll(sharp, 1, 0) + np.roll(sharp, 1, 1) + np.roll(sharp, 1, (0, 1))) / 4
+    assert focus_score(sharp) > focus_score(blurred)
+    assert focus_score(2 * sharp) == pytest.approx(focus_score(sharp))
+    assert focus_score(np.zeros((8, 8))) == 0
@@ -0,0 +1,70 @@
+import threading
+import numpy as np
+import pytest
+import zarr
+from tifffile import imread
+from interact.temporal import TemporalAccumulator, temporal_name
+
+
+def timelapse(acquisition, ch_name='C00'):
+    '''
+    The I0 stacks of every timepoint of a channel, as (T, Z, Y, X).
+    '''
+    return np.stack([imread(acquisition / f'S000_t{t:06d}_V000_R0000_X000_Y000_{ch_name}_I0_D0_P00008.tif') for t in range(3)])
+
+
+def test_image_reductions_match_numpy(acquisition):
+    frames = timelapse(acquisition).max(axis=1)
+    accumulator = TemporalAccumulator(frames.shape[1:], frames.dtype)
+    for frame in frames:
+        accumulator.add(frame)
+    np.testing.assert_array_equal(accumulator.result('max'), frames.max(axis=0))
+    np.testing.assert_array_equal(accumulator.result('min'), frames.min(axis=0))
+    np.testing.assert_allclose(accumulator.result('mean'), np.mean(frames, axis=0, dtype=np.float64), rtol=1e-6)
+    np.testing.assert_allclose(accumulator.result('std'), np.std(frames, axis=0, dtype=np.float64), rtol=1e-5, atol=1e-3)
+    assert accumulator.result('max').dtype == frames.dtype
+    assert accumulator.num_timepoints == 3
+
+
+def test_running_average_is_in_timepoint_order(acquisition):
+    frames = timelapse(acquisition).max(axis=1).astype(np.float64)
+    accumulator = TemporalAccumulator(frames.shape[1:], np.uint16, reductions=('running',), alpha=0.25)
+    for t in (2, 0, 1):
+        accumulator.add(frames[t].astype(np.uint16), t=t)
+    expected = frames[0]
+    for frame in frames[1:]:
+        expected = expected + 0.25 * (frame - expected)
+    np.testing.assert_allclose(accumulator.result('running'), expected, rtol=1e-6)
+
+
+def test_volume_reductions_from_threads(acquisition, tmp_path):
+    volumes = timelapse(acquisition)
+    accumulator = TemporalAccumulator(volumes.shape[1:], volumes.dtype, state_dir=tmp_path / 'state', state_dtype=np.float32)
+    assert 'running' not in accumulator.reductions
+
+    def add(volume):
+        for z, plane in enumerate(volume):
+            accumulator.add_plane(z, plane)
+
+    threads = [threading.Thread(target=add, args=(volume,)) for volume in volumes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    np.testing.assert_array_equal(accumulator.result('max'), volumes.max(axis=0))
+    np.testing.assert_allclose(accumulator.result('mean'), volumes.mean(axis=0), rtol=1e-5)
+    np.testing.assert_allclose(accumulator.result('std', z=3), volumes[:, 3].std(axis=0), rtol=1e-4, atol=1e-2)
+
+    paths = accumulator.write_volumes(lambda reduction: tmp_path / f'{temporal_name(reduction)}.zarr', [(1, 1, 1), (1, 2, 2)],
+                                      (2.5, 0.64, 0.64))
+    assert [path.name for path in paths] == ['TMax.zarr', 'TMin.zarr', 'TMean.zarr', 'TStd.zarr']
+    np.testing.assert_array_equal(zarr.open_group(str(paths[1]), mode='r')['0'][:], volumes.min(axis=0))
+    accumulator.close()
+    assert not (tmp_path / 'state').exists()
+
+
+def test_unknown_reduction():
+    with pytest.raises(ValueError):
+        TemporalAccumulator((4, 4), np.uint16, reductions=('median',))
+    with pytest.raises(ValueError):
+        TemporalAccumulator((4, 4), np.uint16, reductions=('max',)).result('mean')